@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import html.parser
+import html
 import os.path
 import re
 import urllib, urllib.request, urllib.parse
@@ -20,8 +20,13 @@ RE_SEARCH_PDF += r'(?P<title>[^<]*)</a></div>'
 
 RE_GET_PDF = r'<a\s+href="(?P<url>[^"]+)" title="Téléchargez en PDF'
 
-from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, NewspaperStream, LoaderException
+from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, NewspaperStream, LoaderException, CHUNK_SIZE
 from nd.scheduler import WeeklySchedule, SimpleNewspaperDownloadScheduler
+import nd.resume
+import nd.http_client
+import nd.listing
+import nd.metrics
+import nd.session
 
 class CourrierInternationalNetAccess(object):
     '''
@@ -32,7 +37,7 @@ class CourrierInternationalNetAccess(object):
         '''
         Create a new session on the website with the given credentials.
         '''
-        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+        opener = nd.http_client.build_opener()
         PARAMS = {
             'name': username,
             'pass': password,
@@ -40,20 +45,26 @@ class CourrierInternationalNetAccess(object):
         }
         urllogin = urllib.parse.urljoin(URL_BASE, LOGIN_PAGE)
         query = urllib.request.Request(urllogin, urllib.parse.urlencode(PARAMS).encode('utf-8'))
-        query.add_header('User-agent', 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/27.0.1453.110 Safari/537.36')
         loginPage = opener.open(query)
         loginPage.close()
         return opener
 
     def issues_page(self, opener):
         '''
-        Returns the pages full of issues
+        Returns the page full of issues and the number of bytes read
         '''
         urllist = urllib.parse.urljoin(URL_BASE, LIST_PAGE)
         listPage = opener.open(urllist)
-        lines = ''.join(map(lambda x : x.decode('utf-8'), listPage.readlines()))
+        lines = listPage.readlines()
         listPage.close()
-        return lines
+        return ''.join(map(lambda x : x.decode('utf-8'), lines)), sum(map(len, lines))
+
+    def issues_stream(self, opener, headers=None):
+        '''
+        Returns the page full of issues (to be read), requested with "headers"
+        '''
+        url = urllib.parse.urljoin(URL_BASE, LIST_PAGE)
+        return opener.open(nd.session.StreamedRequest(url, headers=headers or {}))
 
     def open(self, opener, url):
         return opener.open(url)
@@ -64,6 +75,9 @@ class CourrierInternationalLoader(NewspaperLoader):
         self._netaccess = netaccess
         self._config = config
         self._opener = None
+        self._partial_store = nd.resume.partial_store(config)
+        self._session = nd.session.session_cache(config)
+        self._listing = nd.session.ParsedPage()
 
     def get_scheduler(self):
         schedule = WeeklySchedule(4)
@@ -73,67 +87,83 @@ class CourrierInternationalLoader(NewspaperLoader):
     def name(self):
         return 'Courrier International'
 
+    def host(self):
+        return urllib.parse.urlparse(URL_BASE).netloc
+
     def init(self):
         self._opener = None
-        try:
+        with nd.http_client.loader_errors('log on %s' % self.name()):
             USERNAME = self._config.get("nd.plugin.ci.username")
             PASSWORD = self._config.get("nd.plugin.ci.password")
 
             if not USERNAME:
                 raise LoaderException('Invalid username')
 
-            self._opener = self._netaccess.login(USERNAME, PASSWORD)
+            def login():
+                opener = self._netaccess.login(USERNAME, PASSWORD)
+                logger = logging.getLogger(__name__)
+                logger.info('Login successfuly on %s', self.name())
+                return opener
 
-            logger = logging.getLogger(__name__)
-            logger.info('Login successfuly on %s', self.name())
-        except urllib.request.HTTPError as e:
-            raise LoaderException('HTTP error when logging on %s (Exception %s, HTTP code: %s)' % \
-                                  (self.name(), e, e.code))
-        except urllib.request.URLError as e:
-            raise LoaderException('Invalid URL to log on %s (Exception %s)' % \
-                                  (self.name(), e))
+            # the session is reused by the next attempts
+            self._opener = self._session.get(login)
 
     def open(self, url):
         return self._netaccess.open(self._opener, url)
 
-    def issues(self):
-        logger = logging.getLogger(__name__)
+    def partial_store(self):
+        return self._partial_store
 
+    def issues(self):
         if not self._opener:
             raise LoaderException("The newspaper '%s' is not initialized" % self.name())
 
         # load the index page
         urllist = urllib.parse.urljoin(URL_BASE, LIST_PAGE)
-        try:
-            lines = self._netaccess.issues_page(self._opener)
-        except urllib.request.HTTPError as e:
-            raise LoaderException('HTTP error when logging on %s (Exception %s, HTTP code: %s)' % \
-                                  (self.name(), e, e.code))
-        except urllib.request.URLError as e:
-            raise LoaderException('Invalid URL to log on %s (Exception %s)' % \
-                                  (self.name(), e))
+        with nd.http_client.loader_errors('list the issues of %s' % self.name(), self._session), \
+             nd.metrics.phase(nd.metrics.LISTING_FETCH) as measure:
+            lines, size = self._netaccess.issues_page(self._opener)
+            measure.add(size)
 
-        h = html.parser.HTMLParser()
+        # an unchanged page is not parsed again
+        with nd.metrics.phase(nd.metrics.LISTING_PARSE):
+            return self._listing.parse(lines, self._parse_issues)
 
-        issues = []
-        for urlmatch in re.finditer(RE_SEARCH_PDF, lines, re.DOTALL):
-            metadata = urlmatch.groupdict()
+    def iter_issues(self):
+        if not self._opener:
+            raise LoaderException("The newspaper '%s' is not initialized" % self.name())
 
-            relative_url = h.unescape(metadata['url'])
-            url = urllib.parse.urljoin(URL_BASE, relative_url)
+        with nd.http_client.loader_errors('list the issues of %s' % self.name(), self._session):
+            open_page = lambda headers : self._netaccess.issues_stream(self._opener, headers)
+            for issue in nd.listing.iter_listing(self._listing, open_page, RE_SEARCH_PDF, self._issue):
+                yield issue
 
-            date = metadata['date']
-            try:
-                date = datetime.datetime.strptime(date, '%d %B %Y').date()
-            except ValueError as e:
-                logger.warning('Invalid date %s in %s for an issue' % \
-                               (date, self.name()))
-                date = None
+    def _issue(self, metadata):
+        '''
+        The issue described by a match of RE_SEARCH_PDF (None if invalid)
+        '''
+        relative_url = html.unescape(metadata['url'])
+        url = urllib.parse.urljoin(URL_BASE, relative_url)
 
-            title = metadata['title']
+        date = metadata['date']
+        try:
+            date = datetime.datetime.strptime(date, '%d %B %Y').date()
+        except ValueError as e:
+            logger = logging.getLogger(__name__)
+            logger.warning('Invalid date %s in %s for an issue' % \
+                           (date, self.name()))
+            return None
 
-            if date:
-                issues.append(CourrierInternationalIssue(title, date, self, url))
+        return CourrierInternationalIssue(metadata['title'], date, self, url)
+
+    def _parse_issues(self, lines):
+        logger = logging.getLogger(__name__)
+
+        issues = []
+        for urlmatch in re.finditer(RE_SEARCH_PDF, lines, re.DOTALL):
+            issue = self._issue(urlmatch.groupdict())
+            if issue:
+                issues.append(issue)
 
         logger.info('%d issues found on the website', len(issues))
         issues.sort(key=lambda x : (x.date(), x.title()), reverse=True)
@@ -151,7 +181,7 @@ class CourrierInternationalIssue(OnlineNewspaperIssue):
         return self._url
 
     def open(self):
-        try:
+        with nd.http_client.loader_errors('download "%s" (URL %s)' % (self.title(), self._url)):
             pdflinkPageStream = self.loader().open(self._url)
             pdflinkPage = ''.join(map(lambda x : x.decode('utf-8'), pdflinkPageStream.readlines()))
 
@@ -164,17 +194,14 @@ class CourrierInternationalIssue(OnlineNewspaperIssue):
                                 str(self), self.url())
                 link = links[0].groupdict()['url']
 
+                store = self.loader().partial_store()
+                if store:
+                    return nd.resume.ResumableStream(store, repr(self), link, self.loader().open)
                 stream = self.loader().open(link)
                 return CourrierInternationalStream(stream, self)
             else:
                 raise LoaderException('No PDF link found for "%s" on "%s"' % \
                                       (self.title(), self.url()))
-        except urllib.request.HTTPError as e:
-            raise LoaderException('HTTP error when downloading "%s" (HTTP code: %s)' % \
-                                  (self.title(), e.code))
-        except urllib.request.URLError as e:
-            raise LoaderException('Invalid URL to download issue "%s" for %s (Exception %s, URL %s)' % \
-                                  (self.title(), self.loader().name(), e.reason, self._url))
 
 class CourrierInternationalStream(NewspaperStream):
 
@@ -188,9 +215,14 @@ class CourrierInternationalStream(NewspaperStream):
         except IOError:
             pass
 
-    def read(self, size=512):
+    def read(self, size=CHUNK_SIZE):
         try:
             return self._stream.read(size)
         except:
             raise LoaderException('Error when downloading %s' % repr(self._issue))
 
+    def readinto(self, buffer):
+        try:
+            return self._stream.readinto(buffer)
+        except:
+            raise LoaderException('Error when downloading %s' % repr(self._issue))
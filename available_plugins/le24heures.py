@@ -1,16 +1,16 @@
 # -*- coding: utf-8 -*-
-import os.path
+import io
 import re
 import shutil
 import urllib, urllib.request, urllib.parse
 import datetime, time
 import logging
-
-import distutils.spawn
-import subprocess
+import concurrent.futures
 
 import zipfile, tempfile
 
+import pypdf
+
 URL_BASE = 'http://journal.24heures.ch/'
 LOGIN_PAGE = '/user'
 TOKEN_PAGE = '/epsaepaper/epaper/1'
@@ -22,12 +22,17 @@ RE_SEARCH_PDF = r'<option (selected="selected" )?value="\d{8}">(?P<d>\d{2})\.(?P
 
 DOWNLOAD_PAGE = '/Products/VQH-{edition_type}/{date}/zip/full.zip'
 
-# pdfconcat can be found here: http://pts-mini-gpl.googlecode.com/svn/trunk/pdfconcat/
-#  you can compile it with gcc.
-PDFCONCAT_PATH = 'pdfconcat'
+# the ZIP files smaller than this size (in bytes) are kept in memory
+ZIP_SPOOL_SIZE = 64*2**20
+
+# the editions downloaded at the same time
+PARALLEL_EDITIONS = 5
 
-from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, NewspaperStream, LoaderException
+from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, NewspaperStream, LoaderException, CHUNK_SIZE
 from nd.scheduler import DailySchedule, SimpleNewspaperDownloadScheduler
+import nd.http_client
+import nd.metrics
+import nd.session
 
 class Le24HeuresNetAccess(object):
     '''
@@ -38,7 +43,7 @@ class Le24HeuresNetAccess(object):
         '''
         Create a new session on the website with the given credentials.
         '''
-        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+        opener = nd.http_client.build_opener()
         PARAMS = {
             'name': username,
             'pass': password,
@@ -47,14 +52,12 @@ class Le24HeuresNetAccess(object):
         }
         urllogin = urllib.parse.urljoin(URL_BASE, LOGIN_PAGE)
         query = urllib.request.Request(urllogin, urllib.parse.urlencode(PARAMS).encode('utf-8'))
-        query.add_header('User-agent', 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/27.0.1453.110 Safari/537.36')
         loginPage = opener.open(query)
         loginPage.readlines()
         loginPage.close()
 
         urltoken = urllib.parse.urljoin(URL_BASE, TOKEN_PAGE)
         query = urllib.request.Request(urltoken)
-        query.add_header('User-agent', 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/27.0.1453.110 Safari/537.36')
         tokenPage = opener.open(query)
         tokenPage.readlines()
         tokenPage.close()
@@ -63,15 +66,31 @@ class Le24HeuresNetAccess(object):
 
     def issues_page(self, opener, issue_type):
         '''
-        Returns the pages full of issues
+        Returns the page full of issues and the number of bytes read
         '''
         # load the index page
         url = LIST_PAGE.format(edition_type=issue_type)
         urllist = urllib.parse.urljoin(URL_VIEWER_BASE, url)
         listPage = opener.open(urllist)
-        lines = ''.join(map(lambda x : x.decode('utf-8'), listPage.readlines()))
+        lines = listPage.readlines()
         listPage.close()
-        return lines
+        return ''.join(map(lambda x : x.decode('utf-8'), lines)), sum(map(len, lines))
+
+    def zip_exists(self, opener, issue_type, date):
+        '''
+        Whether the issue is published (without downloading it), None
+         if the server cannot tell (HEAD refused, server error)
+        '''
+        url = DOWNLOAD_PAGE.format(edition_type=issue_type, date=date)
+        urldownload = urllib.parse.urljoin(URL_VIEWER_BASE, url)
+        try:
+            response = opener.open(urllib.request.Request(urldownload, method='HEAD'))
+        except urllib.request.HTTPError as e:
+            if e.code == 404:
+                return False
+            return None
+        response.close()
+        return True if 200 <= response.status < 300 else None
 
     def load_zip(self, opener, issue_type, date):
         # load the index page
@@ -85,6 +104,8 @@ class Le24HeuresLoader(NewspaperLoader):
         self._netaccess = netaccess
         self._config = config
         self._opener = None
+        self._session = nd.session.session_cache(config)
+        self._listings = {}
 
     def get_scheduler(self):
         schedule = DailySchedule()
@@ -94,6 +115,9 @@ class Le24HeuresLoader(NewspaperLoader):
     def name(self):
         return '24 Heures'
 
+    def host(self):
+        return urllib.parse.urlparse(URL_VIEWER_BASE).netloc
+
     def init(self):
         self._issue_types = {'LAUSANNE': "24 heures", 
                              'VQ_EMPLOI': "Emploi", 
@@ -102,40 +126,45 @@ class Le24HeuresLoader(NewspaperLoader):
                              'VQSU': "Suppléments"}
 
         self._opener = None
-        try:
+        with nd.http_client.loader_errors('log on %s' % self.name()):
             USERNAME = self._config.get("nd.plugin.24heures.username")
             PASSWORD = self._config.get("nd.plugin.24heures.password")
 
             if not USERNAME:
                 raise LoaderException('Invalid username')
 
-            self._opener = self._netaccess.login(USERNAME, PASSWORD)
+            def login():
+                opener = self._netaccess.login(USERNAME, PASSWORD)
+                logger = logging.getLogger(__name__)
+                logger.info('Login successfuly on %s', self.name())
+                return opener
 
-            logger = logging.getLogger(__name__)
-            logger.info('Login successfuly on %s', self.name())
-        except urllib.request.HTTPError as e:
-            raise LoaderException('HTTP error when logging on %s (Exception %s, HTTP code: %s)' % \
-                                  (self.name(), e, e.code))
-        except urllib.request.URLError as e:
-            raise LoaderException('Invalid URL to log on %s (Exception %s)' % \
-                                  (self.name(), e))
+            # the session is reused by the next attempts
+            self._opener = self._session.get(login)
+
+    def parallel_issues(self):
+        return PARALLEL_EDITIONS
 
     def netaccess(self):
         return self._netaccess
 
     def _issues_by_type(self, id_type):
+        # called in the threads of issues()
+        with nd.http_client.loader_errors('list the issues of %s' % self.name(), self._session), \
+             nd.metrics.phase(nd.metrics.LISTING_FETCH, self.name()) as measure:
+            htmlpage, size = self._netaccess.issues_page(self._opener, id_type)
+            measure.add(size)
+
+        # an unchanged page is not parsed again
+        listing = self._listings.setdefault(id_type, nd.session.ParsedPage())
+        with nd.metrics.phase(nd.metrics.LISTING_PARSE, self.name()):
+            return listing.parse(htmlpage, lambda page : self._parse_issues(id_type, page))
+
+    def _parse_issues(self, id_type, htmlpage):
+        logger = logging.getLogger(__name__)
         issues = []
         issue_name = self._issue_types[id_type]
 
-        try:
-            htmlpage = self._netaccess.issues_page(self._opener, id_type)
-        except urllib.request.HTTPError as e:
-            raise LoaderException('HTTP error when logging on %s (Exception %s, HTTP code: %s)' % \
-                                  (self.name(), e, e.code))
-        except urllib.request.URLError as e:
-            raise LoaderException('Invalid URL to log on %s (Exception %s)' % \
-                                  (self.name(), e))
-
         for newspaper_match in re.finditer(RE_SEARCH_PDF, htmlpage, re.DOTALL):
             metadata = newspaper_match.groupdict()
 
@@ -158,14 +187,43 @@ class Le24HeuresLoader(NewspaperLoader):
         if not self._opener:
             raise LoaderException("The newspaper '%s' is not initialized" % self.name())
 
+        # the listings of the editions are fetched at the same time
         issues = []
-        for id_type in self._issue_types:
-            issues.extend(self._issues_by_type(id_type))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self._issue_types)) as executor:
+            futures = [executor.submit(self._issues_by_type, id_type) for id_type in self._issue_types]
+            for future in concurrent.futures.as_completed(futures):
+                issues.extend(future.result())
 
         logger.info('%d issues found on the website', len(issues))
         issues.sort(key=lambda x : (x.date(), x.title()), reverse=True)
         return issues
 
+    def issues_for(self, issue_date):
+        if not self._opener:
+            raise LoaderException("The newspaper '%s' is not initialized" % self.name())
+
+        logger = logging.getLogger(__name__)
+        # the URLs of the editions are built from the date
+        strdate = issue_date.strftime('%Y%m%d')
+        def published(id_type):
+            try:
+                with nd.http_client.loader_errors('look for the issues of %s' % self.name(), self._session):
+                    return self._netaccess.zip_exists(self._opener, id_type, strdate)
+            except LoaderException as e:
+                logger.warning(str(e))
+                return None
+
+        id_types = list(self._issue_types)
+        with nd.metrics.phase(nd.metrics.LISTING_FETCH, self.name()), \
+             concurrent.futures.ThreadPoolExecutor(max_workers=len(id_types)) as executor:
+            found = list(executor.map(published, id_types))
+        if None in found:
+            # the editions are found in the listings
+            logger.info('Cannot check the issues of %s on %s', self.name(), issue_date)
+            return None
+        return [Le24HeuresIssue(id_type, self._issue_types[id_type], issue_date, self)
+                for id_type, exists in zip(id_types, found) if exists]
+
     def opener(self):
         return self._opener
 
@@ -177,92 +235,78 @@ class Le24HeuresIssue(OnlineNewspaperIssue):
             raise ValueError('Invalid argument')
         self._id_type = id_type
 
-    def _create_PDF(self, pdfpathes):
+    def _merge_PDF(self, myzip, output):
         '''
-        Create a new PDF from the files pointed by the pathes in
-         pdfpathes.
+        Write the pages of the ZIP file (one PDF by page) as a single
+         PDF in output. The pages are read from the ZIP file in memory.
         '''
-        if not pdfpathes:
-            raise ValueError('No file, no PDF!')
+        pages = sorted(myzip.namelist())
+        if not pages:
+            raise LoaderException('No page in the ZIP file of "%s"' % self.title())
 
         try:
-            filepath = tempfile.mktemp(suffix='.pdf')
-        except IOError as e:
-            raise LoaderException('Cannot create a temporary file (%s)' % e)
-
-        # compression to be used
-        params = ['-o', filepath]
-        cmdline = [PDFCONCAT_PATH]+params+pdfpathes
-        self._execute(cmdline)
-        return filepath
-
-    def _execute(self, params):
-        try:
-            code = subprocess.call(params)
-            if code != 0:
-                raise LoaderException('Error code %d when executing %s' % \
-                                      (code, ' '.join(params)))
-        except OSError as e:
-            raise LoaderException('Exception "%s" when executing %s' % \
-                                  (e, ' '.join(params)))
+            writer = pypdf.PdfWriter()
+            for page in pages:
+                writer.append(io.BytesIO(myzip.read(page)))
+            writer.write(output)
+        except pypdf.errors.PyPdfError as e:
+            raise LoaderException('Invalid page in the ZIP file of "%s" (%s)' % (self.title(), e))
 
     def open(self):
         try:
             strdate = self.date().strftime('%Y%m%d')
             opener = self.loader().opener()
 
-            stream = self.loader().netaccess().load_zip(opener, self._id_type, strdate)
-            zipf = tempfile.NamedTemporaryFile(delete=True)
-            shutil.copyfileobj(stream, zipf)
-            stream.close()
+            zipf = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE)
+            with nd.http_client.loader_errors('download "%s"' % self.title()):
+                stream = self.loader().netaccess().load_zip(opener, self._id_type, strdate)
+                try:
+                    shutil.copyfileobj(stream, zipf)
+                finally:
+                    stream.close()
             zipf.seek(0)
 
-            myzip = zipfile.ZipFile(zipf)
+            # the merged PDF is the only file written
+            thepdf = tempfile.TemporaryFile()
             try:
-                pages = myzip.namelist()
-                pages.sort()
-
-                pdfdir = tempfile.mkdtemp()
-                pdfpathes = []
-                for page in pages:
-                    pdfpathes.append(myzip.extract(page, pdfdir))
+                with zipfile.ZipFile(zipf) as myzip:
+                    self._merge_PDF(myzip, thepdf)
+            except:
+                thepdf.close()
+                raise
             finally:
-                myzip.close()
-
-            thepdf = self._create_PDF(pdfpathes)
-            for pdfpath in pdfpathes:
-                os.remove(pdfpath)
-            shutil.rmtree(pdfdir)
+                zipf.close()
+            thepdf.seek(0)
 
             return Le24HeuresStream(thepdf, self)
 
         except zipfile.BadZipfile as e:
             raise LoaderException('Invalid ZIP file')
-        except urllib.request.HTTPError as e:
-            raise LoaderException('HTTP error when downloading "%s" (HTTP code: %s)' % \
-                                                    (self.title(), e.code))
-        except urllib.request.URLError as e:
-            raise LoaderException('Invalid URL to download issue "%s" for %s (Exception %s, URL %s)' % \
-                                                    (self.title(), self.loader().name(), e.reason, self._url))
+        except (IOError, OSError) as e:
+            raise LoaderException('Cannot create the PDF of "%s" (%s)' % (self.title(), e))
 
 class Le24HeuresStream(NewspaperStream):
 
-    def __init__(self, path, issue):
-        self._path = path
-        self._stream = open(path, 'rb')
+    def __init__(self, stream, issue):
+        # a temporary file, removed when it is closed
+        self._stream = stream
         self._issue = issue
 
     def close(self):
         try:
             self._stream.close()
-            os.remove(self._path)
         except (IOError, OSError) as e:
             logger = logging.getLogger(__name__)
-            logger.warning('Cannot close and remove file %s', self._path)
+            logger.warning('Cannot close the PDF of %s', repr(self._issue))
 
-    def read(self, size=512):
+    def read(self, size=CHUNK_SIZE):
         try:
             return self._stream.read(size)
         except:
             raise LoaderException('Error when downloading %s' % repr(self._issue))
 
+    def readinto(self, buffer):
+        try:
+            return self._stream.readinto(buffer)
+        except:
+            raise LoaderException('Error when downloading %s' % repr(self._issue))
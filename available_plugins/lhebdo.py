@@ -4,8 +4,8 @@ import tempfile
 
 import re
 
-import html.parser
-import urllib, urllib.request
+import html
+import urllib, urllib.request, urllib.parse
 
 import datetime
 import logging
@@ -14,31 +14,48 @@ LIST_PAGE = 'http://admin7.iomedia.ch/system/client_data/hebdo/epaper/pageflip/g
 
 RE_GET_NEWSPAPERS = 'edition=(?P<date>\d{8})_(?P<no>\d+)\'\s*/>.*?href="(?P<url>[^"]*)"'
 
-from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, NewspaperStream, LoaderException
+from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, NewspaperStream, LoaderException, CHUNK_SIZE
 from nd.scheduler import WeeklySchedule, SimpleNewspaperDownloadScheduler
+import nd.resume
+import nd.http_client
+import nd.listing
+import nd.metrics
+import nd.session
 
 class LHebdoInternetAccess(object):
   '''
   A class to provide network access to the Courrier International loader.
   '''
 
+  def __init__(self):
+    self._opener = nd.http_client.build_opener()
+
   def issues_page(self):
     '''
-    Returns the pages full of issues
+    Returns the page full of issues and the number of bytes read
     '''
-    listPage = urllib.request.urlopen(LIST_PAGE % datetime.date.today().year)
-    lines = ''.join(map(lambda x : x.decode('utf-8'), listPage.readlines()))
+    listPage = self._opener.open(LIST_PAGE % datetime.date.today().year)
+    lines = listPage.readlines()
     listPage.close()
-    return lines
+    return ''.join(map(lambda x : x.decode('utf-8'), lines)), sum(map(len, lines))
+
+  def issues_stream(self, headers=None):
+    '''
+    Returns the page full of issues (to be read), requested with "headers"
+    '''
+    url = LIST_PAGE % datetime.date.today().year
+    return self._opener.open(nd.session.StreamedRequest(url, headers=headers or {}))
 
   def download(self, url):
-    return urllib.request.urlopen(url)
+    return self._opener.open(url)
 
 class LHebdoLoader(NewspaperLoader):
 
   def __init__(self, config, netaccess=LHebdoInternetAccess()):
     self._netaccess = netaccess
     self._config = config
+    self._partial_store = nd.resume.partial_store(config)
+    self._listing = nd.session.ParsedPage()
 
   def get_scheduler(self):
     schedule = WeeklySchedule(4)
@@ -51,38 +68,55 @@ class LHebdoLoader(NewspaperLoader):
   def open(self, url):
     return self._netaccess.download(url)
 
+  def partial_store(self):
+    return self._partial_store
+
+  def host(self):
+    return urllib.parse.urlparse(LIST_PAGE).netloc
+
   def init(self):
     pass
 
   def issues(self):
-    logger = logging.getLogger(__name__)
-
     # load the index page
+    with nd.http_client.loader_errors('list the issues of %s' % self.name()), \
+         nd.metrics.phase(nd.metrics.LISTING_FETCH) as measure:
+      lines, size = self._netaccess.issues_page()
+      measure.add(size)
+
+    # an unchanged page is not parsed again
+    with nd.metrics.phase(nd.metrics.LISTING_PARSE):
+      return self._listing.parse(lines, self._parse_issues)
+
+  def iter_issues(self):
+    with nd.http_client.loader_errors('list the issues of %s' % self.name()):
+      for issue in nd.listing.iter_listing(self._listing, self._netaccess.issues_stream, RE_GET_NEWSPAPERS, self._issue):
+        yield issue
+
+  def _issue(self, metadata):
+    '''
+    The issue described by a match of RE_GET_NEWSPAPERS (None if invalid)
+    '''
+    title = html.unescape('N&deg;'+metadata['no'])
+
     try:
-      lines = self._netaccess.issues_page()
-    except urllib.request.HTTPError as e:
-      raise LoaderException('HTTP error when logging on %s (Exception %s, HTTP code: %s)' % \
-                          (self.name(), e, e.code))
-    except urllib.request.URLError as e:
-      raise LoaderException('Invalid URL to log on %s (Exception %s)' % \
-                          (self.name(), e))
-
-    h = html.parser.HTMLParser()
-    issues = []
-    for urlmatch in re.finditer(RE_GET_NEWSPAPERS, lines, re.DOTALL):
-      metadata = urlmatch.groupdict()
+      date = datetime.datetime.strptime(metadata['date'], '%Y%m%d').date()
+    except ValueError as e:
+      logger = logging.getLogger(__name__)
+      logger.warning('Invalid date %s in %s for an issue' % \
+                     (metadata['date'], self.name()))
+      return None
 
-      title = h.unescape('N&deg;'+metadata['no'])
+    return LHebdoIssue(title, date, self, metadata['url'])
 
-      try:
-        date = datetime.datetime.strptime(metadata['date'], '%Y%m%d').date()
-      except ValueError as e:
-        logger.warning('Invalid date %s in %s for an issue' % \
-                       (date, self.name()))
-        date = None
+  def _parse_issues(self, lines):
+    logger = logging.getLogger(__name__)
 
-      if date:
-        issues.append(LHebdoIssue(title, date, self, metadata['url']))
+    issues = []
+    for urlmatch in re.finditer(RE_GET_NEWSPAPERS, lines, re.DOTALL):
+      issue = self._issue(urlmatch.groupdict())
+      if issue:
+        issues.append(issue)
 
     logger.info('%d issues found on the website', len(issues))
     issues.sort(key=lambda x : (x.date(), x.title()), reverse=True)
@@ -98,18 +132,13 @@ class LHebdoIssue(OnlineNewspaperIssue):
 
   def open(self):
 
-    try:
+    with nd.http_client.loader_errors('download "%s" (URL %s)' % (self.title(), self._url)):
       loader = self.loader()
 
+      if loader.partial_store():
+        return nd.resume.ResumableStream(loader.partial_store(), repr(self), self._url, loader.open)
       return LHebdoStream(loader.open(self._url), self)
 
-    except urllib.request.HTTPError as e:
-      raise LoaderException('HTTP error when downloading "%s" (HTTP code: %s)' % \
-                            (self.title(), e.code))
-    except urllib.request.URLError as e:
-      raise LoaderException('Invalid URL to download issue "%s" for %s (Exception %s, URL %s)' % \
-                            (self.title(), self.loader().name(), e.reason, self._url))
-
 class LHebdoStream(NewspaperStream):
 
   def __init__(self, stream, issue):
@@ -122,9 +151,14 @@ class LHebdoStream(NewspaperStream):
     except IOError:
       pass
 
-  def read(self, size=512):
+  def read(self, size=CHUNK_SIZE):
     try:
       return self._stream.read(size)
     except:
       raise LoaderException('Error when downloading %s' % repr(self._issue))
 
+  def readinto(self, buffer):
+    try:
+      return self._stream.readinto(buffer)
+    except:
+      raise LoaderException('Error when downloading %s' % repr(self._issue))
@@ -0,0 +1,110 @@
+'''
+Compare the startup cost of the plugins when all of them are imported
+ (nd.plugin_utils.load_plugins) with the manifest, which only imports
+ the plugins selected with --plugins.
+
+  > python -m benchmarks.plugin_registry_bench
+
+Every plugin is imported in a new interpreter (the imported modules are
+ cached otherwise).
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import nd.plugin_utils
+
+from argparse import ArgumentParser
+
+PACKAGE = 'benchplugins'
+
+# a plugin with the size of the real ones (and their imports)
+PLUGIN = '''
+import html, http.cookiejar, json, zipfile, xml.dom.minidom
+import nd.http_client, nd.listing, nd.resume, nd.session
+from nd.newspaper_api import NewspaperLoader
+
+%(functions)s
+
+class Loader%(i)d(NewspaperLoader):
+  def __init__(self, config):
+    pass
+  def name(self):
+    return 'Paper %(i)d'
+'''
+
+FUNCTION = '''
+def parse%d(page):
+  return [line.strip().split('=') for line in page.splitlines() if line and not line.startswith('#')]
+'''
+
+LOAD_ALL = '''
+import importlib, nd.plugin_utils
+nd.plugin_utils.load_plugins(importlib.import_module(%r))
+'''
+
+LOAD_SELECTED = '''
+import nd.plugin_utils
+registry = nd.plugin_utils.plugin_registry(%r)
+assert len(registry.load(%r)) == %d
+'''
+
+def create_plugins(directory, nb, nb_functions):
+  package = os.path.join(directory, PACKAGE)
+  os.mkdir(package)
+  open(os.path.join(package, '__init__.py'), 'w').close()
+  functions = ''.join(FUNCTION % i for i in range(nb_functions))
+  for i in range(nb):
+    with open(os.path.join(package, 'paper%d.py' % i), 'w') as plugin:
+      plugin.write(PLUGIN % dict(i=i, functions=functions))
+
+def startup(directory, code, runs):
+  '''
+  The shortest time to run "code" in a new interpreter
+  '''
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([directory, os.getcwd(), env.get('PYTHONPATH', '')])
+  best = None
+  for i in range(runs):
+    started = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    elapsed = time.perf_counter() - started
+    best = elapsed if best == None else min(best, elapsed)
+  return best
+
+def bench(nb, nb_functions, selected, runs):
+  directory = tempfile.mkdtemp()
+  try:
+    create_plugins(directory, nb, nb_functions)
+    sys.path.insert(0, directory)
+    manifest = os.path.join(directory, 'plugins.cfg')
+    nd.plugin_utils.write_manifest(manifest, __import__(PACKAGE))
+    sys.path.remove(directory)
+    sys.modules.pop(PACKAGE, None)
+
+    names = ['Paper %d' % i for i in range(min(selected, nb))]
+    # the bytecode is compiled once for all the runs
+    startup(directory, LOAD_ALL % PACKAGE, 1)
+    scan = startup(directory, LOAD_ALL % PACKAGE, runs)
+    base = startup(directory, LOAD_SELECTED % (manifest, [], 0), runs)
+    lazy = startup(directory, LOAD_SELECTED % (manifest, names, len(names)), runs)
+    return scan, lazy, base
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description='Plugin loading benchmark')
+  parser.add_argument("-n", "--plugins", type=int, nargs='+', default=[5, 20, 50, 100],
+                      help="The number of installed plugins")
+  parser.add_argument("-s", "--selected", type=int, default=2, help="The number of plugins used")
+  parser.add_argument("-f", "--functions", type=int, default=200, help="The size of a plugin (in functions)")
+  parser.add_argument("-r", "--runs", type=int, default=5, help="The number of runs (the best is kept)")
+  options = parser.parse_args()
+
+  print('%8s %16s %16s %16s' % ('plugins', 'all (ms)', 'manifest (ms)', 'no plugin (ms)'))
+  for nb in options.plugins:
+    scan, lazy, base = bench(nb, options.functions, options.selected, options.runs)
+    print('%8d %16.1f %16.1f %16.1f' % (nb, scan * 1000, lazy * 1000, base * 1000))
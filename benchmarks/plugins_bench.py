@@ -0,0 +1,151 @@
+'''
+Run every plugin end to end (login, listing, download) against its
+ recorded HTTP exchanges and report the time of every phase (see
+ nd.metrics), to track the regressions of the plugins.
+
+Record the fixtures once with real accounts (in the configuration):
+
+  > python -m benchmarks.plugins_bench --record --config config.cfg --date 2015-06-12
+
+Then replay them offline, with the latency and the bandwidth of the
+ websites:
+
+  > python -m benchmarks.plugins_bench --latency 0.05 --bandwidth 2000000
+'''
+import datetime
+import importlib
+import inspect
+import json
+import os
+import os.path
+import pkgutil
+
+import nd.config
+import nd.http_client
+import nd.metrics
+import nd.replay
+from nd.newspaper_api import NewspaperLoader, chunks
+from nd.newspaper_loader import NewspaperDownloader
+from nd.sender import Sender
+
+from argparse import ArgumentParser
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+class ReadingSender(Sender):
+  '''
+  Read the issues without storing them
+  '''
+
+  def __init__(self):
+    super(ReadingSender, self).__init__(True)
+
+  def upload_PDF(self, issue, stream):
+    for chunk in chunks(stream):
+      pass
+
+class ReplayConfiguration(nd.config.Configuration):
+  '''
+  The credentials aren't checked by the replay server
+  '''
+
+  def get(self, variable):
+    if variable.endswith('.username') or variable.endswith('.password'):
+      return 'replay'
+    return super(ReplayConfiguration, self).get(variable)
+
+def plugins():
+  '''
+  The loader classes by plugin module
+  '''
+  import available_plugins
+  for importer, modname, ispkg in pkgutil.iter_modules(available_plugins.__path__):
+    module = importlib.import_module('available_plugins.%s' % modname)
+    for name, obj in inspect.getmembers(module):
+      if inspect.isclass(obj) and issubclass(obj, NewspaperLoader) and obj != NewspaperLoader:
+        yield modname, obj
+
+def run(loader_class, config, issue_date):
+  '''
+  Download the issues of the date and returns the phases timed
+  '''
+  newspaper = loader_class(config)
+  registry = nd.metrics.REGISTRY
+  registry.drain()
+  ok = NewspaperDownloader([ReadingSender()], newspaper)(issue_date)
+  phases = {}
+  for sample in registry.drain():
+    seconds, size = phases.get(sample.phase, (0, 0))
+    phases[sample.phase] = (seconds + sample.seconds, size + sample.size)
+  return ok, phases
+
+def record(modname, loader_class, config, issue_date):
+  archive = nd.replay.Archive({'date': issue_date.isoformat()})
+  pool = nd.http_client.POOL
+  nd.http_client.POOL = nd.replay.RecordingPool(archive)
+  try:
+    ok, phases = run(loader_class, config, issue_date)
+  finally:
+    nd.http_client.POOL = pool
+  os.makedirs(FIXTURES, exist_ok=True)
+  archive.save(os.path.join(FIXTURES, '%s.zip' % modname))
+  return ok, phases
+
+def replay(server, modname, loader_class):
+  archive = nd.replay.Archive.load(os.path.join(FIXTURES, '%s.zip' % modname))
+  issue_date = datetime.datetime.strptime(archive.meta['date'], '%Y-%m-%d').date()
+  server.replay(archive)
+  try:
+    return run(loader_class, ReplayConfiguration(), issue_date)
+  finally:
+    nd.http_client.POOL.clear()
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description='End to end benchmark of the plugins')
+  parser.add_argument("-r", "--record", action='store_true', help="Record the fixtures on the websites")
+  parser.add_argument("-c", "--config", type=str, default="config.cfg", help="The configuration (to record)")
+  parser.add_argument("-d", "--date", type=str, default=datetime.date.today().isoformat(),
+                      help="The date of the issues recorded (yyyy-mm-dd)")
+  parser.add_argument("-l", "--latency", type=float, default=0, help="The latency of the replayed responses (s)")
+  parser.add_argument("-b", "--bandwidth", type=float, default=0, help="The replayed bandwidth (bytes/s)")
+  parser.add_argument("-o", "--output", type=str, help="Save the timings in this JSON file")
+  options = parser.parse_args()
+
+  config = nd.config.Configuration()
+  server = None
+  if options.record:
+    with open(options.config) as config_file:
+      config.load(config_file)
+  else:
+    # the proxy of the openers (some plugins create them when imported)
+    server = nd.replay.ReplayServer(nd.replay.Archive(), latency=options.latency,
+                                    bandwidth=options.bandwidth or None)
+    server.start()
+    os.environ['http_proxy'] = server.url()
+
+  results = {}
+  print('%-12s %-16s %10s %12s %12s' % ('plugin', 'phase', 'time (s)', 'bytes', 'bytes/s'))
+  for modname, loader_class in plugins():
+    try:
+      if options.record:
+        ok, phases = record(modname, loader_class, config,
+                            datetime.datetime.strptime(options.date, '%Y-%m-%d').date())
+      else:
+        ok, phases = replay(server, modname, loader_class)
+    except nd.replay.ReplayException as e:
+      print('%-12s no fixture (%s)' % (modname, e))
+      continue
+
+    results[modname] = dict(ok=ok, phases=phases)
+    for phase, (seconds, size) in sorted(phases.items()):
+      throughput = '%12.0f' % (size / seconds) if size and seconds else '%12s' % '-'
+      print('%-12s %-16s %10.3f %12d %s' % (modname, phase, seconds, size, throughput))
+    if not ok:
+      print('%-12s the download failed' % modname)
+
+  if server:
+    server.close()
+
+  if options.output:
+    with open(options.output, 'w') as output:
+      json.dump(results, output, indent=1, sort_keys=True)
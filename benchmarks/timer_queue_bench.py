@@ -0,0 +1,64 @@
+'''
+Compare the cost of one scheduler tick (find the next newspaper to
+ download, then reschedule it) with a min() scan over all the schedulers
+ and with nd.scheduler.TimerQueue.
+
+  > python -m benchmarks.timer_queue_bench
+'''
+import datetime
+import random
+import timeit
+
+import nd.scheduler
+
+from argparse import ArgumentParser
+
+class FakeScheduler(object):
+  def __init__(self, start, step):
+    self._wait_until = start
+    self._step = step
+
+  def wait_until(self):
+    return self._wait_until
+
+  def success(self):
+    self._wait_until += self._step
+
+def create_schedulers(nb):
+  rnd = random.Random(nb)
+  base = datetime.datetime(2015, 1, 1)
+  return [FakeScheduler(base + datetime.timedelta(seconds=rnd.randint(0, 86400)),
+                        datetime.timedelta(seconds=rnd.randint(3600, 86400)))
+          for i in range(nb)]
+
+def min_scan_tick(schedulers):
+  scheduler = min(*schedulers, key=lambda x : x.wait_until())
+  scheduler.success()
+
+def timer_queue_tick(timers):
+  when, scheduler = timers.pop()
+  scheduler.success()
+  timers.push(scheduler, scheduler.wait_until())
+
+def bench(nb, ticks):
+  schedulers = create_schedulers(nb)
+  scan = timeit.timeit(lambda : min_scan_tick(schedulers), number=ticks)
+
+  timers = nd.scheduler.TimerQueue()
+  for scheduler in create_schedulers(nb):
+    timers.push(scheduler, scheduler.wait_until())
+  heap = timeit.timeit(lambda : timer_queue_tick(timers), number=ticks)
+
+  return scan / ticks, heap / ticks
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description='Scheduler tick benchmark')
+  parser.add_argument("-t", "--ticks", type=int, default=2000, help="The number of ticks measured")
+  parser.add_argument("-n", "--schedules", type=int, nargs='+', default=[10, 100, 1000, 10000],
+                      help="The number of registered schedules")
+  options = parser.parse_args()
+
+  print('%10s %16s %16s' % ('schedules', 'min() scan (us)', 'TimerQueue (us)'))
+  for nb in options.schedules:
+    scan, heap = bench(nb, options.ticks)
+    print('%10d %16.2f %16.2f' % (nb, scan * 10**6, heap * 10**6))
@@ -0,0 +1,20 @@
+
+import nd.control
+import sys
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description='Send a command to the running newspaper downloader.')
+parser.add_argument("-s", "--socket", type=str, default="downloader.sock", help="The control socket of the downloader")
+parser.add_argument("command", nargs='+', help="now <newspaper> | reschedule <newspaper> <yyyy-mm-dd> | drain | status")
+
+options = parser.parse_args()
+
+try:
+  line = ' '.join(map(lambda x : '"%s"' % x if ' ' in x else x, options.command))
+  reply = nd.control.send_command(options.socket, line)
+  print(reply)
+  if reply.startswith('error'):
+    sys.exit(1)
+except nd.control.ControlException as e:
+  print(e, file=sys.stderr)
+  sys.exit(1)
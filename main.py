@@ -5,10 +5,16 @@ import nd.scheduler
 import nd.newspaper_loader
 import nd.sender
 import nd.config
+import nd.control
+import nd.isolation
+import nd.http_client
+import nd.ratelimit
+import nd.metrics
+import nd.reload
 
 import sqlite3
 
-import sys, locale
+import sys, locale, signal, socket, os
 locale.setlocale(locale.LC_ALL, 'fr_CH.utf-8')
 
 from argparse import ArgumentParser
@@ -22,6 +28,10 @@ parser.add_argument("-e", "--email", nargs=1, dest="email", help="The mail to wh
 
 parser.add_argument("-c", "--config", nargs=1, default="config.cfg", dest="config", help="The configuration file")
 
+parser.add_argument("-s", "--socket", type=str, default="downloader.sock", help="The socket to control the downloader (see control.py)")
+
+parser.add_argument("-n", "--node", type=str, default="%s-%d" % (socket.gethostname(), os.getpid()), help="The name of this node when several downloaders share the database")
+
 parser.add_argument("-p", "--plugins", nargs='+', default=None, dest="plugins", type=str, help="Use a subset of the available plugins")
 
 options = parser.parse_args()
@@ -42,6 +52,32 @@ except (IOError, OSError, nd.config.ConfigurationException) as e:
   logger.critical(e)
   sys.exit(1)
 
+def config_int(variable, default):
+  value = config.get(variable)
+  try:
+    return int(value) if value else default
+  except ValueError:
+    logger.critical("Invalid value '%s' for %s", value, variable)
+    sys.exit(1)
+
+WORKERS = config_int("nd.downloader.workers", 4)
+WORKERS_PER_HOST = config_int("nd.downloader.workers_per_host", 1)
+
+# the plugins run in child processes unless nd.isolation.workers is 0
+ISOLATION_WORKERS = config_int("nd.isolation.workers", WORKERS)
+ISOLATION_TIMEOUT = config_int("nd.isolation.timeout", 60*60)
+ISOLATION_MEMORY_LIMIT = config_int("nd.isolation.memory_limit", 0)
+
+# the metrics are served on this local port (0 to disable them)
+METRICS_PORT = config_int("nd.metrics.port", 0)
+
+# the thumbnails are created in the background by these threads (0 to
+#  create them before storing the issues)
+THUMBNAIL_WORKERS = config_int("nd.downloader.thumbnail_workers", 1)
+
+# the modified plugins are reloaded after this time (in seconds, 0 to disable it)
+RELOAD_INTERVAL = config_int("nd.downloader.reload_interval", 10)
+
 GMAIL_EMAIL = config.get("nd.downloader.log.email")
 GMAIL_PASSWORD = config.get("nd.downloader.log.password")
 
@@ -57,8 +93,16 @@ if GMAIL_EMAIL and GMAIL_PASSWORD:
   mailhandler.setLevel(logging.CRITICAL)
   logger.addHandler(mailhandler)
 
-# load the plugins
-imported_plugins = nd.plugin_utils.load_plugins()
+# load the plugins (only those used when they are listed)
+registry = nd.plugin_utils.plugin_registry()
+if len(registry) > 0:
+  try:
+    imported_plugins = registry.load(options.plugins)
+  except nd.plugin_utils.PluginException as e:
+    logger.error(str(e))
+    sys.exit(1)
+else:
+  imported_plugins = nd.plugin_utils.load_plugins()
 newspapers = []
 for imported_plugin in imported_plugins:
   try:
@@ -83,7 +127,8 @@ if not newspapers:
 db_name = '%s.db' % options.db
 db_folder = options.db
 try:
-  ndb = sqlite3.connect(db_name)
+  # the downloads run in several threads
+  ndb = sqlite3.connect(db_name, check_same_thread=False)
   try:
     newspaperDir = nd.sender.DirManager(db_folder)
   except IOError as e:
@@ -91,16 +136,88 @@ try:
     sys.exit(1)
 
   db = nd.db.DB(ndb)
-  dbSender = nd.sender.DBSender(newspaperDir, db)
+  thumbnails = None
+  if THUMBNAIL_WORKERS > 0:
+    thumbnails = nd.sender.ThumbnailPool(newspaperDir, db, THUMBNAIL_WORKERS)
+  dbSender = nd.sender.DBSender(newspaperDir, db, thumbnails)
   senders = [dbSender]
   if options.email != None:
     senders.append(nd.sender.GMailSender(options.email))
 
-  downloaders = []
-  for newspaper in newspapers:
-    downloaders.append(nd.newspaper_loader.NewspaperDownloader(senders, newspaper))
+  # the limits are shared by the plugin processes
+  try:
+    nd.http_client.POOL.limits = nd.ratelimit.rate_limits(config, [newspaper.host() for newspaper in newspapers])
+  except nd.config.ConfigurationException as e:
+    logger.error(str(e))
+    sys.exit(1)
 
-  nd.scheduler.download(downloaders)
+  # the fork helper of the plugin processes is forked before any thread is started
+  pool = None
+  if ISOLATION_WORKERS > 0:
+    pool = nd.isolation.PluginPool(newspapers, ISOLATION_WORKERS, ISOLATION_MEMORY_LIMIT * 2**20)
+
+  if thumbnails:
+    # the thumbnails not created before the last stop
+    thumbnails.resume()
+
+  def create_downloader(newspaper):
+    if pool:
+      downloader = nd.isolation.IsolatedNewspaperDownloader(senders, newspaper, pool, ISOLATION_TIMEOUT,
+                                                            known_content=db.issue_exists)
+    else:
+      downloader = nd.newspaper_loader.NewspaperDownloader(senders, newspaper, known_content=db.issue_exists)
+    # every issue is downloaded by only one of the nodes sharing the database
+    return nd.newspaper_loader.LeasedNewspaperDownloader(downloader, db, options.node)
+
+  def reload_downloader(loader_class):
+    newspaper = loader_class(config)
+    if options.plugins != None and newspaper.name() not in options.plugins:
+      return None
+    logger.info("Reload the newspaper loader for '%s'", newspaper.name())
+    if pool:
+      pool.update(loader_class, config)
+    return create_downloader(newspaper)
+
+  downloaders = [create_downloader(newspaper) for newspaper in newspapers]
+
+  control_servers = []
+  if METRICS_PORT:
+    try:
+      metrics_server = nd.metrics.MetricsServer(('127.0.0.1', METRICS_PORT))
+      metrics_server.start()
+      control_servers.append(metrics_server)
+    except (IOError, OSError) as e:
+      logger.error("Cannot serve the metrics on port %d (%s)", METRICS_PORT, e)
+
+  def engine_started(engine):
+    # stop once the downloads in progress are over
+    drain = lambda signum, frame : engine.post(nd.control.ControlCommand('drain'))
+    signal.signal(signal.SIGTERM, drain)
+
+    try:
+      control_server = nd.control.ControlServer(options.socket, engine)
+      control_server.start()
+      control_servers.append(control_server)
+    except (IOError, OSError) as e:
+      logger.error("Cannot listen for commands on %s (%s)", options.socket, e)
+
+    if RELOAD_INTERVAL > 0:
+      watcher = nd.reload.PluginWatcher(engine, reload_downloader, interval=RELOAD_INTERVAL)
+      watcher.start()
+      control_servers.append(watcher)
+
+  try:
+    # the first attempts are made when the issues are usually published
+    learner = nd.scheduler.PublicationTimeLearner(db)
+    nd.scheduler.download(downloaders, max_workers=WORKERS, max_per_host=WORKERS_PER_HOST,
+                          state_store=db, engine_started=engine_started, learner=learner)
+  finally:
+    for control_server in control_servers:
+      control_server.close()
+    if pool:
+      pool.close()
+    if thumbnails:
+      thumbnails.close()
 
 except nd.newspaper_api.LoaderException as e:
   logger.error(e)
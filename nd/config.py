@@ -46,3 +46,9 @@ class Configuration(object):
   def get(self, variable):
     return self._inputs.get(variable, "")
 
+  def items(self, prefix=''):
+    '''
+    The variables (and their values) whose name starts with "prefix"
+    '''
+    return sorted((name, value) for name, value in self._inputs.items() if name.startswith(prefix))
+
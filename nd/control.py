@@ -0,0 +1,160 @@
+'''
+A local control channel to send commands to the running downloader:
+
+  now <newspaper>                     download the newspaper right now
+  reschedule <newspaper> <yyyy-mm-dd> the next issue to download
+  drain                               stop once the downloads in progress are over
+  status                              the next download of every newspaper
+
+The commands are received on a Unix socket, one command per line, and
+ a single line is sent back.
+'''
+
+import datetime
+import logging
+import os
+import shlex
+import socket
+import socketserver
+import threading
+
+class ControlException(Exception):
+  pass
+
+class ControlCommand(object):
+  '''
+  A command to be executed by the download engine's thread.
+  '''
+
+  ACTIONS = ('now', 'reschedule', 'drain', 'status')
+
+  def __init__(self, action, args=()):
+    if action not in self.ACTIONS:
+      raise ControlException('Unknown command "%s"' % action)
+    self._action = action
+    self._args = tuple(args)
+    self._done = threading.Event()
+    self._reply = None
+
+  def action(self):
+    return self._action
+
+  def args(self):
+    return self._args
+
+  def execute(self, engine):
+    try:
+      self._reply = getattr(self, '_%s' % self._action)(engine, *self._args)
+    except KeyError as e:
+      self._reply = 'error: unknown newspaper %s' % e
+    except (TypeError, ValueError) as e:
+      self._reply = 'error: invalid arguments (%s)' % e
+    finally:
+      self._done.set()
+
+  def reply(self, timeout=None):
+    '''
+    Wait until the command is executed and returns its result
+     (None if it isn't executed in time)
+    '''
+    if self._done.wait(timeout):
+      return self._reply
+    return None
+
+  def _now(self, engine, name):
+    if engine.download_now(name):
+      return 'ok'
+    return 'error: %s is already being downloaded' % name
+
+  def _reschedule(self, engine, name, date):
+    issue_date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+    if engine.reschedule(name, issue_date):
+      return 'ok'
+    return 'error: %s is being downloaded' % name
+
+  def _drain(self, engine):
+    engine.drain()
+    return 'ok'
+
+  def _status(self, engine):
+    lines = []
+    for name, issue_date, wait_until in engine.status():
+      when = 'downloading' if wait_until is None else wait_until.strftime('%Y-%m-%d %H:%M')
+      lines.append('%s: %s (%s)' % (name, issue_date, when))
+    return '; '.join(lines)
+
+def parse_command(line):
+  '''
+  Create the command described by the line (ControlException if
+   it is invalid)
+  '''
+  try:
+    words = shlex.split(line)
+  except ValueError as e:
+    raise ControlException('Invalid command (%s)' % e)
+  if not words:
+    raise ControlException('Empty command')
+  return ControlCommand(words[0], words[1:])
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    line = self.rfile.readline().decode('utf-8').strip()
+    try:
+      command = parse_command(line)
+      self.server.engine.post(command)
+      reply = command.reply(self.server.reply_timeout)
+      if reply is None:
+        reply = 'error: no reply from the downloader'
+    except ControlException as e:
+      reply = 'error: %s' % e
+    self.wfile.write(('%s\n' % reply).encode('utf-8'))
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  '''
+  Receive the commands on the Unix socket "path" and send them
+   to the engine.
+  '''
+
+  daemon_threads = True
+
+  def __init__(self, path, engine, reply_timeout=5):
+    if os.path.exists(path):
+      os.remove(path)
+    socketserver.UnixStreamServer.__init__(self, path, _ControlHandler)
+    os.chmod(path, 0o600)
+    self.engine = engine
+    self.reply_timeout = reply_timeout
+
+  def start(self):
+    '''
+    Serve the commands in a background thread.
+    '''
+    thread = threading.Thread(target=self.serve_forever, name='control')
+    thread.daemon = True
+    thread.start()
+
+    logger = logging.getLogger(__name__)
+    logger.info('Waiting for commands on %s', self.server_address)
+
+  def close(self):
+    self.shutdown()
+    self.server_close()
+    try:
+      os.remove(self.server_address)
+    except OSError:
+      pass
+
+def send_command(path, line, timeout=10):
+  '''
+  Send a command to the downloader listening on "path" and returns
+   its reply.
+  '''
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(timeout)
+      sock.connect(path)
+      sock.sendall(('%s\n' % line).encode('utf-8'))
+      return sock.makefile('rb').readline().decode('utf-8').strip()
+  except (IOError, OSError) as e:
+    raise ControlException('Cannot reach the downloader on %s (%s)' % (path, e))
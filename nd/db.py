@@ -2,6 +2,8 @@
 import logging
 import datetime
 import hashlib
+import threading
+import time
 
 import sqlite3
 import nd.newspaper_api
@@ -10,6 +12,12 @@ from contextlib import closing
 class DBException(Exception):
   pass
 
+class DuplicateIssueException(DBException):
+  '''
+  An issue with the same content is already stored.
+  '''
+  pass
+
 class PersistedNewspaperIssue(nd.newspaper_api.NewspaperIssue):
 
   def __init__(self, id, title, date, path, newspaper, thumbnail_path=None):
@@ -36,9 +44,15 @@ class PersistedNewspaperIssue(nd.newspaper_api.NewspaperIssue):
 class DB(object):
   def __init__(self, sqlhandle):
     self._sqlhandle = sqlhandle
+    # the downloads run concurrently and share the same connection
+    self._lock = threading.RLock()
     self._USER_TABLE = 'user'
     self._NEWSPAPER_TABLE = 'newspaper'
     self._ISSUE_TABLE = 'issue'
+    self._SCHEDULER_TABLE = 'scheduler_state'
+    self._PUBLICATION_TABLE = 'publication_sample'
+    self._LEASE_TABLE = 'lease'
+    self._THUMBNAIL_TABLE = 'thumbnail_job'
     
     try:
       user_fields = [('username', 'TEXT PRIMARY KEY'),
@@ -53,8 +67,35 @@ class DB(object):
                       ('date', 'DATE NOT NULL'),
                       ('newspaper', 'TEXT NOT NULL REFERENCES newspaper'),
                       ('path', 'TEXT NOT NULL'),
-                      ('thumbnail_path', 'TEXT')]
+                      ('thumbnail_path', 'TEXT'),
+                      ('sha256', 'TEXT')]
       self._create_table(self._ISSUE_TABLE, issue_fields)
+      # the issues stored before the content was hashed
+      self._ensure_column(self._ISSUE_TABLE, 'sha256', 'TEXT')
+      self._sqlhandle.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s_sha256 ON %s(sha256)' \
+                                % (self._ISSUE_TABLE, self._ISSUE_TABLE))
+
+      scheduler_fields = [('newspaper', 'TEXT PRIMARY KEY'),
+                          ('next_date', 'DATE NOT NULL'),
+                          ('retry_step', 'INTEGER NOT NULL'),
+                          ('last_success', 'DATE')]
+      self._create_table(self._SCHEDULER_TABLE, scheduler_fields)
+
+      publication_fields = [('newspaper', 'TEXT NOT NULL'),
+                            ('date', 'DATE NOT NULL'),
+                            ('offset', 'INTEGER NOT NULL'),
+                            ('PRIMARY KEY', '(newspaper, date)')]
+      self._create_table(self._PUBLICATION_TABLE, publication_fields)
+
+      lease_fields = [('name', 'TEXT PRIMARY KEY'),
+                      ('owner', 'TEXT NOT NULL'),
+                      ('expires', 'REAL NOT NULL'),
+                      ('done', 'INTEGER NOT NULL DEFAULT 0')]
+      self._create_table(self._LEASE_TABLE, lease_fields)
+
+      # the issues whose thumbnail is still to be created
+      thumbnail_fields = [('issue', 'INTEGER PRIMARY KEY REFERENCES issue')]
+      self._create_table(self._THUMBNAIL_TABLE, thumbnail_fields)
     except sqlite3.DatabaseError as e:
       raise DBException('Cannot initialize the database (%s)' % e)
 
@@ -73,6 +114,13 @@ class DB(object):
                 % (tableName, ','.join(fields))
       self._sqlhandle.execute(sql)
 
+  def _ensure_column(self, tableName, column, column_type):
+    try:
+      self._sqlhandle.execute('ALTER TABLE %s ADD COLUMN %s %s' % (tableName, column, column_type))
+    except sqlite3.OperationalError:
+      # the column already exists
+      pass
+
   def _ensure_newspaper_exists(self, newspaper_name):
     sql = 'SELECT COUNT(*) FROM %s WHERE name = ?'
     sql = sql % self._NEWSPAPER_TABLE
@@ -82,22 +130,55 @@ class DB(object):
       sql = 'INSERT INTO %s(name) VALUES(?)' % self._NEWSPAPER_TABLE
       self._sqlhandle.execute(sql, (newspaper_name,))
 
-  def add_issue(self, newspaperissue, path, thumbnail_path=None):
+  def add_issue(self, newspaperissue, path, thumbnail_path=None, sha256=None, thumbnail_job=False):
+    '''
+    Store the issue saved in "path" and returns its id. If thumbnail_job
+     is true, its thumbnail is to be created (see thumbnail_jobs).
+     DuplicateIssueException is raised if an issue with the same SHA-256
+     digest (hex) is already stored.
+    '''
+    with self._lock:
+      try:
+        newspaper_name = newspaperissue.loader().name()
+        self._ensure_newspaper_exists(newspaper_name)
+
+        date = newspaperissue.date().strftime('%Y-%m-%d 00:00:00')
+        title = newspaperissue.title()
+
+        data = (title, date, path, newspaper_name, thumbnail_path, sha256)
+        cursor = self._sqlhandle.execute("INSERT INTO %s(title, date, path, newspaper, thumbnail_path, sha256) VALUES(?, ?, ?, ?, ?, ?)" \
+                  % self._ISSUE_TABLE, data)
+        if thumbnail_job:
+          self._sqlhandle.execute('INSERT INTO %s(issue) VALUES(?)' % self._THUMBNAIL_TABLE,
+                                  (cursor.lastrowid,))
+
+        self._sqlhandle.commit()
+        return cursor.lastrowid
+      except sqlite3.DatabaseError as e:
+        # before another thread uses the connection
+        self._sqlhandle.rollback()
+        if isinstance(e, sqlite3.IntegrityError) and self._is_duplicate(e):
+          raise DuplicateIssueException('The content of %s is already stored (%s)' % (newspaperissue, e))
+        raise DBException('Cannot create an issue (%s)' % e)
+
+  def _is_duplicate(self, error):
+    '''
+    Whether the IntegrityError is a violation of the unique SHA-256 index
+    '''
+    return str(error) == 'UNIQUE constraint failed: %s.sha256' % self._ISSUE_TABLE
+  
+  def issue_exists(self, sha256):
+    '''
+    Whether an issue with this SHA-256 digest (hex) is already stored
+    '''
     try:
-      newspaper_name = newspaperissue.loader().name()
-      self._ensure_newspaper_exists(newspaper_name)
-
-      date = newspaperissue.date().strftime('%Y-%m-%d 00:00:00')
-      title = newspaperissue.title()
-
-      data = (title, date, path, newspaper_name, thumbnail_path)
-      self._sqlhandle.execute("INSERT INTO %s(title, date, path, newspaper, thumbnail_path) VALUES(?, ?, ?, ?, ?)" \
-                % self._ISSUE_TABLE, data)
-
-      self._sqlhandle.commit()
+      with self._lock:
+        row = self._sqlhandle.execute('SELECT COUNT(*) FROM %s WHERE sha256 = ?' % self._ISSUE_TABLE,
+                                      (sha256,)).fetchone()
+      return row[0] > 0
     except sqlite3.DatabaseError as e:
-      raise DBException('Cannot create an issue (%s)' % e)
-  
+      raise DBException('Cannot check the issues (%s)' % e)
+
   def newspapers(self):
     try:
       while self._sqlhandle:
@@ -136,6 +217,138 @@ class DB(object):
     except sqlite3.DatabaseError as e:
       raise DBException('Cannot fetch the newspapers (%s)' % e)
 
+  def thumbnail_jobs(self):
+    '''
+    The thumbnails to be created: the id, the title, the path and the
+     newspaper of the issues
+    '''
+    sql = 'SELECT i.id, i.title, i.path, i.newspaper FROM %s j JOIN %s i ON i.id = j.issue ORDER BY i.id' \
+            % (self._THUMBNAIL_TABLE, self._ISSUE_TABLE)
+    try:
+      with self._lock:
+        return [tuple(row) for row in self._sqlhandle.execute(sql).fetchall()]
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot load the thumbnail jobs (%s)' % e)
+
+  def complete_thumbnail_job(self, issue_id, thumbnail_path=None):
+    '''
+    The thumbnail of the issue has been created in "thumbnail_path"
+     (None if it cannot be created)
+    '''
+    try:
+      with self._lock:
+        if thumbnail_path:
+          self._sqlhandle.execute('UPDATE %s SET thumbnail_path = ? WHERE id = ?' % self._ISSUE_TABLE,
+                                  (thumbnail_path, issue_id))
+        self._sqlhandle.execute('DELETE FROM %s WHERE issue = ?' % self._THUMBNAIL_TABLE, (issue_id,))
+        self._sqlhandle.commit()
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot save the thumbnail of the issue %s (%s)' % (issue_id, e))
+
+  def scheduler_state(self, newspaper_name):
+    '''
+    The persisted state (next issue date, retry step, last issue
+     downloaded) of the newspaper scheduler or None.
+    '''
+    sql = 'SELECT next_date, retry_step, last_success FROM %s WHERE newspaper = ?' \
+            % self._SCHEDULER_TABLE
+    try:
+      with self._lock:
+        row = self._sqlhandle.execute(sql, (newspaper_name,)).fetchone()
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot load the scheduler state (%s)' % e)
+
+    if row is None:
+      return None
+    parse = lambda x : datetime.datetime.strptime(x, '%Y-%m-%d').date() if x else None
+    return parse(row[0]), row[1], parse(row[2])
+
+  def save_scheduler_state(self, newspaper_name, next_date, retry_step, last_success=None):
+    sql = 'INSERT OR REPLACE INTO %s(newspaper, next_date, retry_step, last_success) VALUES(?, ?, ?, ?)' \
+            % self._SCHEDULER_TABLE
+    last_success = last_success.strftime('%Y-%m-%d') if last_success else None
+    data = (newspaper_name, next_date.strftime('%Y-%m-%d'), retry_step, last_success)
+    try:
+      with self._lock:
+        self._sqlhandle.execute(sql, data)
+        self._sqlhandle.commit()
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot save the scheduler state (%s)' % e)
+
+  def publication_samples(self, newspaper_name, limit):
+    '''
+    The last "limit" publication times (in seconds after midnight)
+     of the newspaper, the most recent first.
+    '''
+    sql = 'SELECT offset FROM %s WHERE newspaper = ? ORDER BY date DESC LIMIT ?' \
+            % self._PUBLICATION_TABLE
+    try:
+      with self._lock:
+        rows = self._sqlhandle.execute(sql, (newspaper_name, limit)).fetchall()
+      return [row[0] for row in rows]
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot load the publication times (%s)' % e)
+
+  def add_publication_sample(self, newspaper_name, date, offset):
+    sql = 'INSERT OR REPLACE INTO %s(newspaper, date, offset) VALUES(?, ?, ?)' \
+            % self._PUBLICATION_TABLE
+    try:
+      with self._lock:
+        self._sqlhandle.execute(sql, (newspaper_name, date.strftime('%Y-%m-%d'), offset))
+        self._sqlhandle.commit()
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot save the publication time (%s)' % e)
+
+  def acquire_lease(self, name, owner, ttl):
+    '''
+    Claim the lease "name" for "ttl" seconds. Returns True if the owner
+     holds it (a new lease, a lease renewed or a lease taken over after
+     its expiry), False if somebody else holds it or if it is done.
+    '''
+    now = time.time()
+    sql = 'INSERT INTO %s(name, owner, expires, done) VALUES(?, ?, ?, 0) ' \
+          'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires ' \
+          'WHERE done = 0 AND (owner = excluded.owner OR expires < ?)'
+    sql = sql % self._LEASE_TABLE
+    try:
+      with self._lock:
+        self._sqlhandle.execute(sql, (name, owner, now + ttl, now))
+        row = self._sqlhandle.execute('SELECT owner, done FROM %s WHERE name = ?' % self._LEASE_TABLE,
+                                      (name,)).fetchone()
+        self._sqlhandle.commit()
+      return row == (owner, 0)
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot acquire the lease %s (%s)' % (name, e))
+
+  def complete_lease(self, name, owner):
+    '''
+    Mark the lease as done: nobody will acquire it anymore.
+    '''
+    self._update_lease('UPDATE %s SET done = 1 WHERE name = ? AND owner = ?', name, owner)
+
+  def release_lease(self, name, owner):
+    '''
+    Release the lease so that somebody else can acquire it.
+    '''
+    self._update_lease('DELETE FROM %s WHERE name = ? AND owner = ? AND done = 0', name, owner)
+
+  def _update_lease(self, sql, name, owner):
+    try:
+      with self._lock:
+        self._sqlhandle.execute(sql % self._LEASE_TABLE, (name, owner))
+        self._sqlhandle.commit()
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot update the lease %s (%s)' % (name, e))
+
+  def lease_done(self, name):
+    try:
+      with self._lock:
+        row = self._sqlhandle.execute('SELECT done FROM %s WHERE name = ?' % self._LEASE_TABLE,
+                                      (name,)).fetchone()
+      return bool(row and row[0])
+    except sqlite3.DatabaseError as e:
+      raise DBException('Cannot check the lease %s (%s)' % (name, e))
+
   def __hashpassword(self, password):
       hash = hashlib.sha512()
       hash.update(password.encode('utf-8'))
@@ -0,0 +1,276 @@
+'''
+The HTTP client shared by the plugins: the connections to the websites
+ are kept alive and reused by the login, the listings and the downloads
+ of all the plugins, the pages are compressed (gzip) and every request
+ has a timeout. The requests and the bandwidth are limited by website if
+ the pool has limits (see nd.ratelimit).
+
+The openers are standard urllib openers (see build_opener), the errors
+ are translated into LoaderException with loader_errors:
+
+  opener = nd.http_client.build_opener()
+  with nd.http_client.loader_errors('log on Le Temps'):
+    page = opener.open(url)
+'''
+
+import contextlib
+import gzip
+import http.client
+import socket
+import ssl
+import threading
+import urllib.parse, urllib.request, urllib.response, urllib.error
+
+from nd.newspaper_api import LoaderException
+import nd.session
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/27.0.1453.110 Safari/537.36'
+
+# the default timeout of a request (in seconds)
+TIMEOUT = 60
+
+class _PooledResponse(http.client.HTTPResponse):
+  '''
+  A response giving its connection back to the pool once it has been
+   read completely.
+  '''
+
+  _pool = None
+  _aborted = False
+  _limit = None
+
+  def read(self, amt=None):
+    data = super(_PooledResponse, self).read(amt)
+    if self._limit:
+      self._limit.transferred(len(data))
+    return data
+
+  def readinto(self, buffer):
+    size = super(_PooledResponse, self).readinto(buffer)
+    if self._limit:
+      self._limit.transferred(size)
+    return size
+
+  def read1(self, n=-1):
+    data = super(_PooledResponse, self).read1(n)
+    if self._limit:
+      self._limit.transferred(len(data))
+    return data
+
+  def readline(self, limit=-1):
+    # also used by readlines() and the iteration on the lines
+    line = super(_PooledResponse, self).readline(limit)
+    # the chunked lines are read with read() (see io.IOBase.readline)
+    if self._limit and not self.chunked:
+      self._limit.transferred(len(line))
+    return line
+
+  def _close_conn(self):
+    # the end of the body (or close)
+    super(_PooledResponse, self)._close_conn()
+    self._release(not self.will_close and not self._aborted)
+
+  def close(self):
+    # a connection with unread data cannot be reused
+    self._aborted = not (self.fp == None or self.length == 0)
+    super(_PooledResponse, self).close()
+    self._release(False)
+
+  def _release(self, reusable):
+    if self._pool:
+      pool, self._pool = self._pool, None
+      pool.release(self._key, self._connection, reusable)
+
+class ConnectionPool(object):
+  '''
+  The idle connections by website (at most "max_idle" per website).
+   The requests wait for the limits of their website (see
+   nd.ratelimit.RateLimits).
+  '''
+
+  def __init__(self, max_idle=4, timeout=TIMEOUT, limits=None):
+    self.limits = limits
+    self._lock = threading.Lock()
+    self._idle = {}
+    self._max_idle = max_idle
+    self._timeout = timeout
+    self._context = ssl.create_default_context()
+
+  def _connect(self, key, timeout):
+    scheme, host, tunnel = key
+    if scheme == 'https':
+      connection = http.client.HTTPSConnection(host, timeout=timeout, context=self._context)
+    else:
+      connection = http.client.HTTPConnection(host, timeout=timeout)
+    if tunnel:
+      connection.set_tunnel(tunnel)
+    connection.response_class = _PooledResponse
+    return connection
+
+  def _acquire(self, key):
+    with self._lock:
+      connections = self._idle.get(key)
+      return connections.pop() if connections else None
+
+  def release(self, key, connection, reusable):
+    if reusable:
+      with self._lock:
+        connections = self._idle.setdefault(key, [])
+        if len(connections) < self._max_idle:
+          connections.append(connection)
+          return
+    connection.close()
+
+  def clear(self):
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for connections in idle.values():
+      for connection in connections:
+        connection.close()
+
+  def open(self, scheme, request):
+    '''
+    Send the urllib request on an idle connection (or a new one) and
+     returns the response (see urllib.request.AbstractHTTPHandler.do_open)
+    '''
+    if not request.host:
+      raise urllib.error.URLError('no host given')
+    key = (scheme, request.host, getattr(request, '_tunnel_host', None))
+    timeout = request.timeout
+    if timeout == None or timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+      timeout = self._timeout
+
+    headers = dict(request.unredirected_hdrs)
+    headers.update((k, v) for k, v in request.headers.items() if k not in headers)
+    headers = dict((name.title(), value) for name, value in headers.items())
+    headers['Connection'] = 'keep-alive'
+
+    limit = self.limits.get(urllib.parse.urlsplit(request.full_url).hostname) if self.limits else None
+    if limit:
+      limit.request()
+
+    connection = self._acquire(key)
+    while True:
+      reused = connection != None
+      if not reused:
+        connection = self._connect(key, timeout)
+      else:
+        connection.timeout = timeout
+        if connection.sock:
+          connection.sock.settimeout(timeout)
+      try:
+        connection.request(request.get_method(), request.selector, request.data, headers,
+                           encode_chunked=request.has_header('Transfer-encoding'))
+        response = connection.getresponse()
+        break
+      except (OSError, http.client.HTTPException) as e:
+        connection.close()
+        if not reused:
+          raise urllib.error.URLError(e)
+        # the website closed the idle connection: retry on a new one
+        connection = None
+
+    response._pool, response._key, response._connection = self, key, connection
+    response._limit = limit
+    response.url = request.get_full_url()
+    response.msg = response.reason
+    return response
+
+# the connections shared by all the openers
+POOL = ConnectionPool()
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+  '''
+  Send the requests through "pool" (POOL when the request is sent by
+   default)
+  '''
+
+  def __init__(self, pool=None):
+    super(PooledHTTPHandler, self).__init__()
+    self._pool = pool
+
+  def http_open(self, request):
+    return (self._pool or POOL).open('http', request)
+
+class PooledHTTPSHandler(urllib.request.HTTPSHandler):
+
+  def __init__(self, pool=None):
+    super(PooledHTTPSHandler, self).__init__()
+    self._pool = pool
+
+  def https_open(self, request):
+    return (self._pool or POOL).open('https', request)
+
+class _GzipStream(gzip.GzipFile):
+  '''
+  A decompressed response, closing the response when it is closed.
+  '''
+
+  def __init__(self, response):
+    super(_GzipStream, self).__init__(fileobj=response, mode='rb')
+    self._response = response
+
+  def close(self):
+    try:
+      super(_GzipStream, self).close()
+    finally:
+      self._response.close()
+
+class GzipProcessor(urllib.request.BaseHandler):
+  '''
+  Ask compressed responses (unless the request chose an encoding, like
+   the Range requests) and decompress them.
+  '''
+
+  # before nd.session.ConditionalCacheHandler
+  handler_order = 800
+
+  def http_request(self, request):
+    if not request.has_header('Accept-encoding'):
+      request.add_unredirected_header('Accept-encoding', 'gzip')
+    return request
+
+  def http_response(self, request, response):
+    headers = response.info()
+    if (headers.get('Content-Encoding') or '').lower() != 'gzip':
+      return response
+    del headers['Content-Encoding']
+    del headers['Content-Length']
+    decompressed = urllib.response.addinfourl(_GzipStream(response), headers,
+                                              response.geturl(), response.getcode())
+    decompressed.msg = response.msg
+    return decompressed
+
+  https_request = http_request
+  https_response = http_response
+
+def build_opener(*handlers, pool=None):
+  '''
+  An opener keeping the cookies, sending the pages already seen with
+   conditional requests (see nd.session) and reusing the connections
+   of "pool" (POOL by default).
+  '''
+  opener = urllib.request.build_opener(PooledHTTPHandler(pool), PooledHTTPSHandler(pool),
+                                       urllib.request.HTTPCookieProcessor(),
+                                       nd.session.ConditionalCacheHandler(),
+                                       GzipProcessor(), *handlers)
+  opener.addheaders = [('User-agent', USER_AGENT)]
+  return opener
+
+@contextlib.contextmanager
+def loader_errors(action, session=None):
+  '''
+  Translate the network errors raised in the block into LoaderException
+   ("action" describes what failed). The session (see
+   nd.session.SessionCache) is invalidated if the website refuses it.
+  '''
+  try:
+    yield
+  except urllib.error.HTTPError as e:
+    if session and e.code in (401, 403):
+      session.invalidate()
+    raise LoaderException('HTTP error when trying to %s (Exception %s, HTTP code: %s)' % (action, e, e.code))
+  except urllib.error.URLError as e:
+    raise LoaderException('Invalid URL when trying to %s (Exception %s)' % (action, e.reason))
+  except (socket.timeout, http.client.HTTPException, ConnectionError) as e:
+    raise LoaderException('Network error when trying to %s (%s)' % (action, e))
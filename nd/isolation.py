@@ -0,0 +1,445 @@
+'''
+Run the newspaper loaders in child processes, so that a plugin hanging
+ on the network or leaking memory costs one worker and not the whole
+ downloader.
+
+The children receive a request per download. They log in, list the
+ issues and stream the issues found back to the downloader, which sends
+ them to the senders. A child that exceeds its wall-clock limit is
+ killed and replaced. Its memory is limited by setrlimit (RLIMIT_AS).
+
+The children are forked by a helper process, itself forked before the
+ downloader starts its threads: a child forked later (to replace
+ another one) cannot inherit a lock held by a thread of the downloader.
+'''
+
+import concurrent.futures
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.reduction
+import os
+import queue
+import resource
+import signal
+import threading
+import time
+
+from nd.newspaper_api import OnlineNewspaperIssue, NewspaperStream, LoaderException
+from nd.newspaper_api import CHUNK_SIZE, chunks
+from nd.newspaper_loader import NewspaperDownloader, dated_issues
+import nd.metrics
+import nd.reload
+
+def _opened_issues(newspaper, issue_date):
+  '''
+  The issues published on issue_date with their opened stream. They
+   are opened at the same time if the newspaper allows it (see
+   NewspaperLoader.parallel_issues) and sent in order.
+  '''
+  issues = dated_issues(newspaper, issue_date)
+  parallel = newspaper.parallel_issues()
+  if parallel <= 1:
+    for issue in issues:
+      yield issue, issue.open()
+    return
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+    futures = [executor.submit(issue.open) for issue in issues]
+    sent = 0
+    try:
+      for issue, future in zip(issues, futures):
+        stream = future.result()
+        sent += 1
+        yield issue, stream
+    finally:
+      # the streams not sent after an error
+      for future in futures[sent:]:
+        if not future.cancel() and future.exception() == None:
+          future.result().close()
+
+def _serve(newspapers, conn, memory_limit):
+  '''
+  The main loop of a child process: download the issues requested
+   on "conn" and send them back.
+  '''
+  if memory_limit:
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+  while True:
+    try:
+      name, issue_date = conn.recv()
+    except (EOFError, OSError):
+      return
+
+    try:
+      with nd.metrics.newspaper(name):
+        newspaper = newspapers[name]
+        with nd.metrics.phase(nd.metrics.LOGIN):
+          newspaper.init()
+        for issue, stream in _opened_issues(newspaper, issue_date):
+          conn.send(('issue', issue.title(), issue.date()))
+          try:
+            # the content is sent unpickled, after a header
+            for chunk in chunks(stream, CHUNK_SIZE):
+              conn.send(('data', len(chunk)))
+              conn.send_bytes(chunk)
+          finally:
+            stream.close()
+          conn.send(('end',))
+      result = ('done',)
+    except Exception as e:
+      result = ('error', '%s: %s' % (e.__class__.__name__, e))
+    # the phases timed by the plugin (see nd.metrics)
+    conn.send(('metrics', nd.metrics.REGISTRY.drain()))
+    conn.send(result)
+
+def _update(newspapers, modname, qualname, args):
+  '''
+  Import the module "modname" again in the fork helper and add or
+   replace the newspaper of its loader class "qualname" (created
+   with "args"). The previous newspaper is kept after an error.
+  '''
+  try:
+    loader_class = nd.reload.import_again(modname)
+    for attribute in qualname.split('.'):
+      loader_class = getattr(loader_class, attribute)
+    newspaper = loader_class(*args)
+    newspapers[newspaper.name()] = newspaper
+  except Exception:
+    logger = logging.getLogger(__name__)
+    logger.exception("Cannot update the newspaper loader '%s' of the plugin processes", qualname)
+
+def _fork_plugins(newspapers, conn, pool_conn, memory_limit):
+  '''
+  The main loop of the fork helper: fork a plugin process for every
+   request on "conn" and send back its pid and its connection.
+  '''
+  # the end of the pool (the helper stops when it is closed)
+  pool_conn.close()
+  # the plugin processes are reaped automatically
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  while True:
+    try:
+      request = conn.recv()
+    except (EOFError, OSError):
+      return
+
+    if request[0] == 'update':
+      _update(newspapers, *request[1:])
+      continue
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        conn.close()
+        parent_conn.close()
+        _serve(newspapers, child_conn, memory_limit)
+        status = 0
+      finally:
+        os._exit(status)
+
+    child_conn.close()
+    conn.send(pid)
+    multiprocessing.reduction.send_handle(conn, parent_conn.fileno(), os.getppid())
+    parent_conn.close()
+
+class PluginProcess(object):
+  '''
+  A child process serving the downloads of the newspapers (see
+   PluginPool): its pid and the connection to it.
+  '''
+
+  def __init__(self, pid, conn):
+    self._pid = pid
+    self._conn = conn
+
+  def is_alive(self):
+    if self._conn.closed:
+      return False
+    try:
+      os.kill(self._pid, 0)
+      return True
+    except OSError:
+      return False
+
+  def request(self, name, issue_date):
+    try:
+      self._conn.send((name, issue_date))
+    except (IOError, OSError) as e:
+      self.kill()
+      raise LoaderException('The plugin process is dead (%s)' % e)
+
+  def receive(self, deadline):
+    '''
+    The next message from the child. The child is killed if it doesn't
+     answer before the deadline (a time.time() value) or if it dies.
+    '''
+    try:
+      if self._conn.poll(max(deadline - time.time(), 0)):
+        return self._conn.recv()
+    except (EOFError, IOError, OSError):
+      self.kill()
+      raise LoaderException('The plugin process died')
+
+    self.kill()
+    raise LoaderException('The plugin process timed out')
+
+  def receive_bytes_into(self, buffer, deadline):
+    '''
+    Receive the content following a 'data' header into "buffer" and
+     returns its length (see receive).
+    '''
+    try:
+      if self._conn.poll(max(deadline - time.time(), 0)):
+        return self._conn.recv_bytes_into(buffer)
+    except (EOFError, IOError, OSError, multiprocessing.BufferTooShort):
+      self.kill()
+      raise LoaderException('The plugin process died')
+
+    self.kill()
+    raise LoaderException('The plugin process timed out')
+
+  def kill(self):
+    try:
+      os.kill(self._pid, signal.SIGKILL)
+    except OSError:
+      # already dead (and reaped by the fork helper)
+      pass
+    self._conn.close()
+
+class PluginPool(object):
+  '''
+  A pool of "size" plugin processes shared by all the newspapers. The
+   fork helper is forked when the pool is created (it must be created
+   before the downloader starts its threads). The processes are
+   replaced when they are killed or when the newspapers are updated.
+  '''
+
+  def __init__(self, newspapers, size, memory_limit=None):
+    if not newspapers or size < 1:
+      raise ValueError('Invalid argument')
+    context = multiprocessing.get_context('fork')
+    self._conn, helper_conn = context.Pipe()
+    newspapers = dict(map(lambda x : (x.name(), x), newspapers))
+    self._helper = context.Process(target=_fork_plugins, args=(newspapers, helper_conn, self._conn, memory_limit),
+                                   name='plugin-forker')
+    self._helper.daemon = True
+    self._helper.start()
+    helper_conn.close()
+    self._lock = threading.Lock()
+
+    # the processes forked before the last update are replaced
+    self._generation = 0
+    self._idle = queue.Queue()
+    for i in range(size):
+      self._idle.put(self._fork())
+
+  def _fork(self):
+    '''
+    A new plugin process (forked by the helper)
+    '''
+    with self._lock:
+      try:
+        self._conn.send(('fork',))
+        pid = self._conn.recv()
+        handle = multiprocessing.reduction.recv_handle(self._conn)
+      except (EOFError, IOError, OSError) as e:
+        raise LoaderException('The plugin fork helper is dead (%s)' % e)
+      process = PluginProcess(pid, multiprocessing.connection.Connection(handle))
+      process.generation = self._generation
+    return process
+
+  def update(self, loader_class, *args):
+    '''
+    Add or replace (with the same name) the newspaper loader_class(*args)
+     after importing its module again in the fork helper (a loader isn't
+     sent to it, it may not be picklable): the processes are forked
+     again once they are idle.
+    '''
+    with self._lock:
+      try:
+        self._conn.send(('update', loader_class.__module__, loader_class.__qualname__, args))
+      except (IOError, OSError) as e:
+        raise LoaderException('The plugin fork helper is dead (%s)' % e)
+      self._generation += 1
+
+  def acquire(self):
+    '''
+    An idle process (wait until one is available)
+    '''
+    process = self._idle.get()
+    try:
+      if not process.is_alive():
+        logger = logging.getLogger(__name__)
+        logger.warning('Replace a dead plugin process')
+        process = self._fork()
+      elif process.generation != self._generation:
+        process.kill()
+        process = self._fork()
+    except LoaderException:
+      # replaced at the next attempt
+      self._idle.put(process)
+      raise
+    return process
+
+  def release(self, process):
+    self._idle.put(process)
+
+  def close(self):
+    while True:
+      try:
+        self._idle.get_nowait().kill()
+      except queue.Empty:
+        break
+    # the helper stops at the end of its connection
+    self._conn.close()
+    self._helper.join()
+
+def _record_metrics(samples):
+  # the phases timed by the plugin process
+  for sample in samples:
+    nd.metrics.REGISTRY.record(sample)
+
+class RemoteIssue(OnlineNewspaperIssue):
+  '''
+  An issue downloaded by a plugin process.
+  '''
+
+  def __init__(self, title, date, loader, stream):
+    super(RemoteIssue, self).__init__(title, date, loader)
+    self._stream = stream
+
+  def open(self):
+    return self._stream
+
+class PipeStream(NewspaperStream):
+  '''
+  The content of an issue received from a plugin process.
+  '''
+
+  def __init__(self, process, deadline):
+    self._process = process
+    self._deadline = deadline
+    self._buffer = memoryview(bytearray(CHUNK_SIZE))
+    self._length = 0
+    self._offset = 0
+    self._ended = False
+    self._failed = False
+
+  def ended(self):
+    return self._ended
+
+  def failed(self):
+    '''
+    Whether the plugin failed while sending the issue (the request
+     is then over)
+    '''
+    return self._failed
+
+  def _next_chunk(self, buffer):
+    '''
+    Receive the next chunk into "buffer" and returns its length
+     (0 at the end of the issue).
+    '''
+    message = self._process.receive(self._deadline)
+    while message[0] == 'metrics':
+      _record_metrics(message[1])
+      message = self._process.receive(self._deadline)
+
+    if message[0] == 'data':
+      return self._process.receive_bytes_into(buffer, self._deadline)
+    if message[0] == 'end':
+      self._ended = True
+      return 0
+    if message[0] == 'error':
+      self._ended = True
+      self._failed = True
+      raise LoaderException(message[1])
+    self._process.kill()
+    raise LoaderException('Unexpected message %s from the plugin process' % message[0])
+
+  def _fill(self):
+    while self._offset >= self._length and not self._ended:
+      self._length, self._offset = self._next_chunk(self._buffer), 0
+
+  def readinto(self, buffer):
+    if self._offset >= self._length and len(buffer) >= CHUNK_SIZE:
+      # large enough to receive the next chunk without a copy
+      length = 0
+      while not length and not self._ended:
+        length = self._next_chunk(buffer)
+      return length
+
+    self._fill()
+    length = min(len(buffer), self._length - self._offset)
+    buffer[:length] = self._buffer[self._offset:self._offset + length]
+    self._offset += length
+    return length
+
+  def read(self, size=CHUNK_SIZE):
+    self._fill()
+    data = bytes(self._buffer[self._offset:self._offset + size])
+    self._offset += len(data)
+    return data
+
+  def close(self):
+    # the rest of the issue is dropped
+    while not self._ended:
+      self._offset = self._length
+      self._fill()
+
+class IsolatedNewspaperDownloader(NewspaperDownloader):
+  '''
+  A newspaper downloader running the loader in a process of the pool.
+   An attempt lasting more than "timeout" seconds is aborted.
+  '''
+
+  def __init__(self, senders, newspaper, pool, timeout=60*60, **kwargs):
+    super(IsolatedNewspaperDownloader, self).__init__(senders, newspaper, **kwargs)
+    if pool == None or timeout <= 0:
+      raise ValueError('Invalid argument')
+    self._pool = pool
+    self._timeout = timeout
+
+  def _parallel_issues(self):
+    # the issues are opened at the same time by the plugin process
+    return 1
+
+  def _issues(self, issue_date):
+    deadline = time.time() + self._timeout
+    process = self._pool.acquire()
+    completed = False
+    stream = None
+    try:
+      process.request(self._newspaper.name(), issue_date)
+      while True:
+        message = process.receive(deadline)
+        if message[0] == 'issue':
+          stream = PipeStream(process, deadline)
+          yield RemoteIssue(message[1], message[2], self._newspaper, stream)
+          stream.close()
+          if stream.failed():
+            completed = True
+            return
+        elif message[0] == 'metrics':
+          _record_metrics(message[1])
+        elif message[0] == 'done':
+          completed = True
+          return
+        elif message[0] == 'error':
+          completed = True
+          raise LoaderException(message[1])
+        else:
+          raise LoaderException('Unexpected message %s from the plugin process' % message[0])
+    finally:
+      if stream != None and stream.failed():
+        # the error has been received while reading the issue
+        completed = True
+      if not completed:
+        # the process is not ready for another request
+        process.kill()
+      self._pool.release(process)
@@ -0,0 +1,164 @@
+'''
+Parse the listing pages while they are downloaded: the entries are
+ recognized by a regular expression in the text received so far, so
+ that the issues can be used (and the download stopped) before the
+ end of the page.
+
+  for metadata in nd.listing.iter_matches(page, RE_SEARCH_PDF):
+    ...
+
+The plugins open their listing with iter_page, which times the request
+ and the reads as the listing_fetch phase and the parsing as the
+ listing_parse phase (see nd.metrics). With iter_listing, an unchanged
+ listing costs a "304 Not Modified" and is not parsed again.
+'''
+
+import codecs
+import io
+import re
+import time
+import urllib.error
+
+import nd.metrics
+
+# the size of the reads (small: the entries are parsed as they arrive)
+READ_SIZE = 16*2**10
+
+class ListingParser(object):
+  '''
+  Find the matches of "pattern" in a text given piece by piece. An entry
+   is at most "window" characters long: a match is final once "window"
+   characters follow it (it cannot change with the next pieces), the
+   text before it is dropped.
+  '''
+
+  def __init__(self, pattern, flags=re.DOTALL, window=16*2**10):
+    self._regex = re.compile(pattern, flags) if isinstance(pattern, str) else pattern
+    self._window = window
+    self._buffer = ''
+
+  def feed(self, text):
+    '''
+    Add text and returns the new final matches
+    '''
+    self._buffer += text
+    return self._matches(len(self._buffer) - self._window)
+
+  def close(self):
+    '''
+    The end of the text: returns the last matches
+    '''
+    return self._matches(len(self._buffer))
+
+  def _matches(self, limit):
+    matches = []
+    keep = max(limit, 0)
+    for match in self._regex.finditer(self._buffer):
+      if match.end() > limit:
+        # may change with the next pieces
+        keep = min(keep, match.start())
+        break
+      matches.append(match)
+      keep = max(keep, match.end())
+    self._buffer = self._buffer[keep:]
+    return matches
+
+class ListingTimes(object):
+  '''
+  The time spent reading and parsing a listing, and its size in bytes
+  '''
+
+  def __init__(self):
+    self.fetch = 0.0
+    self.parse = 0.0
+    self.size = 0
+
+def iter_matches(stream, pattern, flags=re.DOTALL, encoding='utf-8', size=READ_SIZE, times=None):
+  '''
+  The group dictionaries of the matches of "pattern" in the page read
+   from "stream" (bytes in "encoding" or text), as they are read. The
+   time spent is added to "times" (a ListingTimes) if it is given.
+  '''
+  times = times or ListingTimes()
+  parser = ListingParser(pattern, flags)
+  decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+  while True:
+    started = time.monotonic()
+    data = stream.read(size)
+    read = time.monotonic()
+    times.fetch += read - started
+    if not data:
+      break
+    times.size += len(data)
+    text = decoder.decode(data) if isinstance(data, bytes) else data
+    matches = parser.feed(text)
+    times.parse += time.monotonic() - read
+    for match in matches:
+      yield match.groupdict()
+
+  started = time.monotonic()
+  parser.feed(decoder.decode(b'', final=True))
+  matches = parser.close()
+  times.parse += time.monotonic() - started
+  for match in matches:
+    yield match.groupdict()
+
+def iter_page(open_page, pattern, flags=re.DOTALL, encoding='utf-8', size=READ_SIZE):
+  '''
+  The matches of "pattern" in the page returned by open_page() (see
+   iter_matches), closed at the end. The phases of the listing are
+   recorded for the current newspaper, even if the iteration stops
+   before the end of the page.
+  '''
+  newspaper = nd.metrics.current_newspaper() or 'unknown'
+  times = ListingTimes()
+  started = time.monotonic()
+  try:
+    try:
+      page = open_page()
+    finally:
+      times.fetch += time.monotonic() - started
+    try:
+      for metadata in iter_matches(page, pattern, flags, encoding, size, times):
+        yield metadata
+    finally:
+      page.close()
+  finally:
+    nd.metrics.REGISTRY.record(nd.metrics.Sample(newspaper, nd.metrics.LISTING_FETCH, times.fetch, times.size))
+    nd.metrics.REGISTRY.record(nd.metrics.Sample(newspaper, nd.metrics.LISTING_PARSE, times.parse, 0))
+
+def iter_listing(listing, open_page, pattern, parse_match, flags=re.DOTALL, encoding='utf-8', size=READ_SIZE):
+  '''
+  The items parse_match(metadata) (None are skipped) of the matches of
+   "pattern" in the page returned by open_page(headers) (see iter_page).
+   The page is requested with the conditional headers of "listing" (a
+   nd.session.ParsedPage): the items of an unchanged page are those
+   kept by "listing" the last time it was read completely.
+  '''
+  headers = listing.conditional_headers()
+  # the page opened, None if it is not modified
+  pages = []
+  def open_listing():
+    try:
+      page = open_page(headers)
+    except urllib.error.HTTPError as e:
+      if e.code != 304 or not headers:
+        raise
+      e.close()
+      pages.append(None)
+      return io.BytesIO()
+    pages.append(page)
+    return page
+
+  items = []
+  for metadata in iter_page(open_listing, pattern, flags, encoding, size):
+    item = parse_match(metadata)
+    if item != None:
+      items.append(item)
+      yield item
+
+  if pages[0] == None:
+    for item in listing.streamed_result():
+      yield item
+  elif hasattr(pages[0], 'info'):
+    listing.streamed(pages[0].info(), items)
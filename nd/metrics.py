@@ -0,0 +1,187 @@
+'''
+Time the phases of the downloads (login, listing, download, senders,
+ thumbnail) to see which newspaper or which phase is the bottleneck.
+
+  with nd.metrics.newspaper('Le Temps'):
+    with nd.metrics.phase('download') as measure:
+      measure.add(len(chunk))
+
+The phases are kept in a registry (the totals and the last samples) and
+ served in the Prometheus text format by a MetricsServer.
+'''
+
+import collections
+import contextlib
+import http.server
+import logging
+import socketserver
+import threading
+import time
+
+# the phases timed by the downloader and the plugins
+LOGIN = 'login'
+LISTING_FETCH = 'listing_fetch'
+LISTING_PARSE = 'listing_parse'
+DOWNLOAD = 'download'
+THUMBNAIL = 'thumbnail'
+
+def sender_phase(sender):
+  return 'sender_%s' % sender.__class__.__name__
+
+Sample = collections.namedtuple('Sample', ('newspaper', 'phase', 'seconds', 'size'))
+
+class Measure(object):
+  '''
+  The bytes processed during a phase
+  '''
+
+  def __init__(self):
+    self.size = 0
+
+  def add(self, size):
+    self.size += size
+
+class Registry(object):
+  '''
+  The totals of every phase by newspaper and the last "window" samples.
+  '''
+
+  def __init__(self, window=1000):
+    self._lock = threading.Lock()
+    self._totals = collections.OrderedDict()
+    self._samples = collections.deque(maxlen=window)
+    self._pending = collections.deque(maxlen=window)
+
+  def record(self, sample):
+    with self._lock:
+      key = (sample.newspaper, sample.phase)
+      count, seconds, size = self._totals.get(key, (0, 0, 0))
+      self._totals[key] = (count + 1, seconds + sample.seconds, size + sample.size)
+      self._samples.append(sample)
+      self._pending.append(sample)
+
+  def samples(self):
+    with self._lock:
+      return list(self._samples)
+
+  def drain(self):
+    '''
+    The samples recorded since the last call (sent by the plugin
+     processes to the downloader, see nd.isolation)
+    '''
+    with self._lock:
+      pending = list(self._pending)
+      self._pending.clear()
+      return pending
+
+  def prometheus(self):
+    '''
+    The metrics in the Prometheus text format
+    '''
+    with self._lock:
+      totals = list(self._totals.items())
+      samples = list(self._samples)
+
+    # the throughput of the recent samples
+    recent = collections.OrderedDict()
+    for sample in samples:
+      seconds, size = recent.get((sample.newspaper, sample.phase), (0, 0))
+      recent[(sample.newspaper, sample.phase)] = (seconds + sample.seconds, size + sample.size)
+
+    lines = []
+    def metric(name, kind, help, values):
+      lines.append('# HELP %s %s' % (name, help))
+      lines.append('# TYPE %s %s' % (name, kind))
+      for (newspaper, phase), value in values:
+        lines.append('%s{newspaper="%s",phase="%s"} %s' % (name, _escape(newspaper), _escape(phase), value))
+
+    metric('nd_phase_runs_total', 'counter', 'The number of runs of the phase',
+           [(key, count) for key, (count, seconds, size) in totals])
+    metric('nd_phase_seconds_total', 'counter', 'The time spent in the phase',
+           [(key, '%.6f' % seconds) for key, (count, seconds, size) in totals])
+    metric('nd_phase_bytes_total', 'counter', 'The bytes processed by the phase',
+           [(key, size) for key, (count, seconds, size) in totals])
+    metric('nd_phase_throughput_bytes', 'gauge', 'The bytes per second of the recent runs',
+           [(key, '%.1f' % (size / seconds)) for key, (seconds, size) in recent.items() if seconds > 0])
+    return '\n'.join(lines) + '\n'
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# the registry of the process
+REGISTRY = Registry()
+
+_current = threading.local()
+
+def current_newspaper():
+  return getattr(_current, 'newspaper', None)
+
+@contextlib.contextmanager
+def newspaper(name):
+  '''
+  The phases of the thread belong to the newspaper "name"
+  '''
+  previous = current_newspaper()
+  _current.newspaper = name
+  try:
+    yield
+  finally:
+    _current.newspaper = previous
+
+@contextlib.contextmanager
+def phase(name, newspaper=None, registry=None):
+  '''
+  Time the block as the phase "name" of the newspaper (the current
+   newspaper of the thread by default). The block adds the bytes it
+   processes to the measure it receives.
+  '''
+  registry = registry or REGISTRY
+  newspaper = newspaper or current_newspaper() or 'unknown'
+  measure = Measure()
+  start = time.monotonic()
+  try:
+    yield measure
+  finally:
+    registry.record(Sample(newspaper, name, time.monotonic() - start, measure.size))
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+  def log_message(self, *args):
+    pass
+
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    content = self.server.registry.prometheus().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  '''
+  Serve the metrics of the registry on http://<address>/metrics
+  '''
+
+  daemon_threads = True
+
+  def __init__(self, address, registry=REGISTRY):
+    http.server.HTTPServer.__init__(self, address, _MetricsHandler)
+    self.registry = registry
+
+  def start(self):
+    '''
+    Serve the metrics in a background thread.
+    '''
+    thread = threading.Thread(target=self.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+
+    logger = logging.getLogger(__name__)
+    logger.info('Metrics served on http://%s:%d/metrics', *self.server_address[:2])
+
+  def close(self):
+    self.shutdown()
+    self.server_close()
@@ -1,5 +1,9 @@
 
 import datetime
+import inspect
+
+# the size of the buffers used to copy the issues
+CHUNK_SIZE = 256 * 2**10
 
 class NewspaperLoader(object):
   '''
@@ -18,6 +22,20 @@ class NewspaperLoader(object):
     '''
     raise NotImplementedError()
 
+  def host(self):
+    '''
+    The website from which the newspaper is downloaded (the
+     downloads on the same website are limited together)
+    '''
+    return self.name()
+
+  def parallel_issues(self):
+    '''
+    The number of issues of a same date (several editions) that can
+     be downloaded at the same time
+    '''
+    return 1
+
   def init(self):
     '''
     Initialize the newspaper loader (for example: login on the website)
@@ -30,6 +48,22 @@ class NewspaperLoader(object):
     '''
     raise NotImplementedError()
 
+  def issues_for(self, issue_date):
+    '''
+    The issues published on issue_date, found without the listing (for
+     example with URLs built from the date), or None if the loader
+     cannot find them this way (see iter_issues and issues)
+    '''
+    return None
+
+  def iter_issues(self):
+    '''
+    The issues at our disposal, yielded while the listing is read (the
+     issues of a date are listed together), or None if the loader
+     only lists them at once (see issues)
+    '''
+    return None
+
 class NewspaperIssue(object):
   '''
   A newspaper issue (can be daily, monthly, ...)
@@ -87,12 +121,33 @@ class NewspaperStream(object):
   A stream to download a newspaper
   '''
 
-  def read(self):
+  def read(self, size=None):
     '''
-    Read the stream or None if its end has been reached
+    Read at most "size" bytes from the stream (the rest of the stream
+     if it is None) or None if its end has been reached. The streams
+     of the old plugins define read(self) without a size.
     '''
     raise NotImplementedError()
 
+  def readinto(self, buffer):
+    '''
+    Read the stream into "buffer" (a writable memoryview) and returns
+     the number of bytes read (0 at the end of the stream). The default
+     implementation uses read(), the streams should override it to
+     avoid a copy.
+    '''
+    data = _read(self, len(buffer))
+    if not data:
+      return 0
+    buffer[:len(data)] = data
+    return len(data)
+
+  def chunks(self, size=CHUNK_SIZE):
+    '''
+    Iterate over the content of the stream (see chunks)
+    '''
+    return chunks(self, size)
+
   def close(self):
     '''
     Close and cleanup the stream (close the files?)
@@ -106,3 +161,82 @@ class LoaderException(Exception):
   def __init__(self, msg):
     super(LoaderException, self).__init__(msg)
 
+class DuplicateContentException(IOError):
+  '''
+  The stream was aborted because its content is already stored
+   (see nd.newspaper_loader.StreamTee)
+  '''
+  pass
+
+def _takes_size(read):
+  '''
+  Whether the method read accepts a size
+  '''
+  try:
+    parameters = inspect.signature(read).parameters.values()
+  except (TypeError, ValueError):
+    # no signature available (a builtin stream)
+    return True
+  return any(p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD, p.VAR_POSITIONAL) for p in parameters)
+
+def _read(stream, size):
+  '''
+  Read at most "size" bytes from "stream". The streams whose read()
+   doesn't take a size (the old plugins) are read with read() and the
+   rest of what it returns is kept for the next calls.
+  '''
+  rest = getattr(stream, '_unread', None)
+  if rest == None:
+    if _takes_size(stream.read):
+      return stream.read(size)
+    rest = stream.read()
+    if not rest:
+      return rest
+  stream._unread = rest[size:] or None
+  return rest[:size]
+
+def readinto(stream, buffer):
+  '''
+  Read "stream" into "buffer" (a writable memoryview) with readinto()
+   when the stream provides it or read() otherwise. Returns the number
+   of bytes read (0 at the end of the stream).
+  '''
+  if hasattr(stream, 'readinto'):
+    return stream.readinto(buffer) or 0
+  data = _read(stream, len(buffer))
+  if not data:
+    return 0
+  buffer[:len(data)] = data
+  return len(data)
+
+def chunks(stream, size=CHUNK_SIZE):
+  '''
+  Iterate over the content of "stream" by chunks of at most "size"
+   bytes. The chunks are memoryviews on a single buffer: a chunk is
+   overwritten by the next one. The streams without readinto() (the
+   old plugins, text streams) yield what their read() returns.
+  '''
+  if not hasattr(stream, 'readinto'):
+    while True:
+      data = _read(stream, size)
+      if not data:
+        return
+      yield data
+
+  view = memoryview(bytearray(size))
+  while True:
+    length = stream.readinto(view) or 0
+    if not length:
+      return
+    yield view[:length]
+
+def copy_stream(source, destination, size=CHUNK_SIZE):
+  '''
+  Copy the stream "source" into the file "destination" through
+   a preallocated buffer. Returns the number of bytes copied.
+  '''
+  total = 0
+  for chunk in chunks(source, size):
+    destination.write(chunk)
+    total += len(chunk)
+  return total
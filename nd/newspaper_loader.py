@@ -1,94 +1,491 @@
 
 from nd.newspaper_api import NewspaperLoader, NewspaperIssue, NewspaperStream, LoaderException
+from nd.newspaper_api import DuplicateContentException
+from nd.newspaper_api import CHUNK_SIZE, readinto, chunks
 from nd.sender import SenderException
+from nd.db import DBException
+import nd.metrics
 
 import tempfile, os, logging
+import threading
+import collections
+import hashlib
+import concurrent.futures
+
+def dated_issues(newspaper, issue_date):
+  '''
+  The issues of the newspaper published on issue_date. The newspaper
+   finds them directly if it can (see NewspaperLoader.issues_for),
+   otherwise the listing is not read further than these issues if the
+   newspaper lists its issues incrementally (see iter_issues).
+  '''
+  issues = newspaper.issues_for(issue_date)
+  if issues != None:
+    return list(issues)
+
+  issues = newspaper.iter_issues()
+  if issues == None:
+    return [issue for issue in newspaper.issues() if issue.date() == issue_date]
+
+  found = []
+  try:
+    for issue in issues:
+      if issue.date() == issue_date:
+        found.append(issue)
+      elif found:
+        break
+  finally:
+    issues.close()
+  return found
 
 class DocRepository(object):
   def mkstemp(self):
     return tempfile.NamedTemporaryFile()
 
+class _Chunk(object):
+
+  def __init__(self, size):
+    self.view = memoryview(bytearray(size))
+    self.length = 0
+    # the readers that haven't read the chunk yet
+    self.readers = 0
+
+class StreamTee(object):
+  '''
+  Copy a stream to several readers (see TeeReader) in a single pass.
+   The stream is read into "nb_chunks" preallocated buffers that are
+   reused once every reader has read them: a slow reader slows the
+   download.
+
+  The SHA-256 digest of the stream is computed on the way. If
+   known(digest) is true at the end of the stream, the readers are
+   aborted instead of reaching the end (the content is a duplicate).
+  '''
+
+  def __init__(self, nb_readers, chunk_size=CHUNK_SIZE, nb_chunks=16, known=None):
+    self._condition = threading.Condition()
+    self._free = [_Chunk(chunk_size) for i in range(nb_chunks)]
+    self._error = None
+    self._sha256 = hashlib.sha256()
+    self._known = known
+    self.duplicate = False
+    # the bytes read from the stream
+    self.size = 0
+    self.readers = [TeeReader(self) for i in range(nb_readers)]
+
+  def sha256(self):
+    return self._sha256.hexdigest()
+
+  def _open_readers(self):
+    return [reader for reader in self.readers if not reader.closed]
+
+  def fill(self, stream):
+    '''
+    Read the next chunk of the stream and push it to the readers.
+     Returns False at the end of the stream or if no reader is open.
+    '''
+    with self._condition:
+      while not self._free and self._open_readers():
+        self._condition.wait()
+      if not self._open_readers():
+        return False
+      chunk = self._free.pop()
+
+    chunk.length = readinto(stream, chunk.view)
+    self.size += chunk.length
+    self._sha256.update(chunk.view[:chunk.length])
+    if not chunk.length and self._known and self._known(self.sha256()):
+      self.duplicate = True
+      self.abort('the content is already stored')
+      return False
+
+    with self._condition:
+      readers = self._open_readers()
+      chunk.readers = len(readers)
+      for reader in readers:
+        reader._chunks.append(chunk)
+      if not readers:
+        self._free.append(chunk)
+      self._condition.notify_all()
+      return chunk.length > 0 and len(readers) > 0
+
+  def abort(self, error):
+    '''
+    The download failed: the readers raise an IOError once they have
+     read the chunks already pushed (a DuplicateContentException if the
+     content is already stored).
+    '''
+    with self._condition:
+      self._error = error
+      self._condition.notify_all()
+
+  def _release(self, chunk):
+    chunk.readers -= 1
+    if chunk.readers == 0:
+      self._free.append(chunk)
+      self._condition.notify_all()
+
+class TeeReader(object):
+  '''
+  A file-like object given to a sender, reading the chunks of
+   a StreamTee while the issue is being downloaded.
+  '''
+
+  def __init__(self, tee):
+    self._tee = tee
+    self._chunks = collections.deque()
+    self._offset = 0
+    self._ended = False
+    self.closed = False
+
+  def _consume(self, size, buffer=None):
+    '''
+    Consume at most "size" bytes of the current chunk (copied into
+     "buffer" if it is given). Must be called with the tee's lock.
+    '''
+    condition = self._tee._condition
+    while not self._chunks and not self._ended and self._tee._error == None:
+      condition.wait()
+    if self._ended:
+      return b''
+    # the chunks already pushed are read before the abort
+    if not self._chunks:
+      if self._tee.duplicate:
+        raise DuplicateContentException('The content is already stored')
+      raise IOError('The download failed (%s)' % self._tee._error)
+
+    chunk = self._chunks[0]
+    length = min(size, chunk.length - self._offset)
+    data = chunk.view[self._offset:self._offset + length]
+    if buffer != None:
+      buffer[:length] = data
+    else:
+      data = bytes(data)
+    self._offset += length
+
+    if self._offset >= chunk.length:
+      self._ended = chunk.length == 0
+      self._chunks.popleft()
+      self._offset = 0
+      self._tee._release(chunk)
+    return data
+
+  def readinto(self, buffer):
+    with self._tee._condition:
+      return len(self._consume(len(buffer), buffer))
+
+  def sha256(self):
+    '''
+    The SHA-256 digest (hex) of the stream, once its end is reached
+    '''
+    return self._tee.sha256() if self._ended else None
+
+  def read(self, size=-1):
+    with self._tee._condition:
+      if size != None and size >= 0:
+        return self._consume(size)
+      parts = []
+      while not self._ended:
+        parts.append(self._consume(CHUNK_SIZE))
+      return b''.join(parts)
+
+  def close(self):
+    with self._tee._condition:
+      self.closed = True
+      while self._chunks:
+        self._tee._release(self._chunks.popleft())
+      self._offset = 0
+
 class NewspaperDownloader(object):
   '''
   A downloader for a newspaper that send
    the new issues to the given sender.
   '''
-  def __init__(self, senders, newspaper, repository=DocRepository()):
+  def __init__(self, senders, newspaper, repository=None, known_content=None):
     '''
-    Create a new newspaper downloader.
+    Create a new newspaper downloader. The issues are sent to all the
+     senders while they are downloaded, unless a repository is given:
+     they are then saved in a temporary file and sent one sender after
+     the other. The issues for which known_content(sha256) is true are
+     already stored: the senders don't process them.
     '''
-    if senders == None or newspaper == None or repository == None:
+    if senders == None or newspaper == None:
       raise ValueError
     self._senders = senders
     if not isinstance(self._senders, list):
       self._senders = [self._senders]
     self._newspaper = newspaper
     self._repository = repository
+    self._known_content = known_content
 
   def __repr__(self):
     return self._newspaper.name()
 
+  def name(self):
+    return self._newspaper.name()
+
+  def host(self):
+    return self._newspaper.host()
+
   def schedule(self):
     return self._newspaper.schedule()
 
   def wait_evolution(self):
     return self._newspaper.wait_evolution()
 
-  def _save_locally(self, stream):
+  def _save_locally(self, stream, digest, measure):
     '''
     Save the given "stream" in a temporary file and
-     returns the path to this new file.
+     returns the path to this new file. The content is
+     hashed with "digest" and counted by "measure" on the way.
     (this file must be deleted after usage, if possible)
     '''
     file = self._repository.mkstemp()
-    while True:
-      data = stream.read()
-      if not data:
-        break
-      file.write(data)
+    for chunk in chunks(stream):
+      file.write(chunk)
+      digest.update(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+      measure.add(len(chunk))
     stream.close()
     return file
 
+  def _is_known(self, sha256):
+    '''
+    Whether an issue with the same content is already stored
+    '''
+    if self._known_content == None:
+      return False
+    try:
+      return self._known_content(sha256)
+    except DBException:
+      logger = logging.getLogger(__name__)
+      logger.exception('Cannot check whether %s is already stored', sha256)
+      return False
+
+  def _fan_out(self, issue, stream):
+    '''
+    Send the stream to all the senders in a single pass: every sender
+     runs in its own thread and reads the chunks as they are downloaded.
+     Returns the exception raised by every sender (None if it succeeded)
+     or None if the content is already stored.
+    '''
+    tee = StreamTee(len(self._senders), known=self._is_known)
+    readers = tee.readers
+    errors = [None] * len(self._senders)
+    name = self._newspaper.name()
+
+    def upload(i):
+      sender = self._senders[i]
+      try:
+        # the time of a sender includes the download it is waiting for
+        with nd.metrics.newspaper(name), nd.metrics.phase(nd.metrics.sender_phase(sender)) as measure:
+          sender.upload_PDF(issue, readers[i])
+          measure.add(tee.size)
+      except Exception as e:
+        errors[i] = e
+      finally:
+        readers[i].close()
+
+    threads = [threading.Thread(target=upload, args=(i,), name='sender-%d' % i)
+               for i in range(len(self._senders))]
+    for thread in threads:
+      thread.start()
+    try:
+      # stop downloading if no sender reads the stream anymore
+      with nd.metrics.phase(nd.metrics.DOWNLOAD) as measure:
+        while tee.fill(stream):
+          pass
+        measure.add(tee.size)
+    except BaseException as e:
+      tee.abort(e)
+      raise
+    finally:
+      for thread in threads:
+        thread.join()
+      stream.close()
+    return None if tee.duplicate else errors
+
   def get_scheduler(self):
     return self._newspaper.get_scheduler()
 
+  def _issues(self, issue_date):
+    '''
+    The issues published on issue_date (to be opened).
+    '''
+    with nd.metrics.phase(nd.metrics.LOGIN):
+      self._newspaper.init()
+    for issue in dated_issues(self._newspaper, issue_date):
+      yield issue
+
+  def _parallel_issues(self):
+    '''
+    The number of issues of a date downloaded at the same time
+    '''
+    return self._newspaper.parallel_issues() or 1
+
+  def _download_issue(self, issue):
+    '''
+    Download the issue and send it to the senders. Returns False if
+     a critical sender failed.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('New issue found: %s', issue.title())
+    with nd.metrics.newspaper(self._newspaper.name()):
+      return self._send_issue(issue)
+
+  def _send_issue(self, issue):
+    logger = logging.getLogger(__name__)
+
+    file = None
+    try:
+      if self._repository == None:
+        errors = self._fan_out(issue, issue.open())
+      else:
+        digest = hashlib.sha256()
+        with nd.metrics.phase(nd.metrics.DOWNLOAD) as download:
+          file = self._save_locally(issue.open(), digest, download)
+        errors = None
+        if not self._is_known(digest.hexdigest()):
+          errors = []
+          for sender in self._senders:
+            file.seek(0)
+            try:
+              with nd.metrics.phase(nd.metrics.sender_phase(sender)) as measure:
+                sender.upload_PDF(issue, file)
+                measure.add(download.size)
+              errors.append(None)
+            except SenderException as e:
+              errors.append(e)
+    finally:
+      try:
+        if file: file.close()
+      except:
+        logger.exception("Cannot close temporary file %s", file.name)
+
+    if errors == None:
+      logger.info('The content of %s is already stored', issue.title())
+      return True
+
+    success = True
+    for sender, error in zip(self._senders, errors):
+      if isinstance(error, SenderException):
+        logger.error('A sender cannot process the new issue', exc_info=error)
+        if sender.is_critical():
+          success = False
+      elif error != None:
+        raise error
+    return success
+
   def __call__(self, issue_date):
     '''
     Download the newspaper issues at the given date and send it
-     to the sender.
+     to the sender. The issues are downloaded at the same time if
+     the newspaper allows it (see NewspaperLoader.parallel_issues).
     '''
-    file = None
     logger = logging.getLogger(__name__)
     logger.info('Ready to download "%s" on %s',
                 self._newspaper.name(), issue_date)
-    success = True
-    issue_found = False
     try:
-      self._newspaper.init()
-      for issue in self._newspaper.issues():
-        if issue.date() == issue_date:
-          logger.info('New issue found: %s', issue.title())
-          file = self._save_locally(issue.open())
-          issue_found = True
-
-          for sender in self._senders:
-            file.seek(0)
-            try:
-              sender.upload_PDF(issue, file)
-            except SenderException:
-              logger.exception('A sender cannot process the new issue')
-              if sender.is_critical():
-                success = False
-      return success and issue_found
+      with nd.metrics.newspaper(self._newspaper.name()):
+        return self._download(issue_date)
     except (IOError, OSError, LoaderException):
       logger.exception('Error when loading "%s" on %s',
                        self._newspaper.name(), issue_date)
     except Exception:
       logger.exception('Unknown exception when loading "%s"',
                        self._newspaper.name())
+    return all(map(lambda x : not x.is_critical(), self._senders))
+
+  def _download(self, issue_date):
+    parallel = self._parallel_issues()
+    if parallel > 1:
+      issues = list(self._issues(issue_date))
+      with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        results = list(executor.map(self._download_issue, issues))
+    else:
+      results = [self._download_issue(issue) for issue in self._issues(issue_date)]
+    return all(results) and len(results) > 0
+
+class LeasedNewspaperDownloader(object):
+  '''
+  A downloader that claims every issue in a database shared by several
+   nodes before downloading it (see nd.db.DB.acquire_lease), so that
+   an issue is downloaded by a single node. The lease is renewed during
+   the download and taken over by another node if it expires (the
+   nodes' clocks must be synchronized).
+  '''
+
+  def __init__(self, downloader, db, owner, ttl=15*60):
+    if downloader == None or db == None or not owner or ttl <= 0:
+      raise ValueError('Invalid argument')
+    self._downloader = downloader
+    self._db = db
+    self._owner = owner
+    self._ttl = ttl
+    # the issue date of the last call not downloaded by this node
+    self._skipped = None
+
+  def __repr__(self):
+    return repr(self._downloader)
+
+  def name(self):
+    return self._downloader.name()
+
+  def host(self):
+    return self._downloader.host()
+
+  def get_scheduler(self):
+    return self._downloader.get_scheduler()
+
+  def skipped(self, issue_date):
+    '''
+    Whether the last result for "issue_date" doesn't come from a
+     download on this node (the lease is done or held by another node)
+    '''
+    return self._skipped == issue_date
+
+  def _renew(self, lease, stop):
+    logger = logging.getLogger(__name__)
+    while not stop.wait(self._ttl / 3):
+      try:
+        if not self._db.acquire_lease(lease, self._owner, self._ttl):
+          logger.error('The lease %s has been taken over by another node', lease)
+          return
+      except DBException:
+        logger.exception('Cannot renew the lease %s', lease)
+
+  def __call__(self, issue_date):
+    logger = logging.getLogger(__name__)
+    lease = '%s:%s' % (self.name(), issue_date)
+
+    self._skipped = issue_date
+    try:
+      if self._db.lease_done(lease):
+        logger.info('%s already downloaded by another node', lease)
+        return True
+      if not self._db.acquire_lease(lease, self._owner, self._ttl):
+        logger.info('%s is being downloaded by another node', lease)
+        return False
+    except DBException:
+      logger.exception('Cannot acquire the lease %s', lease)
+      return False
+    self._skipped = None
+
+    stop = threading.Event()
+    renewal = threading.Thread(target=self._renew, args=(lease, stop))
+    renewal.daemon = True
+    renewal.start()
+
+    success = False
+    try:
+      success = self._downloader(issue_date)
     finally:
+      stop.set()
+      renewal.join()
       try:
-        if file: file.close()
-      except:
-        logger.exception("Cannot close temporary file %s", file.name)
-    return all(map(lambda x : not x.is_critical(), self._senders))
+        if success:
+          self._db.complete_lease(lease, self._owner)
+        else:
+          self._db.release_lease(lease, self._owner)
+      except DBException:
+        logger.exception('Cannot update the lease %s', lease)
+    return success
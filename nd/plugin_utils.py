@@ -1,27 +1,190 @@
+'''
+Find the plugins to download newspapers.
 
+The plugins are listed in a manifest (nd/plugins/plugins.cfg) or by the
+ entry points "nd.plugins" of the installed packages, as
+ "<newspaper name> = <module>:<loader class>", and only the plugins used
+ are imported. Without them, every module of nd.plugins is imported.
+ The manifest is generated from nd.plugins with:
+
+  > python -m nd.plugin_utils
+'''
 from nd.newspaper_api import NewspaperLoader
 
-import nd.plugins, pkgutil, inspect
+import nd.config
+import nd.plugins, pkgutil, inspect, importlib
 import logging
+import os.path
+
+try:
+  import importlib.metadata as metadata
+except ImportError:
+  metadata = None
+
+MANIFEST = os.path.join(os.path.dirname(nd.plugins.__file__), 'plugins.cfg')
 
-def load_plugins():
+ENTRY_POINTS = 'nd.plugins'
+
+class PluginException(Exception):
+  pass
+
+def loader_classes(module):
+  '''
+  The newspaper loaders of an imported plugin module
+  '''
+  return [obj for name, obj in inspect.getmembers(module)
+          if inspect.isclass(obj) and issubclass(obj, NewspaperLoader) and obj != NewspaperLoader]
+
+def load_plugins(package=nd.plugins):
   '''
   Load all the plugins to download newspapers
   '''
   imported_plugins = []
   logger = logging.getLogger(__name__)
 
-  for importer, modname, ispkg in pkgutil.iter_modules(nd.plugins.__path__):
+  for importer, modname, ispkg in pkgutil.iter_modules(package.__path__):
     try:
-      plugin = __import__('nd.plugins.%s' % modname, fromlist=[modname])
-      foundImporter = False
-      for name, obj in inspect.getmembers(plugin):
-        if inspect.isclass(obj) and issubclass(obj, NewspaperLoader) \
-            and obj != NewspaperLoader:
-          foundImporter = True
-          imported_plugins.append(obj)
-      if not foundImporter:
+      plugin = importlib.import_module('%s.%s' % (package.__name__, modname))
+      found = loader_classes(plugin)
+      imported_plugins.extend(found)
+      if not found:
         logger.warning("No importer found in '%s'", modname)
     except Exception as e:
       logger.exception("Invalid plugin '%s'", modname)
   return imported_plugins
+
+class PluginEntry(object):
+  '''
+  A plugin not imported yet: the loader class "target" (module:class)
+   of the newspaper "name"
+  '''
+
+  def __init__(self, name, target):
+    self.name = name
+    self.target = target
+
+  def load(self):
+    '''
+    Import the module of the plugin and returns its loader class
+    '''
+    modname, separator, classname = self.target.partition(':')
+    if not separator:
+      raise PluginException("Invalid plugin '%s' for %s" % (self.target, self.name))
+    loader_class = importlib.import_module(modname)
+    for attribute in classname.split('.'):
+      loader_class = getattr(loader_class, attribute)
+    if not (inspect.isclass(loader_class) and issubclass(loader_class, NewspaperLoader)):
+      raise PluginException("'%s' isn't a newspaper loader" % self.target)
+    return loader_class
+
+class PluginRegistry(object):
+  '''
+  The plugins available by newspaper name
+  '''
+
+  def __init__(self, entries=()):
+    self._entries = {}
+    for entry in entries:
+      self.add(entry)
+
+  def add(self, entry):
+    # the first plugin found for a newspaper is kept
+    self._entries.setdefault(entry.name, entry)
+
+  def names(self):
+    return sorted(self._entries)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def load(self, names=None):
+    '''
+    Import the plugins of the newspapers "names" (all of them by default)
+     and returns their loader classes. The plugins which cannot be
+     imported are skipped.
+    '''
+    if names == None:
+      names = self.names()
+    unknown = [name for name in names if name not in self._entries]
+    if unknown:
+      raise PluginException("Unknown newspapers: %s" % ', '.join(unknown))
+
+    logger = logging.getLogger(__name__)
+    loader_classes = []
+    for name in names:
+      entry = self._entries[name]
+      try:
+        loader_classes.append(entry.load())
+      except Exception as e:
+        logger.exception("Invalid plugin '%s' for %s", entry.target, name)
+    return loader_classes
+
+def read_manifest(path=MANIFEST):
+  '''
+  The plugins listed in the manifest (none if it doesn't exist)
+  '''
+  if not os.path.exists(path):
+    return []
+  manifest = nd.config.Configuration()
+  with open(path) as manifest_file:
+    manifest.load(manifest_file)
+  return [PluginEntry(name, target) for name, target in manifest.items()]
+
+def listed_modules(path=MANIFEST):
+  '''
+  The names of the modules listed in the manifest (empty if it doesn't
+   exist: every module is used)
+  '''
+  return set(entry.target.partition(':')[0] for entry in read_manifest(path))
+
+def entry_points(group=ENTRY_POINTS):
+  '''
+  The plugins declared by the installed packages
+  '''
+  if metadata == None:
+    return []
+  return [PluginEntry(entry_point.name, entry_point.value)
+          for entry_point in metadata.entry_points(group=group)]
+
+def plugin_registry(manifest=MANIFEST, group=ENTRY_POINTS, package=nd.plugins):
+  '''
+  The plugins of the manifest, then those of the entry points
+  '''
+  entries = read_manifest(manifest)
+  if entries:
+    # listed without being imported
+    listed = listed_modules(manifest)
+    logger = logging.getLogger(__name__)
+    for importer, modname, ispkg in pkgutil.iter_modules(package.__path__):
+      if '%s.%s' % (package.__name__, modname) not in listed:
+        logger.warning("Plugin '%s' not in the manifest %s", modname, manifest)
+  return PluginRegistry(entries + entry_points(group))
+
+def write_manifest(path=MANIFEST, package=nd.plugins, config=None):
+  '''
+  List the plugins of "package" in the manifest (they are imported and
+   instantiated with "config" to get their names)
+  '''
+  logger = logging.getLogger(__name__)
+  lines = []
+  for loader_class in load_plugins(package):
+    try:
+      name = loader_class(config or nd.config.Configuration()).name()
+    except Exception as e:
+      logger.exception("Cannot instantiate '%s'", loader_class.__name__)
+      continue
+    lines.append('%s = %s:%s\n' % (name, loader_class.__module__, loader_class.__qualname__))
+
+  with open(path, 'w') as manifest:
+    manifest.write('# <newspaper name> = <module>:<loader class>\n')
+    manifest.writelines(sorted(lines))
+  return len(lines)
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description='List the plugins of nd.plugins in the manifest')
+  parser.add_argument("-o", "--output", type=str, default=MANIFEST, help="The manifest")
+  options = parser.parse_args()
+
+  logging.basicConfig()
+  print('%d plugins listed in %s' % (write_manifest(options.output), options.output))
@@ -0,0 +1,145 @@
+'''
+Limit the requests and the bandwidth used on every website, so that
+ the concurrent downloads don't hammer a website at the scheduled hour.
+
+The limits are token buckets configured by website:
+
+  nd.ratelimit.requests=1                      # requests per second
+  nd.ratelimit.bandwidth=500000                # bytes per second
+  nd.ratelimit.epaper.tamedia.ch.requests=0.5  # for one website
+
+The buckets live in shared memory: the plugin processes forked after
+ their creation (see nd.isolation) share them.
+'''
+
+import logging
+import multiprocessing
+import threading
+import time
+
+import nd.config
+
+PREFIX = 'nd.ratelimit.'
+
+class TokenBucket(object):
+  '''
+  "rate" tokens per second, at most "burst" of them saved in advance.
+   A consumer may take more tokens than available: the next consumers
+   wait until the debt is paid.
+  '''
+
+  def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+    if rate <= 0 or (burst != None and burst <= 0):
+      raise ValueError('Invalid rate')
+    self._rate = float(rate)
+    self._burst = float(burst if burst != None else max(rate, 1))
+    self._clock = clock
+    self._sleep = sleep
+    context = multiprocessing.get_context('fork')
+    self._lock = context.Lock()
+    # the tokens available and the time they were counted
+    self._state = context.RawArray('d', [self._burst, clock()])
+
+  def reserve(self, amount=1):
+    '''
+    Take "amount" tokens and returns the time to wait (in seconds)
+     before using them.
+    '''
+    with self._lock:
+      now = self._clock()
+      tokens, counted = self._state
+      tokens = min(self._burst, tokens + max(0, now - counted) * self._rate) - amount
+      self._state[0], self._state[1] = tokens, now
+    return max(0, -tokens / self._rate)
+
+  def acquire(self, amount=1):
+    '''
+    Take "amount" tokens, waiting until they are available.
+    '''
+    delay = self.reserve(amount)
+    if delay > 0:
+      self._sleep(delay)
+    return delay
+
+class HostLimit(object):
+  '''
+  The limits of a website: requests per second and bytes per second
+   (None for no limit).
+  '''
+
+  def __init__(self, requests=None, bandwidth=None, **kwargs):
+    self._requests = TokenBucket(requests, **kwargs) if requests else None
+    self._bandwidth = TokenBucket(bandwidth, **kwargs) if bandwidth else None
+
+  def request(self):
+    '''
+    Wait before sending a request
+    '''
+    if self._requests:
+      self._requests.acquire()
+
+  def transferred(self, size):
+    '''
+    "size" bytes were received: wait if the bandwidth is exceeded
+    '''
+    if self._bandwidth and size:
+      self._bandwidth.acquire(size)
+
+class RateLimits(object):
+  '''
+  The limits by website (host name). The other websites (those of the
+   plugins loaded later, the login pages) get the default limits on
+   their first request.
+  '''
+
+  def __init__(self, limits=None, requests=None, bandwidth=None):
+    self._limits = dict(limits or {})
+    self._default = (requests, bandwidth)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._limits)
+
+  def get(self, host):
+    with self._lock:
+      if host not in self._limits and any(self._default):
+        # only shared with the processes forked from now on
+        logger = logging.getLogger(__name__)
+        logger.info('Default limits for %s', host)
+        self._limits[host] = HostLimit(*self._default)
+      return self._limits.get(host)
+
+def _rate(config, name):
+  value = config.get(name)
+  try:
+    rate = float(value) if value else None
+  except ValueError:
+    raise nd.config.ConfigurationException('Invalid value %s for %s' % (value, name))
+  if rate != None and rate < 0:
+    raise nd.config.ConfigurationException('Invalid value %s for %s' % (value, name))
+  return rate
+
+def rate_limits(config, hosts=()):
+  '''
+  The limits configured for the websites named in the configuration
+   and for "hosts" (the websites of the plugins), which have the
+   default limits unless they have their own, like any other website.
+  '''
+  hosts = set(hosts)
+  for name, value in config.items(PREFIX):
+    host, _, kind = name[len(PREFIX):].rpartition('.')
+    if host and kind in ('requests', 'bandwidth'):
+      hosts.add(host)
+
+  default = (_rate(config, PREFIX + 'requests'), _rate(config, PREFIX + 'bandwidth'))
+  limits = {}
+  for host in hosts:
+    requests = _rate(config, '%s%s.requests' % (PREFIX, host))
+    bandwidth = _rate(config, '%s%s.bandwidth' % (PREFIX, host))
+    requests = requests if requests != None else default[0]
+    bandwidth = bandwidth if bandwidth != None else default[1]
+    if requests or bandwidth:
+      logger = logging.getLogger(__name__)
+      logger.info('Limits for %s: %s requests/s, %s bytes/s', host, requests or '-', bandwidth or '-')
+      limits[host] = HostLimit(requests, bandwidth)
+  return RateLimits(limits, *default)
@@ -0,0 +1,156 @@
+'''
+Reload the plugins modified while the downloader is running. A
+ PluginWatcher polls the modification times of the modules of nd.plugins
+ and posts a PluginReload to the download engine (see nd.scheduler),
+ which imports the modules again and replaces their newspapers between
+ two attempts:
+
+  watcher = nd.reload.PluginWatcher(engine, create_downloader)
+  watcher.start()
+
+The modules are imported as new modules: the downloads in progress
+ finish with the previous code. A module that cannot be imported is
+ logged and its newspapers keep the previous code. The newspapers of
+ the deleted modules are kept until the downloader is restarted.
+'''
+
+import importlib
+import logging
+import os
+import os.path
+import sys
+import threading
+
+import nd.plugins
+import nd.plugin_utils
+
+def import_again(modname):
+  '''
+  Import the module "modname" as a new module (the previous one is kept
+   if it cannot be imported)
+  '''
+  importlib.invalidate_caches()
+  previous = sys.modules.pop(modname, None)
+  try:
+    return importlib.import_module(modname)
+  except Exception:
+    if previous is not None:
+      sys.modules[modname] = previous
+    raise
+
+class PluginReload(object):
+  '''
+  An event of the download engine: import the modules "modnames" again
+   and replace the newspapers they contain by the downloaders
+   create_downloader(loader_class) (ignored when it returns None).
+  '''
+
+  def __init__(self, modnames, create_downloader):
+    self._modnames = tuple(modnames)
+    self._create_downloader = create_downloader
+
+  def modnames(self):
+    return self._modnames
+
+  def execute(self, engine):
+    logger = logging.getLogger(__name__)
+    for modname in self._modnames:
+      try:
+        module = import_again(modname)
+      except Exception:
+        logger.exception("Cannot reload the plugin '%s'", modname)
+        continue
+
+      loader_classes = [x for x in nd.plugin_utils.loader_classes(module) if x.__module__ == modname]
+      if not loader_classes:
+        logger.warning("No importer found in '%s'", modname)
+      for loader_class in loader_classes:
+        try:
+          downloader = self._create_downloader(loader_class)
+        except Exception:
+          logger.exception("Cannot create the newspaper loader '%s'", loader_class.__name__)
+          continue
+        if downloader is not None:
+          engine.replace(downloader)
+
+class PluginWatcher(object):
+  '''
+  Check the modules of "package" every "interval" seconds and post a
+   PluginReload to the engine when some of them are added or modified.
+   Only the modules listed in the manifest are checked, if it exists
+   (see nd.plugin_utils.plugin_registry).
+  '''
+
+  def __init__(self, engine, create_downloader, package=nd.plugins, interval=10,
+               manifest=nd.plugin_utils.MANIFEST):
+    if interval <= 0:
+      raise ValueError('Invalid interval')
+    self._engine = engine
+    self._create_downloader = create_downloader
+    self._package = package
+    self._interval = interval
+    self._manifest = manifest
+    self._stop = threading.Event()
+    self._thread = None
+    # the modules already imported
+    self._mtimes = self._modules()
+
+  def _modules(self):
+    '''
+    The modification time and the size of the modules by name
+    '''
+    # read again: a module added to the manifest is loaded
+    listed = nd.plugin_utils.listed_modules(self._manifest)
+    modules = {}
+    for directory in self._package.__path__:
+      try:
+        entries = list(os.scandir(directory))
+      except OSError:
+        continue
+      for entry in entries:
+        name, extension = os.path.splitext(entry.name)
+        if extension != '.py' or name.startswith('_') or not entry.is_file():
+          continue
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue
+        modname = '%s.%s' % (self._package.__name__, name)
+        if not listed or modname in listed:
+          modules[modname] = (stat.st_mtime_ns, stat.st_size)
+    return modules
+
+  def check(self):
+    '''
+    Post a PluginReload for the modules changed since the last check
+     and returns their names
+    '''
+    mtimes = self._modules()
+    changed = sorted(modname for modname, mtime in mtimes.items() if self._mtimes.get(modname) != mtime)
+    self._mtimes = mtimes
+    if changed:
+      logger = logging.getLogger(__name__)
+      logger.info('Reload the plugins %s', ', '.join(changed))
+      self._engine.post(PluginReload(changed, self._create_downloader))
+    return changed
+
+  def _run(self):
+    while not self._stop.wait(self._interval):
+      try:
+        self.check()
+      except Exception:
+        logger = logging.getLogger(__name__)
+        logger.exception('Cannot check the plugins')
+
+  def start(self):
+    '''
+    Check the plugins in a background thread.
+    '''
+    self._thread = threading.Thread(target=self._run, name='plugin-watcher')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def close(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
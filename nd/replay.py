@@ -0,0 +1,210 @@
+'''
+Record the HTTP exchanges of the plugins and replay them offline, to
+ measure the plugins end to end (login, listing, download) without the
+ websites (see benchmarks/plugins_bench.py).
+
+The exchanges are recorded by a RecordingPool (a connection pool of
+ nd.http_client) in an Archive: a ZIP file with an index (exchanges.json)
+ and the bodies. A ReplayServer is an HTTP proxy answering the recorded
+ requests with a configurable latency and bandwidth:
+
+  server = nd.replay.ReplayServer(nd.replay.Archive.load('letemps.zip'), latency=0.05)
+  server.start()
+  os.environ['http_proxy'] = server.url()
+
+Only the http:// websites can be replayed (no tunnel for https).
+'''
+
+import collections
+import http.server
+import io
+import json
+import logging
+import socketserver
+import threading
+import time
+import urllib.response
+import zipfile
+
+import nd.http_client
+import nd.ratelimit
+
+Exchange = collections.namedtuple('Exchange', ('method', 'url', 'status', 'reason', 'headers', 'body'))
+
+# the headers of a connection, not of the recorded response
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-length', 'proxy-connection')
+
+class ReplayException(Exception):
+  pass
+
+class Archive(object):
+  '''
+  The HTTP exchanges recorded for a plugin (and free metadata, like
+   the date of the issues recorded)
+  '''
+
+  def __init__(self, meta=None):
+    self._lock = threading.Lock()
+    self.exchanges = []
+    self.meta = dict(meta or {})
+
+  def add(self, exchange):
+    with self._lock:
+      self.exchanges.append(exchange)
+
+  def responses(self, method, url):
+    '''
+    The exchanges recorded for the request, in order
+    '''
+    return [exchange for exchange in self.exchanges if exchange.method == method and exchange.url == url]
+
+  def save(self, path):
+    with self._lock:
+      exchanges = list(self.exchanges)
+    index = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+      for i, exchange in enumerate(exchanges):
+        name = 'bodies/%d' % i
+        archive.writestr(name, exchange.body)
+        index.append(dict(method=exchange.method, url=exchange.url, status=exchange.status,
+                          reason=exchange.reason, headers=exchange.headers, body=name))
+      archive.writestr('exchanges.json', json.dumps(dict(meta=self.meta, exchanges=index), indent=1))
+
+  @staticmethod
+  def load(path):
+    try:
+      with zipfile.ZipFile(path) as archive:
+        content = json.loads(archive.read('exchanges.json').decode('utf-8'))
+        loaded = Archive(content['meta'])
+        for exchange in content['exchanges']:
+          loaded.add(Exchange(exchange['method'], exchange['url'], exchange['status'], exchange['reason'],
+                              [tuple(header) for header in exchange['headers']],
+                              archive.read(exchange['body'])))
+        return loaded
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile) as e:
+      raise ReplayException('Invalid archive %s (%s)' % (path, e))
+
+class RecordingPool(nd.http_client.ConnectionPool):
+  '''
+  A connection pool recording the exchanges in "archive". The responses
+   are read completely before being returned.
+  '''
+
+  def __init__(self, archive, **kwargs):
+    super(RecordingPool, self).__init__(**kwargs)
+    self._archive = archive
+
+  def open(self, scheme, request):
+    response = super(RecordingPool, self).open(scheme, request)
+    try:
+      body = response.read()
+    finally:
+      response.close()
+    headers = list(response.getheaders())
+    self._archive.add(Exchange(request.get_method(), request.get_full_url(), response.status,
+                               response.reason, headers, body))
+
+    recorded = urllib.response.addinfourl(io.BytesIO(body), response.headers,
+                                          request.get_full_url(), response.status)
+    recorded.msg = response.reason
+    return recorded
+
+class _ReplayHandler(http.server.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def _replay(self):
+    server = self.server
+    length = int(self.headers.get('Content-Length') or 0)
+    if length:
+      self.rfile.read(length)
+
+    # an absolute URL when the server is used as a proxy
+    url = self.path
+    if url.startswith('/'):
+      url = 'http://%s%s' % (self.headers.get('Host'), url)
+    exchange = server.next_exchange(self.command, url)
+    if server.latency:
+      time.sleep(server.latency)
+
+    if exchange == None:
+      self.send_response(404, 'Not recorded')
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+
+    self.send_response(exchange.status, exchange.reason)
+    for name, value in exchange.headers:
+      if name.lower() not in HOP_HEADERS:
+        self.send_header(name, value)
+    self.send_header('Content-Length', str(len(exchange.body)))
+    self.end_headers()
+    if self.command == 'HEAD':
+      return
+
+    body = memoryview(exchange.body)
+    for start in range(0, len(body), server.chunk_size):
+      chunk = body[start:start + server.chunk_size]
+      if server.bandwidth:
+        server.bandwidth.acquire(len(chunk))
+      self.wfile.write(chunk)
+
+  do_GET = _replay
+  do_POST = _replay
+  do_HEAD = _replay
+
+class ReplayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  '''
+  An HTTP proxy answering the requests recorded in "archive" after
+   "latency" seconds, at most "bandwidth" bytes per second (for all
+   the connections). A request recorded several times gets the
+   recorded responses in order (the last one once they are all used).
+  '''
+
+  daemon_threads = True
+
+  def __init__(self, archive, address=('127.0.0.1', 0), latency=0, bandwidth=None, chunk_size=16*2**10):
+    http.server.HTTPServer.__init__(self, address, _ReplayHandler)
+    self.archive = archive
+    self.latency = latency
+    self.bandwidth = nd.ratelimit.TokenBucket(bandwidth) if bandwidth else None
+    self.chunk_size = chunk_size
+    self._lock = threading.Lock()
+    self._replayed = collections.Counter()
+
+  def replay(self, archive):
+    '''
+    Replay another archive from the start
+    '''
+    with self._lock:
+      self.archive = archive
+      self._replayed.clear()
+
+  def next_exchange(self, method, url):
+    responses = self.archive.responses(method, url)
+    if not responses:
+      logger = logging.getLogger(__name__)
+      logger.warning('No response recorded for %s %s', method, url)
+      return None
+    with self._lock:
+      index = self._replayed[(method, url)]
+      self._replayed[(method, url)] += 1
+    return responses[min(index, len(responses) - 1)]
+
+  def url(self):
+    return 'http://%s:%d' % self.server_address[:2]
+
+  def start(self):
+    '''
+    Serve the requests in a background thread.
+    '''
+    thread = threading.Thread(target=self.serve_forever, name='replay')
+    thread.daemon = True
+    thread.start()
+
+  def close(self):
+    self.shutdown()
+    self.server_close()
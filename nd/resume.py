@@ -0,0 +1,220 @@
+'''
+Resume the downloads of the issues interrupted by a network error.
+
+The bytes received are written to a partial file, next to the
+ validators of the download (ETag, Last-Modified, expected length and
+ digest). The next attempt asks only the missing bytes with a Range
+ request: the server sends them if the issue hasn't changed (If-Range),
+ the whole issue otherwise. The final size and SHA-256 digest are
+ checked before the issue is accepted.
+'''
+
+import base64
+import hashlib
+import json
+import logging
+import os, os.path
+import re
+import urllib.request
+
+from nd.newspaper_api import NewspaperStream, LoaderException, CHUNK_SIZE
+
+RE_CONTENT_RANGE = re.compile(r'bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+|\*)')
+
+class PartialStore(object):
+  '''
+  The partial downloads saved in "directory" (created if needed).
+  '''
+
+  def __init__(self, directory):
+    os.makedirs(directory, exist_ok=True)
+    self._dir = directory
+
+  def _paths(self, key):
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    path = os.path.join(self._dir, name)
+    return path + '.part', path + '.json'
+
+  def load(self, key):
+    '''
+    The validators of the partial download "key" and the number of
+     bytes already received (None if there is no partial download)
+    '''
+    data_path, meta_path = self._paths(key)
+    try:
+      with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+      return meta, os.path.getsize(data_path)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def open(self, key, meta, offset):
+    '''
+    Save the validators and returns the partial file opened to append
+     the bytes following "offset" and the partial file opened to read
+     the first "offset" bytes.
+    '''
+    data_path, meta_path = self._paths(key)
+    with open(meta_path, 'w') as meta_file:
+      json.dump(meta, meta_file)
+    mode = 'r+b' if offset and os.path.exists(data_path) else 'w+b'
+    output = open(data_path, mode)
+    output.truncate(offset)
+    output.seek(offset)
+    return output, open(data_path, 'rb')
+
+  def remove(self, key):
+    for path in self._paths(key):
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+def partial_store(config):
+  '''
+  The store configured with nd.downloader.partial_dir (None if the
+   downloads aren't resumable)
+  '''
+  directory = config.get('nd.downloader.partial_dir')
+  return PartialStore(directory) if directory else None
+
+def _digest(headers):
+  '''
+  The SHA-256 digest announced by the server (hex), if any
+  '''
+  for header in ('Repr-Digest', 'Digest'):
+    for value in (headers.get(header) or '').split(','):
+      algorithm, _, digest = value.strip().partition('=')
+      if algorithm.lower() == 'sha-256':
+        try:
+          return base64.b64decode(digest.strip(':')).hex()
+        except ValueError:
+          pass
+  return None
+
+class ResumableStream(NewspaperStream):
+  '''
+  A stream downloading "url" with "open" (a function opening
+   a urllib.request.Request, see OpenerDirector.open), resuming the
+   partial download "key" of "store" if there is one. The bytes saved
+   are replayed first.
+  '''
+
+  def __init__(self, store, key, url, open):
+    self._store = store
+    self._key = key
+    self._url = url
+    self._open_request = open
+    self._output = None
+    self._replay = None
+    self._response = None
+    self._finished = False
+    self._open()
+
+  def _request(self, partial):
+    # the offsets are those of the raw content (not compressed)
+    request = urllib.request.Request(self._url, headers={'Accept-Encoding': 'identity'})
+    if partial:
+      meta, offset = partial
+      validator = meta.get('etag') or meta.get('last_modified')
+      if offset > 0 and validator:
+        request.add_header('Range', 'bytes=%d-' % offset)
+        request.add_header('If-Range', validator)
+    return self._open_request(request)
+
+  def _open(self):
+    logger = logging.getLogger(__name__)
+    partial = self._store.load(self._key)
+    try:
+      response = self._request(partial)
+    except urllib.request.HTTPError as e:
+      if e.code != 416 or not partial:
+        raise
+      # the partial download is longer than the issue
+      self._store.remove(self._key)
+      partial = None
+      response = self._request(None)
+
+    headers = response.info()
+    meta = {
+      'etag': headers.get('ETag'),
+      'last_modified': headers.get('Last-Modified'),
+      'length': None,
+      'sha256': _digest(headers)
+    }
+    offset = 0
+    match = RE_CONTENT_RANGE.match(headers.get('Content-Range') or '')
+    if response.getcode() == 206 and match and partial and int(match.group('start')) == partial[1]:
+      offset = partial[1]
+      if match.group('total') != '*':
+        meta['length'] = int(match.group('total'))
+      # the server may only announce the digest with the first response
+      meta['sha256'] = meta['sha256'] or partial[0].get('sha256')
+      logger.info('Resume the download of %s at %d bytes', self._key, offset)
+    elif response.getcode() == 206:
+      response.close()
+      self._store.remove(self._key)
+      raise LoaderException('Unexpected range "%s" for %s' % (headers.get('Content-Range'), self._key))
+    elif headers.get('Content-Length'):
+      meta['length'] = int(headers.get('Content-Length'))
+
+    self._response = response
+    self._length = meta['length']
+    self._sha256 = meta['sha256']
+    self._offset = offset
+    self._replayed = 0
+    self._hash = hashlib.sha256()
+    self._output, self._replay = self._store.open(self._key, meta, offset)
+
+  def readinto(self, buffer):
+    if self._finished:
+      return 0
+
+    if self._replayed < self._offset:
+      view = buffer[:min(len(buffer), self._offset - self._replayed)]
+      length = self._replay.readinto(view)
+      if not length:
+        raise LoaderException('The partial download of %s is truncated' % self._key)
+      self._replayed += length
+    else:
+      try:
+        length = self._response.readinto(buffer)
+      except Exception as e:
+        # what has been received is kept to be resumed
+        self._output.flush()
+        raise LoaderException('Error when downloading %s (%s)' % (self._key, e))
+      if not length:
+        self._finish()
+        return 0
+      self._output.write(buffer[:length])
+
+    self._hash.update(buffer[:length])
+    return length
+
+  def read(self, size=CHUNK_SIZE):
+    buffer = bytearray(size)
+    length = self.readinto(memoryview(buffer))
+    return bytes(buffer[:length])
+
+  def _finish(self):
+    self._output.flush()
+    total = self._output.tell()
+    if self._length != None and total < self._length:
+      raise LoaderException('The download of %s was interrupted at %d/%d bytes' % \
+                            (self._key, total, self._length))
+
+    self._finished = True
+    self.close()
+    self._store.remove(self._key)
+    if self._length != None and total != self._length:
+      raise LoaderException('Invalid size for %s (%d bytes instead of %d)' % \
+                            (self._key, total, self._length))
+    if self._sha256 and self._hash.hexdigest() != self._sha256:
+      raise LoaderException('Invalid SHA-256 digest for %s' % self._key)
+
+  def close(self):
+    for stream in (self._response, self._output, self._replay):
+      try:
+        if stream: stream.close()
+      except (IOError, OSError):
+        pass
@@ -5,6 +5,9 @@ import datetime
 from datetime import date, timedelta
 
 import itertools, logging
+import nd.db
+import queue, heapq, collections
+import concurrent.futures
 
 class NewspaperSchedule(object):
   '''
@@ -74,6 +77,15 @@ class Time(object):
     return datetime.datetime.now()
   def sleep(self, wait_time):
     time.sleep(wait_time)
+  def wait(self, events, wait_time=None):
+    '''
+    Wait for the next event in the queue "events" (at most wait_time
+     seconds, forever if None). Returns None if no event arrived.
+    '''
+    try:
+      return events.get(timeout=wait_time)
+    except queue.Empty:
+      return None
 
 class NewspaperDownloadScheduler(object):
 
@@ -108,11 +120,41 @@ class NewspaperDownloadScheduler(object):
     '''
     raise NotImplementedError
 
+  def state(self):
+    '''
+    The state to persist to resume the scheduler after a restart: the
+     next issue date, the number of failed attempts for this issue and
+     the date of the last issue downloaded (or None).
+    '''
+    raise NotImplementedError
+
+  def restore(self, next_date, retry_step=0, last_success=None):
+    '''
+    Resume the scheduler from a state returned by state().
+    '''
+    raise NotImplementedError
+
+  def start(self, today):
+    '''
+    Start from the first issue date from "today" (when there is no
+     state to restore).
+    '''
+    raise NotImplementedError
+
+  def catch_up(self, today):
+    '''
+    Returns the issue dates that should have been downloaded before
+     "today" and move the scheduler to the first issue date from today.
+    '''
+    raise NotImplementedError
+
 class SimpleNewspaperDownloadScheduler(object):
 
   def __init__(self, newspaper_schedule, wait_evolution, time=Time()):
 
     self._next_download_date = time.today()
+    self._last_success = None
+    self._base_wait_evolution = None
 
     self._newspaper_schedule = newspaper_schedule
     self._wait_evolution = wait_evolution
@@ -122,6 +164,7 @@ class SimpleNewspaperDownloadScheduler(object):
   def _next_try(self):
     try:
       self._current_wait_time += next(self._current_wait_evolution)
+      self._retry_step += 1
 
       next_download_date = self._newspaper_schedule.next_day(self._next_download_date)
       if self.wait_until().date() >= next_download_date:
@@ -135,10 +178,15 @@ class SimpleNewspaperDownloadScheduler(object):
 
   def _reinit_try(self):
     self._next_download_date = self._newspaper_schedule.next_day(self._next_download_date)
+    self._reset_wait()
+
+  def _reset_wait(self):
     self._current_wait_evolution, self._wait_evolution = itertools.tee(self._wait_evolution)
     self._current_wait_time = next(self._current_wait_evolution)
+    self._retry_step = 0
 
   def success(self):
+    self._last_success = self._next_download_date
     self._reinit_try()
 
   def failure(self):
@@ -153,33 +201,563 @@ class SimpleNewspaperDownloadScheduler(object):
   def download_on_date(self):
     return self._next_download_date
 
+  def state(self):
+    return self._next_download_date, self._retry_step, self._last_success
+
+  def restore(self, next_date, retry_step=0, last_success=None):
+    self._next_download_date = next_date
+    self._last_success = last_success
+    self._reset_wait()
+
+    for i in range(retry_step):
+      try:
+        self._current_wait_time += next(self._current_wait_evolution)
+        self._retry_step += 1
+      except StopIteration:
+        break
+
+  def start(self, today):
+    self.restore(self._newspaper_schedule.next_day(today - timedelta(1)))
+
+  def catch_up(self, today):
+    missed = []
+    while self._next_download_date < today:
+      missed.append(self._next_download_date)
+      self._next_download_date = self._newspaper_schedule.next_day(self._next_download_date)
+
+    if missed:
+      self._reset_wait()
+    return missed
+
+  def wait_evolution(self):
+    '''
+    The waiting times (in seconds) between the attempts to download an
+     issue (the first one is counted from the midnight of the issue date)
+    '''
+    wait_evolution, self._wait_evolution = itertools.tee(self._wait_evolution)
+    return list(wait_evolution)
+
+  def adapt(self, publication, lead=0, step=15*60, window=2*60*60):
+    '''
+    Retry every "step" seconds from "lead" seconds before the expected
+     publication time (in seconds after midnight) during "window"
+     seconds, then fall back to the original waiting times.
+    '''
+    if self._base_wait_evolution is None:
+      self._base_wait_evolution = self.wait_evolution()
+
+    first = max(publication - lead, 0)
+    attempts = list(range(int(first), int(first + window) + 1, step))
+    for attempt in itertools.accumulate(self._base_wait_evolution):
+      if attempt > attempts[-1]:
+        attempts.append(attempt)
+
+    self._wait_evolution = [attempts[0]] + [y - x for x, y in zip(attempts, attempts[1:])]
+    if self._retry_step == 0:
+      self._reset_wait()
+
+class PublicationTimeLearner(object):
+  '''
+  Learn when the newspapers publish their issues and make the first
+   attempts around this time, every "step" seconds during "window"
+   seconds (see SimpleNewspaperDownloadScheduler.adapt).
+
+  An issue is published between the last failed attempt and the first
+   successful one. If the first attempt succeeds, we assume that the
+   issue was published during the previous step. The samples (the
+   middle of these intervals, in seconds after the midnight of the
+   issue date) are persisted in the store (see nd.db.DB) if given.
+  '''
+
+  def __init__(self, store=None, history=14, min_samples=3, step=15*60, window=2*60*60):
+    self._store = store
+    self._history = history
+    self._min_samples = min_samples
+    self._step = step
+    self._window = window
+    self._samples = {}
+    self._last_failure = {}
+
+  def samples(self, name):
+    if name not in self._samples:
+      samples = []
+      if self._store is not None:
+        try:
+          samples = self._store.publication_samples(name, self._history)
+        except nd.db.DBException:
+          logger = logging.getLogger(__name__)
+          logger.exception('Cannot load the publication times of %s', name)
+      self._samples[name] = samples
+    return self._samples[name]
+
+  def record(self, name, issue_date, attempt_time, success):
+    '''
+    Record an attempt to download the issue of "issue_date" at
+     "attempt_time".
+    '''
+    midnight = datetime.datetime.combine(issue_date, datetime.time())
+    offset = total_seconds(attempt_time - midnight)
+
+    if not success:
+      self._last_failure[name] = (issue_date, offset)
+      return
+
+    last_failure = self._last_failure.pop(name, None)
+    if last_failure is not None and last_failure[0] == issue_date:
+      offset = (last_failure[1] + offset) / 2
+    else:
+      offset -= self._step / 2
+
+    samples = self.samples(name)
+    samples.insert(0, int(offset))
+    del samples[self._history:]
+
+    if self._store is not None:
+      try:
+        self._store.add_publication_sample(name, issue_date, int(offset))
+      except nd.db.DBException:
+        logger = logging.getLogger(__name__)
+        logger.exception('Cannot save the publication time of %s', name)
+
+  def estimate(self, name):
+    '''
+    The expected publication time of the newspaper (in seconds after
+     midnight) or None if it isn't known yet
+    '''
+    samples = sorted(self.samples(name))
+    if len(samples) < self._min_samples:
+      return None
+    return samples[len(samples) // 2]
+
+  def adapt(self, scheduler, name):
+    '''
+    Make the next attempts of the scheduler around the expected
+     publication time of the newspaper (if it is known).
+    '''
+    publication = self.estimate(name)
+    if publication is not None:
+      scheduler.adapt(publication, step=self._step, window=self._window)
+
 def total_seconds(td):
   return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6
 
-def download(downloaders, time=Time()):
-  scheduler_downloader = list(map(lambda x : (x.get_scheduler(), x), downloaders))
+class TimerQueue(object):
+  '''
+  A priority queue of items sorted by the datetime when they are due.
+   Adding, rescheduling or removing an item doesn't depend on the
+   other items (no scan over the whole queue).
+
+  >>> q = TimerQueue()
+  >>> q.push('b', datetime.datetime(2014, 12, 13))
+  >>> q.push('a', datetime.datetime(2014, 12, 12))
+  >>> q.peek()
+  (datetime.datetime(2014, 12, 12, 0, 0), 'a')
+  >>> q.push('a', datetime.datetime(2014, 12, 14))
+  >>> q.pop()
+  (datetime.datetime(2014, 12, 13, 0, 0), 'b')
+  >>> len(q)
+  1
+  '''
+
+  _REMOVED = object()
+
+  def __init__(self):
+    self._heap = []
+    self._entries = {}
+    self._counter = itertools.count()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, item):
+    return item in self._entries
+
+  def push(self, item, when):
+    '''
+    Add the item (or move it if it is already queued) so that
+     it is due at the datetime "when"
+    '''
+    if item in self._entries:
+      self.remove(item)
+    entry = [when, next(self._counter), item]
+    self._entries[item] = entry
+    heapq.heappush(self._heap, entry)
+
+  def remove(self, item):
+    '''
+    Remove the item from the queue (KeyError if it isn't queued)
+    '''
+    entry = self._entries.pop(item)
+    entry[-1] = self._REMOVED
+
+  def peek(self):
+    '''
+    The first item due and its datetime (None if the queue is empty)
+    '''
+    while self._heap and self._heap[0][-1] is self._REMOVED:
+      heapq.heappop(self._heap)
+    if not self._heap:
+      return None
+    when, _, item = self._heap[0]
+    return when, item
+
+  def pop(self):
+    '''
+    Remove and return the first item due and its datetime
+     (KeyError if the queue is empty)
+    '''
+    first = self.peek()
+    if first is None:
+      raise KeyError('The queue is empty')
+    heapq.heappop(self._heap)
+    del self._entries[first[1]]
+    return first
+
+class DownloadEngine(object):
+  '''
+  Run the newspaper downloaders on a pool of workers. Each downloader
+   is started when its scheduler asks for it, with at most max_workers
+   downloads at the same time and at most max_per_host downloads on
+   the same website.
+  '''
+
+  def __init__(self, downloaders, time=Time(), max_workers=4, max_per_host=1, state_store=None,
+               learner=None):
+    '''
+    Create a new engine. If state_store is given (see nd.db.DB), the
+     schedulers resume from their persisted state and save it after
+     every attempt. If learner is given (see PublicationTimeLearner),
+     the first attempts are made around the expected publication time.
+    '''
+    if not downloaders:
+      raise TypeError('No newspaper to download')
+    if max_workers < 1 or max_per_host < 1:
+      raise ValueError('Invalid number of workers')
+    self._state_store = state_store
+    self._learner = learner
+    self._time = time
+    # the issue dates still to catch up (see catch_up)
+    self._missed = {}
+
+    self._schedulers = []
+    self._timers = TimerQueue()
+    for downloader in downloaders:
+      scheduler = downloader.get_scheduler()
+      self._load_state(scheduler, downloader)
+      self._adapt(scheduler, downloader)
+      self._schedulers.append((scheduler, downloader))
+      self._timers.push((scheduler, downloader), scheduler.wait_until())
+    # the idle downloads waiting for a worker on their website
+    self._parked = {}
+    self._running = {}
+    # the downloaders replacing those in progress (see replace)
+    self._replacements = {}
+    # the downloads completed and the commands received (see nd.control),
+    #  a SimpleQueue can be fed by a signal handler (reentrant put)
+    self._events = queue.SimpleQueue()
+    self._draining = False
+
+    self._max_workers = max_workers
+    self._max_per_host = max_per_host
+
+  def _load_state(self, scheduler, downloader):
+    if self._state_store is None:
+      return
+    logger = logging.getLogger(__name__)
+    try:
+      state = self._state_store.scheduler_state(downloader.name())
+      if state is not None:
+        scheduler.restore(*state)
+        logger.info('Resume %s on %s (attempt %d)', downloader, state[0], state[1]+1)
+      else:
+        # today's issue isn't skipped
+        scheduler.start(self._time.today())
+    except nd.db.DBException:
+      logger.exception('Cannot load the scheduler state of %s', downloader)
+
+  def _save_state(self, scheduler, downloader):
+    if self._state_store is None:
+      return
+    state = scheduler.state()
+    missed = self._missed.get((scheduler, downloader))
+    if missed:
+      # the issues not caught up yet are resumed after a restart
+      state = (missed[0], 0, state[2])
+    try:
+      self._state_store.save_scheduler_state(downloader.name(), *state)
+    except nd.db.DBException:
+      logger = logging.getLogger(__name__)
+      logger.exception('Cannot save the scheduler state of %s', downloader)
+
+  def _adapt(self, scheduler, downloader):
+    if self._learner is not None:
+      self._learner.adapt(scheduler, downloader.name())
+
+  def catch_up(self):
+    '''
+    Download the issues missed while the downloader wasn't running (if
+     they are still available). The downloads are started by run()
+     before the regular ones, within the same limits.
+    '''
+    logger = logging.getLogger(__name__)
+    today = self._time.today()
+
+    for scheduler, downloader in self._schedulers:
+      missed = scheduler.catch_up(today)
+      if missed:
+        logger.info('Catch up %d issues of %s', len(missed), downloader)
+        self._missed[(scheduler, downloader)] = collections.deque(missed)
+        self._save_state(scheduler, downloader)
+      self._timers.push((scheduler, downloader), self._due(scheduler, downloader))
+
+  def _due(self, scheduler, downloader):
+    '''
+    When the next download of scheduler/downloader must start
+    '''
+    if (scheduler, downloader) in self._missed:
+      return self._time.now()
+    return scheduler.wait_until()
 
-  logger = logging.getLogger(__name__)
+  def _running_on(self, host):
+    return len([x for x in self._running.values() if x[1].host() == host])
 
-  while True:
-    if len(scheduler_downloader) == 1:
-      scheduler, downloader = scheduler_downloader[0]
+  def _next_idle(self):
+    '''
+    The datetime and the idle scheduler/downloader that must be started
+     first (None if every website already has too many downloads in
+     progress)
+    '''
+    while True:
+      first = self._timers.peek()
+      if first is None:
+        return None
+
+      when, (scheduler, downloader) = first
+      host = downloader.host()
+      if self._running_on(host) < self._max_per_host:
+        return first
+
+      self._timers.pop()
+      self._parked.setdefault(host, []).append((scheduler, downloader))
+
+  def _start(self, executor, scheduler, downloader):
+    missed = self._missed.get((scheduler, downloader))
+    if missed:
+      current_date = missed.popleft()
+      if not missed:
+        del self._missed[(scheduler, downloader)]
     else:
-      scheduler, downloader = min(*scheduler_downloader, key=lambda x : x[0].wait_until())
+      current_date = scheduler.download_on_date()
+    self._timers.remove((scheduler, downloader))
 
-    wait_time = max(total_seconds(scheduler.wait_until() - time.now()), 0)
+    future = executor.submit(downloader, current_date)
+    self._running[future] = (scheduler, downloader, current_date, missed is not None)
+    future.add_done_callback(self._events.put)
 
-    logger.info("Wait for %d seconds", wait_time)
-    time.sleep(wait_time)
+  def _finish(self, future):
+    scheduler, downloader, current_date, catching_up = self._running.pop(future)
+
+    # the idle downloads on the same website may be started again
+    for parked in self._parked.pop(downloader.host(), []):
+      self._timers.push(parked, self._due(*parked))
 
-    current_date = scheduler.download_on_date()
-    if downloader(current_date):
+    try:
+      if catching_up:
+        self._caught_up(scheduler, downloader, current_date, future.result())
+      else:
+        self._downloaded(scheduler, downloader, current_date, future.result())
+    finally:
+      self._save_state(scheduler, downloader)
+      self._timers.push((scheduler, downloader), self._due(scheduler, downloader))
+
+      if self._replacements and downloader.name() in self._replacements:
+        self._swap(self._replacements.pop(downloader.name()))
+
+  def _downloaded(self, scheduler, downloader, issue_date, success):
+    # the results given by the other nodes don't tell when the issue
+    #  was published (see nd.newspaper_loader.LeasedNewspaperDownloader)
+    skipped = hasattr(downloader, 'skipped') and downloader.skipped(issue_date)
+    if self._learner is not None and not skipped:
+      self._learner.record(downloader.name(), issue_date, self._time.now(), success)
+
+    if success:
       scheduler.success()
+      self._adapt(scheduler, downloader)
     else:
       failure_type = scheduler.failure()
 
       if failure_type == NewspaperDownloadScheduler.NO_MORE_DOWNLOAD:
-        logger.critical('Failed to download %s on %s', downloader, current_date)
+        logger = logging.getLogger(__name__)
+        logger.critical('Failed to download %s on %s', downloader, issue_date)
+
+  def _caught_up(self, scheduler, downloader, issue_date, success):
+    '''
+    The missed issues don't move the scheduler (only the last success)
+    '''
+    if success:
+      next_date, retry_step, last_success = scheduler.state()
+      if last_success is None or last_success < issue_date:
+        scheduler.restore(next_date, retry_step, issue_date)
+    else:
+      logger = logging.getLogger(__name__)
+      logger.error('Failed to catch up %s on %s', downloader, issue_date)
+
+  def _find(self, name):
+    for scheduler, downloader in self._schedulers:
+      if downloader.name() == name:
+        return scheduler, downloader
+    raise KeyError(name)
+
+  def _is_running(self, downloader):
+    return any(x[1] is downloader for x in self._running.values())
+
+  def post(self, command):
+    '''
+    Send a command to the engine (thread-safe, and safe in a signal
+     handler). The command is executed by the engine's thread as soon
+     as possible (see nd.control).
+    '''
+    self._events.put(command)
+
+  def download_now(self, name):
+    '''
+    Try to download the newspaper "name" right now (KeyError if
+     it doesn't exist).
+    '''
+    item = self._find(name)
+    if self._is_running(item[1]):
+      return False
+    for parked in self._parked.values():
+      if item in parked:
+        parked.remove(item)
+    self._timers.push(item, self._time.now())
+    return True
+
+  def reschedule(self, name, issue_date):
+    '''
+    The next issue of the newspaper "name" to download is the one of
+     "issue_date" (KeyError if the newspaper doesn't exist).
+    '''
+    scheduler, downloader = self._find(name)
+    if self._is_running(downloader):
+      return False
+    last_success = scheduler.state()[2]
+    scheduler.restore(issue_date, 0, last_success)
+    self._save_state(scheduler, downloader)
+    if (scheduler, downloader) in self._timers:
+      self._timers.push((scheduler, downloader), self._due(scheduler, downloader))
+    return True
+
+  def replace(self, downloader):
+    '''
+    Download the newspaper with "downloader" from now on, with the state
+     of the downloader it replaces (a new newspaper is added). A
+     newspaper being downloaded is replaced once the attempt is over.
+    '''
+    try:
+      if self._is_running(self._find(downloader.name())[1]):
+        self._replacements[downloader.name()] = downloader
+        return False
+    except KeyError:
+      pass
+    self._swap(downloader)
+    return True
+
+  def _swap(self, downloader):
+    logger = logging.getLogger(__name__)
+    scheduler = downloader.get_scheduler()
+    try:
+      item = self._find(downloader.name())
+    except KeyError:
+      logger.info('Add %s', downloader)
+      self._load_state(scheduler, downloader)
+    else:
+      logger.info('Replace %s', downloader)
+      scheduler.restore(*item[0].state())
+      if item in self._missed:
+        self._missed[(scheduler, downloader)] = self._missed.pop(item)
+      self._schedulers.remove(item)
+      if item in self._timers:
+        self._timers.remove(item)
+      for parked in self._parked.values():
+        if item in parked:
+          parked.remove(item)
+
+    self._adapt(scheduler, downloader)
+    self._schedulers.append((scheduler, downloader))
+    self._timers.push((scheduler, downloader), self._due(scheduler, downloader))
+
+  def drain(self):
+    '''
+    Stop starting new downloads. run() returns once the downloads in
+     progress are over.
+    '''
+    self._draining = True
+
+  def status(self):
+    '''
+    The newspapers with their next issue date and when they will be
+     downloaded (None if they are being downloaded)
+    '''
+    ret = []
+    for scheduler, downloader in self._schedulers:
+      wait_until = None if self._is_running(downloader) else scheduler.wait_until()
+      ret.append((downloader.name(), scheduler.download_on_date(), wait_until))
+    return ret
+
+  def _process(self, event):
+    if isinstance(event, concurrent.futures.Future):
+      self._finish(event)
+    else:
+      event.execute(self)
+
+  def _create_executor(self):
+    '''
+    The executor running the downloads.
+    '''
+    return concurrent.futures.ThreadPoolExecutor(self._max_workers)
+
+  def run(self):
+    logger = logging.getLogger(__name__)
+
+    with self._create_executor() as executor:
+      while not self._draining or self._running:
+        next_idle = None
+        if not self._draining and len(self._running) < self._max_workers:
+          next_idle = self._next_idle()
+
+        if next_idle is None:
+          self._process(self._time.wait(self._events))
+          continue
+
+        wait_until, (scheduler, downloader) = next_idle
+        wait_time = max(total_seconds(wait_until - self._time.now()), 0)
+
+        # a download may end or a command may arrive before the next
+        #  download must start
+        logger.info("Wait for %d seconds", wait_time)
+        event = self._time.wait(self._events, wait_time)
+        if event is not None:
+          self._process(event)
+          continue
+
+        self._start(executor, scheduler, downloader)
+
+    logger.info('All the downloads are over')
+
+def download(downloaders, time=Time(), max_workers=4, max_per_host=1, state_store=None,
+             engine_started=None, learner=None):
+  '''
+  Download the newspapers forever (until the engine is drained).
+   engine_started is called with the engine before it runs (to
+   send it commands from other threads).
+  '''
+  engine = DownloadEngine(downloaders, time, max_workers, max_per_host, state_store, learner)
+  if engine_started is not None:
+    engine_started(engine)
+  if state_store is not None:
+    engine.catch_up()
+  engine.run()
 
 if __name__ == '__main__':
   import doctest
@@ -1,17 +1,23 @@
 
 import smtplib
+import base64
 import email
+import email.mime.base
+import email.mime.multipart
 import email.mime.text
-import shutil
 
 import logging
 
-from nd.newspaper_api import LoaderException
+from nd.newspaper_api import LoaderException, DuplicateContentException, chunks
 
 import sqlite3
 import os, os.path
 import tempfile, subprocess
+import hashlib
+import concurrent.futures
+import threading
 import nd.db
+import nd.metrics
 
 CONVERT_PATH = 'convert'
 
@@ -52,12 +58,28 @@ class GMailSender(Sender):
         smtp.sendmail(self._LOGIN_GMAIL, [self._mail], msg)
         smtp.quit()
 
+    def _encode(self, stream):
+        '''
+        The content of the stream in base64, encoded chunk by chunk. The
+         encoded attachment is kept in memory: smtplib sends the whole
+         message at once.
+        '''
+        # base64.encodebytes writes lines of 57 bytes
+        lines, rest = [], b''
+        for chunk in chunks(stream):
+            data = rest + (chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            end = len(data) - len(data) % 57
+            lines.append(base64.encodebytes(data[:end]))
+            rest = data[end:]
+        lines.append(base64.encodebytes(rest))
+        return b''.join(lines).decode('ascii')
+
     def upload_PDF(self, newspaperissue, stream):
         filename = newspaperissue.title()
         filename += ' ' + newspaperissue.date().strftime('%d-%m-%y')
         filename += '.pdf'
 
-        emailmsg = email.MIMEMultipart.MIMEMultipart('alternative')
+        emailmsg = email.mime.multipart.MIMEMultipart('alternative')
         emailmsg['Subject'] = filename
         emailmsg['From'] = self._LOGIN_GMAIL
         emailmsg['To'] = self._mail
@@ -66,8 +88,8 @@ class GMailSender(Sender):
 
         filemsg = email.mime.base.MIMEBase('application','application/pdf')
 
-        filemsg.set_payload(stream.read())
-        email.encoders.encode_base64(filemsg)
+        filemsg.set_payload(self._encode(stream))
+        filemsg['Content-Transfer-Encoding'] = 'base64'
         filemsg.add_header('Content-Disposition','attachment;filename=%s' % filename)
         emailmsg.attach(filemsg)
 
@@ -90,7 +112,16 @@ class DirManager(object):
         filename = os.path.basename(path)
         return os.fdopen(handle, "wb"), filename
 
+    def remove_file(self, name):
+        try:
+            os.remove(os.path.join(self._dir, name))
+        except OSError as e:
+            logger = logging.getLogger(__name__)
+            logger.warning('Cannot remove %s (%s)', name, e)
+
     def create_thumbnail(self, base_name, pdf_name):
+        # we cannot use ':' characters with imagemagick (see DBSender.upload_PDF)
+        base_name = base_name.replace(':', '')
         ascii_base_name = base_name.encode('ascii', 'ignore').decode('ascii')
         thumbnail_path = tempfile.mktemp(dir=self._dir, prefix=ascii_base_name, suffix='.png')
 
@@ -105,9 +136,79 @@ class DirManager(object):
         thumbnail_name = os.path.basename(thumbnail_path)
         return thumbnail_name
 
-class DBSender(Sender):
+class ThumbnailPool(object):
+    '''
+    Create the thumbnails of the issues stored in the database on
+     "workers" background threads. The jobs are saved in the database
+     (see nd.db.DB.thumbnail_jobs): those not done when the pool is
+     closed are resumed by the next pool.
+    '''
+
+    def __init__(self, dirmanager, db, workers=1):
+        if dirmanager == None or db == None or workers < 1:
+            raise ValueError('Invalid argument')
+        self._dirmanager = dirmanager
+        self._db = db
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._closed = threading.Event()
+
+    def submit(self, issue_id, title, pdf_name, newspaper=None):
+        '''
+        Create the thumbnail of the issue saved in "pdf_name" (the job
+         must be saved in the database)
+        '''
+        return self._executor.submit(self._create, issue_id, title, pdf_name, newspaper)
+
+    def resume(self):
+        '''
+        Submit the jobs saved in the database and returns their number
+        '''
+        try:
+            jobs = self._db.thumbnail_jobs()
+        except nd.db.DBException as e:
+            logger = logging.getLogger(__name__)
+            logger.error('Cannot resume the thumbnails (%s)', e)
+            return 0
+        for issue_id, title, pdf_name, newspaper in jobs:
+            self.submit(issue_id, title, pdf_name, newspaper)
+        return len(jobs)
+
+    def _create(self, issue_id, title, pdf_name, newspaper):
+        if self._closed.is_set():
+            # resumed by the next pool
+            return None
+        logger = logging.getLogger(__name__)
+        try:
+            with nd.metrics.phase(nd.metrics.THUMBNAIL, newspaper):
+                thumbnail_name = self._dirmanager.create_thumbnail(title, pdf_name)
+            logger.info('Thumbnail created in %s', thumbnail_name)
+        except (IOError, OSError) as e:
+            logger.warning('Exception %s when creating a thumbnail', e)
+            thumbnail_name = None
 
-    def __init__(self, dirmanager, db):
+        try:
+            self._db.complete_thumbnail_job(issue_id, thumbnail_name)
+        except nd.db.DBException as e:
+            logger.error(str(e))
+        return thumbnail_name
+
+    def close(self):
+        '''
+        Wait for the thumbnails being created (the others are left
+         to the next pool)
+        '''
+        self._closed.set()
+        self._executor.shutdown()
+
+class DBSender(Sender):
+    '''
+    Save the issues in the directory of "dirmanager" and in the
+     database, unless an issue with the same content is already stored.
+     The thumbnails are created by "thumbnails" (a ThumbnailPool) after
+     the issue is stored if it is given, before otherwise.
+    '''
+
+    def __init__(self, dirmanager, db, thumbnails=None):
         super(DBSender, self).__init__(True)
 
         if dirmanager == None or db == None:
@@ -115,6 +216,19 @@ class DBSender(Sender):
 
         self._dirmanager = dirmanager
         self._db = db
+        self._thumbnails = thumbnails
+
+    def _copy(self, stream, output):
+        '''
+        Copy the stream into output and returns its SHA-256 digest (hex)
+        '''
+        # the digest may be computed by the downloader (see nd.newspaper_loader.StreamTee)
+        digest = None if hasattr(stream, 'sha256') else hashlib.sha256()
+        for chunk in chunks(stream):
+            output.write(chunk)
+            if digest:
+                digest.update(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        return digest.hexdigest() if digest else stream.sha256()
 
     def upload_PDF(self, newspaperissue, stream):
         try:
@@ -125,18 +239,48 @@ class DBSender(Sender):
             #  http://www.imagemagick.org/discourse-server/viewtopic.php?f=1&t=21314
             title = title.replace(':', '')
             d, path = self._dirmanager.create_file(title)
-
-            shutil.copyfileobj(stream, d)
-            d.close()
+            try:
+                try:
+                    sha256 = self._copy(stream, d)
+                finally:
+                    d.close()
+            except DuplicateContentException:
+                # aborted by the downloader (see nd.newspaper_loader.StreamTee)
+                logger.info('The content of %s is already stored', newspaperissue.title())
+                self._dirmanager.remove_file(path)
+                return
+            except (OSError, IOError):
+                # no partial issue is left if the download fails
+                self._dirmanager.remove_file(path)
+                raise
+
+            # the duplicates are detected before creating the thumbnail
+            if self._db.issue_exists(sha256):
+                logger.info('The content of %s is already stored', newspaperissue.title())
+                self._dirmanager.remove_file(path)
+                return
+
+            if self._thumbnails != None:
+                self._add_issue(newspaperissue, title, path, sha256)
+                return
 
             try:
-                thumbnail_name = self._dirmanager.create_thumbnail(title, path)
+                with nd.metrics.phase(nd.metrics.THUMBNAIL):
+                    thumbnail_name = self._dirmanager.create_thumbnail(title, path)
                 logger.info('Thumbnail created in %s', thumbnail_name)
             except (IOError, OSError) as e:
                 logger.warning('Exception %s when creating a thumbnail', e)
                 thumbnail_name = None
 
-            self._db.add_issue(newspaperissue, path, thumbnail_name)
+            try:
+                self._db.add_issue(newspaperissue, path, thumbnail_name, sha256)
+            except nd.db.DuplicateIssueException:
+                # stored by another download in the meantime
+                logger.info('The content of %s is already stored', newspaperissue.title())
+                self._dirmanager.remove_file(path)
+                if thumbnail_name:
+                    self._dirmanager.remove_file(thumbnail_name)
+                return
 
             logger.info('Newspaper %s saved in the database (path: %s)', \
                         newspaperissue.title(), path)
@@ -145,3 +289,20 @@ class DBSender(Sender):
         except nd.db.DBException as e:
             raise SenderException('Unable to save %s in database' % newspaperissue)
 
+    def _add_issue(self, newspaperissue, title, path, sha256):
+        '''
+        Store the issue now and create its thumbnail in the background
+        '''
+        logger = logging.getLogger(__name__)
+        try:
+            issue_id = self._db.add_issue(newspaperissue, path, None, sha256, thumbnail_job=True)
+        except nd.db.DuplicateIssueException:
+            # stored by another download in the meantime
+            logger.info('The content of %s is already stored', newspaperissue.title())
+            self._dirmanager.remove_file(path)
+            return
+
+        logger.info('Newspaper %s saved in the database (path: %s)', \
+                    newspaperissue.title(), path)
+        self._thumbnails.submit(issue_id, title, path, newspaperissue.loader().name())
+
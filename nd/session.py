@@ -0,0 +1,186 @@
+'''
+Make the frequent attempts cheap for the websites: the logged-in
+ sessions are reused between the attempts and the listing pages are
+ downloaded again only when they have changed.
+
+  session = nd.session.SessionCache()
+  opener = session.get(login)   # see nd.http_client.build_opener
+'''
+
+import io
+import logging
+import threading
+import time
+import urllib.request, urllib.response
+
+import nd.config
+
+class StreamedRequest(urllib.request.Request):
+  '''
+  A request for a page read while it is downloaded (see nd.listing):
+   it isn't cached, the cache would read the whole page first. Its
+   conditional headers are given by the caller (see ParsedPage).
+  '''
+  pass
+
+class ConditionalCacheHandler(urllib.request.BaseHandler):
+  '''
+  Remember the HTML pages with their validators (ETag, Last-Modified)
+   and ask them again with If-None-Match/If-Modified-Since: an unchanged
+   page costs a "304 Not Modified" and is returned from the cache. The
+   streamed requests (see StreamedRequest) are not cached.
+  '''
+
+  # before urllib.request.HTTPErrorProcessor (304 is an error for urllib)
+  handler_order = 900
+
+  def __init__(self, max_pages=16):
+    # shared by the threads of a plugin (see Le24HeuresLoader.issues)
+    self._lock = threading.Lock()
+    self._pages = {}
+    self._max_pages = max_pages
+
+  def http_request(self, request):
+    if isinstance(request, StreamedRequest):
+      return request
+    with self._lock:
+      page = self._pages.get(request.full_url)
+    if page and request.get_method() == 'GET':
+      etag, last_modified, headers, content = page
+      if etag:
+        request.add_unredirected_header('If-None-Match', etag)
+      if last_modified:
+        request.add_unredirected_header('If-Modified-Since', last_modified)
+    return request
+
+  def http_response(self, request, response):
+    if isinstance(request, StreamedRequest):
+      return response
+    url = request.full_url
+    with self._lock:
+      page = self._pages.get(url)
+    if response.getcode() == 304 and page:
+      etag, last_modified, headers, content = page
+      response.close()
+      logger = logging.getLogger(__name__)
+      logger.debug('%s not modified', url)
+      return self._cached(url, headers, content)
+
+    headers = response.info()
+    etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+    content_type = headers.get('Content-Type') or ''
+    if response.getcode() == 200 and request.get_method() == 'GET' and (etag or last_modified) and \
+       content_type.startswith('text/'):
+      content = response.read()
+      response.close()
+      with self._lock:
+        if url not in self._pages and len(self._pages) >= self._max_pages:
+          self._pages.pop(next(iter(self._pages)))
+        self._pages[url] = (etag, last_modified, headers, content)
+      return self._cached(url, headers, content)
+    return response
+
+  def _cached(self, url, headers, content):
+    response = urllib.response.addinfourl(io.BytesIO(content), headers, url, 200)
+    response.msg = 'OK'
+    return response
+
+  https_request = http_request
+  https_response = http_response
+
+class SessionCache(object):
+  '''
+  A logged-in session (an opener) reused during "max_age" seconds or
+   until the website refuses it (see invalidate). The threads sharing
+   the cache wait for a single login.
+  '''
+
+  def __init__(self, max_age=30*60, clock=time.time):
+    self._lock = threading.Lock()
+    self._max_age = max_age
+    self._clock = clock
+    self._opener = None
+    self._created = None
+
+  def get(self, login):
+    '''
+    The cached opener if it is still valid, a new one created by the
+     function "login" otherwise.
+    '''
+    with self._lock:
+      if self._opener != None and self._clock() - self._created < self._max_age:
+        logger = logging.getLogger(__name__)
+        logger.debug('Reuse the session created at %s', time.ctime(self._created))
+        return self._opener
+
+      self._opener = None
+      opener = login()
+      self._opener, self._created = opener, self._clock()
+      return opener
+
+  def invalidate(self):
+    '''
+    The website refused the session (HTTP 401/403): the next attempt
+     logs in again.
+    '''
+    with self._lock:
+      self._opener = None
+
+def session_cache(config):
+  '''
+  A session cache with the maximum age configured with
+   nd.downloader.session_max_age (in seconds, 0 to log in every time)
+  '''
+  value = config.get('nd.downloader.session_max_age')
+  try:
+    return SessionCache(int(value) if value else 30*60)
+  except ValueError:
+    raise nd.config.ConfigurationException('Invalid value %s for nd.downloader.session_max_age' % value)
+
+class ParsedPage(object):
+  '''
+  The result of parsing a page, kept until the page changes (an
+   unchanged listing is not parsed again). The result of a page read
+   while it is downloaded is kept with its validators, once the whole
+   page has been read (see nd.listing.iter_listing).
+  '''
+
+  def __init__(self):
+    self._content = None
+    self._result = None
+    self._validators = None
+    self._streamed = None
+
+  def parse(self, content, parser):
+    if content != self._content:
+      self._result = parser(content)
+      self._content = content
+    return self._result
+
+  def conditional_headers(self):
+    '''
+    The headers requesting the page streamed last time only if it has
+     changed (none if no page was streamed completely)
+    '''
+    headers = {}
+    if self._validators:
+      etag, last_modified = self._validators
+      if etag:
+        headers['If-None-Match'] = etag
+      if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+  def streamed(self, headers, result):
+    '''
+    The page received with "headers" was read completely: keep its
+     result if it has validators (ETag, Last-Modified)
+    '''
+    validators = (headers.get('ETag'), headers.get('Last-Modified'))
+    if any(validators):
+      self._validators, self._streamed = validators, result
+    else:
+      self._validators, self._streamed = None, None
+
+  def streamed_result(self):
+    return self._streamed
@@ -0,0 +1,227 @@
+'''
+Simulate the download engine on a virtual clock to evaluate a retry
+ policy (the "wait_evolution" of the schedulers) without waiting days
+ to see its effect in production.
+
+Hundreds of fake newspapers are published every day (or every week)
+ at a random hour, some issues are never published and some attempts
+ fail because the website is down. The report counts the attempts, the
+ logins and the bytes downloaded with the given policy.
+
+  > python -m nd.simulator --wait 6 12 --newspapers 300 --days 365
+'''
+
+import concurrent.futures
+import datetime
+import logging
+import random
+
+import nd.scheduler
+
+from argparse import ArgumentParser
+
+class SimulationOver(Exception):
+  pass
+
+class VirtualTime(nd.scheduler.Time):
+  '''
+  A clock that only moves when somebody waits on it. It raises
+   SimulationOver when it reaches the end of the simulation.
+  '''
+
+  def __init__(self, start, end):
+    self._now = start
+    self._end = end
+
+  def today(self):
+    return self._now.date()
+
+  def now(self):
+    return self._now
+
+  def sleep(self, wait_time):
+    self._advance(wait_time)
+
+  def wait(self, events, wait_time=None):
+    if not events.empty():
+      return events.get_nowait()
+    if wait_time is None:
+      # nothing can happen anymore (every download is synchronous)
+      raise SimulationOver()
+    self._advance(wait_time)
+    return None
+
+  def _advance(self, wait_time):
+    self._now += datetime.timedelta(seconds=wait_time)
+    if self._now >= self._end:
+      raise SimulationOver()
+
+class SynchronousExecutor(concurrent.futures.Executor):
+  '''
+  Run the downloads immediately on the caller's thread (the virtual
+   clock doesn't move during a download).
+  '''
+
+  def submit(self, fn, *args, **kwargs):
+    future = concurrent.futures.Future()
+    try:
+      future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+class SimulatedEngine(nd.scheduler.DownloadEngine):
+
+  def _create_executor(self):
+    return SynchronousExecutor()
+
+class SimulationReport(object):
+  '''
+  What a retry policy costs on the simulated newspapers.
+  '''
+
+  def __init__(self, newspapers):
+    self.attempts = sum(x.attempts for x in newspapers)
+    self.logins = sum(x.logins for x in newspapers)
+    self.bytes = sum(x.bytes for x in newspapers)
+    self.downloaded = sum(len(x.delays) for x in newspapers)
+    self.missed = sum(x.missed() for x in newspapers)
+    delays = [delay for x in newspapers for delay in x.delays]
+    self.mean_delay = sum(delays, datetime.timedelta()) / len(delays) if delays else None
+
+  def __str__(self):
+    lines = ['Attempts:          %d' % self.attempts,
+             'Logins:            %d' % self.logins,
+             'Downloaded:        %d MB' % (self.bytes // 2**20),
+             'Failed attempts:   %d' % (self.attempts - self.downloaded),
+             'Issues downloaded: %d' % self.downloaded,
+             'Issues missed:     %d' % self.missed,
+             'Mean delay:        %s' % self.mean_delay]
+    return '\n'.join(lines)
+
+class FakeNewspaper(object):
+  '''
+  A newspaper published around "publication_hour" (with a random delay
+   every day). It can be downloaded with an attempt once published,
+   except when the website is down.
+  '''
+
+  def __init__(self, name, schedule, wait_evolution, time, rnd, publication_hour,
+               failure_rate=0.05, missing_rate=0.01,
+               listing_size=100*2**10, issue_size=20*2**20):
+    self._name = name
+    self._schedule = schedule
+    self._wait_evolution = wait_evolution
+    self._time = time
+    self._rnd = rnd
+    self._publication_hour = publication_hour
+    self._failure_rate = failure_rate
+    self._missing_rate = missing_rate
+    self._listing_size = listing_size
+    self._issue_size = issue_size
+    self._publications = {}
+    self._attempted = set()
+
+    self.attempts = 0
+    self.logins = 0
+    self.bytes = 0
+    self.delays = []
+
+  def __repr__(self):
+    return self._name
+
+  def name(self):
+    return self._name
+
+  def host(self):
+    return self._name
+
+  def get_scheduler(self):
+    return nd.scheduler.SimpleNewspaperDownloadScheduler(self._schedule, self._wait_evolution, self._time)
+
+  def publication(self, issue_date):
+    '''
+    When the issue is published (None if it is never published)
+    '''
+    if issue_date not in self._publications:
+      publication = None
+      if self._rnd.random() >= self._missing_rate:
+        delay = max(self._rnd.gauss(self._publication_hour, 0.5), 0)
+        publication = datetime.datetime.combine(issue_date, datetime.time()) + \
+                        datetime.timedelta(hours=delay)
+      self._publications[issue_date] = publication
+    return self._publications[issue_date]
+
+  def missed(self):
+    return len([x for x in self._attempted if self.publication(x) is not None]) - len(self.delays)
+
+  def __call__(self, issue_date):
+    now = self._time.now()
+    self._attempted.add(issue_date)
+    self.attempts += 1
+
+    if self._rnd.random() < self._failure_rate:
+      return False
+
+    self.logins += 1
+    self.bytes += self._listing_size
+
+    publication = self.publication(issue_date)
+    if publication is None or publication > now:
+      return False
+
+    self.bytes += self._issue_size
+    self.delays.append(now - publication)
+    return True
+
+def simulate(wait_evolution, nb_newspapers=300, days=365, seed=0, weekly_rate=0.2,
+             failure_rate=0.05, missing_rate=0.01, max_workers=4, adaptive=False):
+  '''
+  Run the engine on the fake newspapers for "days" days with the retry
+   policy "wait_evolution" (in seconds) and returns a SimulationReport.
+   If adaptive is set, the engine learns when the newspapers are
+   published (see nd.scheduler.PublicationTimeLearner).
+  '''
+  rnd = random.Random(seed)
+  start = datetime.datetime(2015, 1, 1)
+  time = VirtualTime(start, start + datetime.timedelta(days=days))
+
+  newspapers = []
+  for i in range(nb_newspapers):
+    if rnd.random() < weekly_rate:
+      schedule = nd.scheduler.WeeklySchedule(rnd.randint(1, 6))
+    else:
+      schedule = nd.scheduler.DailySchedule(rnd.random() < 0.5)
+    newspapers.append(FakeNewspaper('newspaper %d' % i, schedule, list(wait_evolution), time, rnd,
+                                    rnd.uniform(0, 10), failure_rate, missing_rate))
+
+  learner = nd.scheduler.PublicationTimeLearner() if adaptive else None
+  engine = SimulatedEngine(newspapers, time, max_workers=max_workers, learner=learner)
+  logging.disable(logging.CRITICAL)
+  try:
+    engine.run()
+  except SimulationOver:
+    pass
+  finally:
+    logging.disable(logging.NOTSET)
+  return SimulationReport(newspapers)
+
+if __name__ == '__main__':
+  import time
+
+  parser = ArgumentParser(description='Simulate a retry policy on fake newspapers')
+  parser.add_argument("-w", "--wait", type=float, nargs='+', default=[6, 12], help="The wait evolution (in hours)")
+  parser.add_argument("-n", "--newspapers", type=int, default=300, help="The number of fake newspapers")
+  parser.add_argument("-d", "--days", type=int, default=365, help="The simulated period")
+  parser.add_argument("-f", "--failure-rate", type=float, default=0.05, help="The rate of attempts failing")
+  parser.add_argument("-m", "--missing-rate", type=float, default=0.01, help="The rate of issues never published")
+  parser.add_argument("-a", "--adaptive", action='store_true', help="Learn the publication times")
+  parser.add_argument("-s", "--seed", type=int, default=0, help="The random seed")
+  options = parser.parse_args()
+
+  started = time.time()
+  report = simulate([x*60*60 for x in options.wait], options.newspapers, options.days, options.seed,
+                    failure_rate=options.failure_rate, missing_rate=options.missing_rate,
+                    adaptive=options.adaptive)
+  print(report)
+  print('Simulated in %.1f seconds' % (time.time() - started))
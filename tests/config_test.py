@@ -26,6 +26,15 @@ class TestConfig(unittest.TestCase):
 
         self.assertEqual(config.get("titi"), "")
 
+    def testItems(self):
+        stream = io.StringIO("a.b=1\na.c=2\nb.a=3")
+
+        config = nd.config.Configuration()
+        config.load(stream)
+
+        self.assertEqual(config.items('a.'), [('a.b', '1'), ('a.c', '2')])
+        self.assertEqual(len(config.items()), 3)
+
     def testIOException(self):
         mock_stream = mock()
 
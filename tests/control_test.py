@@ -0,0 +1,109 @@
+
+import unittest
+import datetime
+import threading
+import tempfile
+import os.path
+import signal
+import time
+
+import nd.control
+import nd.scheduler
+
+from mockito import mock, when
+
+class ControlTest(unittest.TestCase):
+
+    class Downloader(object):
+        def __init__(self, scheduler):
+            self.called = threading.Event()
+            self._scheduler = scheduler
+        def __call__(self, date):
+            self.called.set()
+            return True
+        def name(self):
+            return 'LT'
+        def host(self):
+            return 'letemps.ch'
+        def get_scheduler(self):
+            return self._scheduler
+
+    def setUp(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(1)
+        self._scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [3600])
+        self._scheduler.restore(tomorrow)
+        self._downloader = self.Downloader(self._scheduler)
+
+        self._engine = nd.scheduler.DownloadEngine([self._downloader])
+        self._thread = threading.Thread(target=self._engine.run)
+        self._thread.start()
+
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'control.sock')
+        self._server = nd.control.ControlServer(self._path, self._engine)
+        self._server.start()
+
+    def tearDown(self):
+        self._engine.post(nd.control.ControlCommand('drain'))
+        self._thread.join(5)
+        self._server.close()
+        os.rmdir(self._dir)
+
+    def testDownloadNow(self):
+        self.assertEqual(nd.control.send_command(self._path, 'now LT'), 'ok')
+        self.assertTrue(self._downloader.called.wait(1))
+
+    def testUnknownNewspaper(self):
+        reply = nd.control.send_command(self._path, 'now "Le Temps"')
+        self.assertTrue(reply.startswith('error'))
+
+    def testInvalidCommand(self):
+        reply = nd.control.send_command(self._path, 'sleep')
+        self.assertTrue(reply.startswith('error'))
+
+    def testReschedule(self):
+        reply = nd.control.send_command(self._path, 'reschedule LT 2015-01-02')
+        self.assertEqual(reply, 'ok')
+        self.assertTrue(self._downloader.called.wait(1))
+
+        reply = nd.control.send_command(self._path, 'reschedule LT 2015-01-52')
+        self.assertTrue(reply.startswith('error'))
+
+    def testStatus(self):
+        reply = nd.control.send_command(self._path, 'status')
+        self.assertTrue(reply.startswith('LT: '))
+
+    def testDrain(self):
+        self.assertEqual(nd.control.send_command(self._path, 'drain'), 'ok')
+        self._thread.join(1)
+        self.assertFalse(self._thread.is_alive())
+        self.assertFalse(self._downloader.called.is_set())
+
+    def testPostFromSignalHandler(self):
+        # the handler may interrupt the main thread while it posts
+        posted = []
+        def handler(signum, frame):
+            command = nd.control.ControlCommand('status')
+            self._engine.post(command)
+            posted.append(command)
+        previous = signal.signal(signal.SIGALRM, handler)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.001, 0.001)
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                self._engine.post(nd.control.ControlCommand('status'))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+        self.assertTrue(posted)
+        self.assertTrue(posted[-1].reply(5).startswith('LT: '))
+
+    def testNoDownloader(self):
+        try:
+            nd.control.send_command(os.path.join(self._dir, 'none.sock'), 'status')
+            self.fail("No exception raised")
+        except nd.control.ControlException:
+            pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+
+import unittest
+import gzip
+import http.server
+import socketserver
+import threading
+import time
+
+from nd.http_client import *
+from nd.newspaper_api import LoaderException
+from nd.ratelimit import RateLimits, HostLimit
+
+CONTENT = b'<html>issues</html>' * 100
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.clients.append(self.client_address)
+        server.encodings.append(self.headers.get('Accept-Encoding'))
+        if self.path == '/slow':
+            time.sleep(0.5)
+        if self.path == '/missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(CONTENT), 500):
+                chunk = CONTENT[i:i+500]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+
+        content = CONTENT
+        self.send_response(200)
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            content = gzip.compress(content)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class ThreadedServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class HttpClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = ThreadedServer(('127.0.0.1', 0), PageHandler)
+        self._server.clients = []
+        self._server.encodings = []
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:%d' % self._server.server_port
+        self._pool = ConnectionPool(timeout=5)
+
+    def tearDown(self):
+        self._pool.clear()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _get(self, opener, path='/issue.pdf'):
+        page = opener.open(self._url + path)
+        try:
+            return page.read()
+        finally:
+            page.close()
+
+    def testConnectionReused(self):
+        opener = build_opener(pool=self._pool)
+        self.assertEqual(self._get(opener), CONTENT)
+        self.assertEqual(self._get(opener), CONTENT)
+        # another opener (another plugin) shares the connections
+        self.assertEqual(self._get(build_opener(pool=self._pool)), CONTENT)
+        self.assertEqual(len(set(self._server.clients)), 1)
+
+    def testUnreadResponseNotReused(self):
+        opener = build_opener(pool=self._pool)
+        request = urllib.request.Request(self._url + '/issue.pdf', headers={'Accept-Encoding': 'identity'})
+        page = opener.open(request)
+        page.read(10)
+        page.close()
+        self.assertEqual(self._get(opener), CONTENT)
+        self.assertEqual(len(set(self._server.clients)), 2)
+
+    def testGzip(self):
+        opener = build_opener(pool=self._pool)
+        self.assertEqual(self._get(opener), CONTENT)
+        self.assertEqual(self._server.encodings, ['gzip'])
+
+        # the encoding chosen by the request is kept (Range requests)
+        request = urllib.request.Request(self._url + '/issue.pdf', headers={'Accept-Encoding': 'identity'})
+        page = opener.open(request)
+        self.assertEqual(page.read(), CONTENT)
+        page.close()
+        self.assertEqual(self._server.encodings, ['gzip', 'identity'])
+
+    def testRateLimits(self):
+        sleeps = []
+        limit = HostLimit(requests=1, bandwidth=1000, clock=lambda : 0, sleep=sleeps.append)
+        self._pool.limits = RateLimits({'127.0.0.1': limit})
+        opener = build_opener(pool=self._pool)
+        request = urllib.request.Request(self._url + '/issue.pdf', headers={'Accept-Encoding': 'identity'})
+        for i in range(2):
+            page = opener.open(request)
+            self.assertEqual(page.read(), CONTENT)
+            page.close()
+        # 1 request/s, 2 * 1900 bytes at 1000 bytes/s
+        self.assertEqual(sleeps, [0.9, 1, 2.8])
+
+    def testRateLimitsReadlines(self):
+        sleeps = []
+        limit = HostLimit(bandwidth=1000, clock=lambda : 0, sleep=sleeps.append)
+        self._pool.limits = RateLimits({'127.0.0.1': limit})
+        opener = build_opener(pool=self._pool)
+        request = urllib.request.Request(self._url + '/issue.pdf', headers={'Accept-Encoding': 'identity'})
+        # the listings are read by lines
+        page = opener.open(request)
+        self.assertEqual(b''.join(page.readlines()), CONTENT)
+        page.close()
+        self.assertEqual(sleeps, [0.9])
+
+        # the chunked lines are counted once
+        del sleeps[:]
+        limit = HostLimit(bandwidth=1000, clock=lambda : 0, sleep=sleeps.append)
+        self._pool.limits = RateLimits({'127.0.0.1': limit})
+        page = opener.open(self._url + '/chunked')
+        self.assertEqual(b''.join(page.readlines()), CONTENT)
+        page.close()
+        self.assertAlmostEqual(sleeps[-1], 0.9)
+
+    def testLoaderErrors(self):
+        opener = build_opener(pool=self._pool)
+        def get(path, timeout):
+            with loader_errors('download'):
+                opener.open(self._url + path, timeout=timeout).close()
+
+        self.assertRaises(LoaderException, get, '/missing', 5)
+        self.assertRaises(LoaderException, get, '/slow', 0.1)
+
+        self._server.server_close()
+        self._pool.clear()
+        self.assertRaises(LoaderException, get, '/issue.pdf', 5)
+
+    def testSessionInvalidated(self):
+        class Session(object):
+            invalidated = False
+            def invalidate(self):
+                self.invalidated = True
+
+        session = Session()
+        try:
+            with loader_errors('list the issues', session):
+                raise urllib.error.HTTPError('http://example.com', 403, 'Forbidden', None, None)
+            self.fail('No exception raised')
+        except LoaderException:
+            pass
+        self.assertTrue(session.invalidated)
+
+if __name__ == '__main__':
+    unittest.main()
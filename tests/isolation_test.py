@@ -0,0 +1,187 @@
+
+import unittest
+import datetime
+import io
+import os
+import threading
+import time
+
+from nd.isolation import *
+from nd.newspaper_api import NewspaperLoader, OnlineNewspaperIssue, LoaderException
+from nd.sender import Sender
+import nd.metrics
+
+TODAY = datetime.date(2014, 12, 12)
+
+class FakeIssue(OnlineNewspaperIssue):
+    def __init__(self, loader, content, title='Issue', barrier=None):
+        super(FakeIssue, self).__init__(title, TODAY, loader)
+        self._content = content
+        self._barrier = barrier
+    def open(self):
+        if self._barrier:
+            # every edition waits for the others to be opened
+            self._barrier.wait()
+        return io.BytesIO(self._content)
+
+class BrokenStream(io.BytesIO):
+    def __init__(self):
+        super(BrokenStream, self).__init__(b'x' * 10**6)
+    def read(self, size=-1):
+        if self.tell() > 0:
+            raise IOError('Broken stream')
+        return super(BrokenStream, self).read(size)
+    def readinto(self, buffer):
+        if self.tell() > 0:
+            raise IOError('Broken stream')
+        return super(BrokenStream, self).readinto(buffer)
+
+class BrokenIssue(FakeIssue):
+    def open(self):
+        return BrokenStream()
+
+class FakeLoader(NewspaperLoader):
+    def __init__(self, name, behaviour):
+        self._name = name
+        self._behaviour = behaviour
+    def name(self):
+        return self._name
+    def init(self):
+        pass
+    def parallel_issues(self):
+        return 3 if self._behaviour == 'editions' else 1
+    def issues(self):
+        if self._behaviour == 'hang':
+            time.sleep(60)
+        elif self._behaviour == 'error':
+            raise LoaderException('Invalid page')
+        elif self._behaviour == 'broken':
+            return [BrokenIssue(self, b'')]
+        elif self._behaviour == 'memory':
+            return [b'x' * 2**30]
+        elif self._behaviour == 'editions':
+            barrier = threading.Barrier(3, timeout=5)
+            return [FakeIssue(self, b'edition %d' % i, 'Edition %d' % i, barrier) for i in range(3)]
+        return [FakeIssue(self, b'content' * 100000)]
+
+class MemorySender(Sender):
+    def __init__(self):
+        super(MemorySender, self).__init__(True)
+        self.content = None
+        self.titles = []
+    def upload_PDF(self, issue, stream):
+        self.content = (issue.title(), issue.date(), issue.loader().name(), stream.read())
+        self.titles.append(issue.title())
+
+class IsolationTest(unittest.TestCase):
+
+    def setUp(self):
+        self._loaders = dict((name, FakeLoader(name, name)) for name in ('ok', 'hang', 'error', 'memory', 'editions', 'broken'))
+        self._pool = PluginPool(list(self._loaders.values()), 1, memory_limit=512 * 2**20)
+
+    def tearDown(self):
+        self._pool.close()
+
+    def _download(self, name, timeout=10, sender=None):
+        sender = sender or MemorySender()
+        downloader = IsolatedNewspaperDownloader(sender, self._loaders[name], self._pool, timeout)
+        return downloader(TODAY), sender.content
+
+    def _logins(self, name):
+        return len([s for s in nd.metrics.REGISTRY.samples() if s.newspaper == name and s.phase == nd.metrics.LOGIN])
+
+    def testDownload(self):
+        logins = self._logins('ok')
+        ok, content = self._download('ok')
+        self.assertTrue(ok)
+        self.assertEqual(content, ('Issue', TODAY, 'ok', b'content' * 100000))
+
+        # the process is reused
+        ok, content = self._download('ok')
+        self.assertTrue(ok)
+
+        # the phases timed by the plugin process are received
+        self.assertEqual(self._logins('ok'), logins + 2)
+
+    def testTimeout(self):
+        started = time.time()
+        ok, content = self._download('hang', timeout=0.5)
+        self.assertFalse(ok)
+        self.assertTrue(time.time() - started < 5)
+
+        # the process has been replaced
+        ok, content = self._download('ok')
+        self.assertTrue(ok)
+
+    def testLoaderError(self):
+        ok, content = self._download('error')
+        self.assertFalse(ok)
+        self.assertEqual(content, None)
+
+    def testMemoryLimit(self):
+        ok, content = self._download('memory')
+        self.assertFalse(ok)
+
+        ok, content = self._download('ok')
+        self.assertTrue(ok)
+
+    def testParallelEditions(self):
+        sender = MemorySender()
+        ok, content = self._download('editions', sender=sender)
+        self.assertTrue(ok)
+        self.assertEqual(sender.titles, ['Edition 0', 'Edition 1', 'Edition 2'])
+        self.assertEqual(content[3], b'edition 2')
+
+    def testErrorWhileSending(self):
+        downloader = IsolatedNewspaperDownloader(MemorySender(), self._loaders['broken'], self._pool, 10)
+        issues = downloader._issues(TODAY)
+        stream = next(issues).open()
+        try:
+            while stream.read():
+                pass
+            self.fail('No exception raised')
+        except LoaderException as e:
+            # the error of the plugin
+            self.assertTrue('Broken stream' in str(e))
+        issues.close()
+
+        ok, content = self._download('ok')
+        self.assertTrue(ok)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/stat'), 'no /proc')
+    def testReplacedByForkHelper(self):
+        def parent(pid):
+            with open('/proc/%d/stat' % pid) as stat:
+                return int(stat.read().rsplit(')', 1)[1].split()[1])
+        process = self._pool.acquire()
+        process.kill()
+        self._pool.release(process)
+
+        # the dead process isn't forked by the (threaded) downloader
+        process = self._pool.acquire()
+        try:
+            self.assertTrue(process.is_alive())
+            self.assertNotEqual(parent(process._pid), os.getpid())
+        finally:
+            self._pool.release(process)
+
+    def testUpdate(self):
+        # a newspaper added after the processes are forked
+        self._loaders['added'] = FakeLoader('added', 'ok')
+        self._pool.update(FakeLoader, 'added', 'ok')
+        ok, content = self._download('added')
+        self.assertTrue(ok)
+        self.assertEqual(content[2], 'added')
+
+        ok, content = self._download('ok')
+        self.assertTrue(ok)
+
+    def testInvalidArguments(self):
+        try:
+            IsolatedNewspaperDownloader(MemorySender(), self._loaders['ok'], None)
+            self.fail("No exception raised")
+        except ValueError:
+            pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+
+import unittest
+import datetime
+import multiprocessing
+import os.path
+import shutil
+import sqlite3
+import tempfile
+
+from nd.db import DB, DBException
+from nd.newspaper_loader import LeasedNewspaperDownloader
+
+from mockito import mock, when, verify, any
+
+def acquire_all(path, owner, names):
+    db = DB(sqlite3.connect(path, timeout=30))
+    acquired = [name for name in names if db.acquire_lease(name, owner, 60)]
+    db.close()
+    return acquired
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self._db = DB(sqlite3.connect(':memory:'))
+
+    def testAcquireLease(self):
+        self.assertTrue(self._db.acquire_lease('LT:2014-12-12', 'a', 60))
+        self.assertTrue(self._db.acquire_lease('LT:2014-12-12', 'a', 60))
+        self.assertFalse(self._db.acquire_lease('LT:2014-12-12', 'b', 60))
+
+        self._db.release_lease('LT:2014-12-12', 'a')
+        self.assertTrue(self._db.acquire_lease('LT:2014-12-12', 'b', 60))
+
+        self._db.complete_lease('LT:2014-12-12', 'b')
+        self.assertTrue(self._db.lease_done('LT:2014-12-12'))
+        self.assertFalse(self._db.acquire_lease('LT:2014-12-12', 'b', 60))
+        self.assertFalse(self._db.lease_done('LT:2014-12-13'))
+
+    def testExpiredLease(self):
+        self.assertTrue(self._db.acquire_lease('LT:2014-12-12', 'a', -1))
+        self.assertTrue(self._db.acquire_lease('LT:2014-12-12', 'b', 60))
+        self.assertFalse(self._db.acquire_lease('LT:2014-12-12', 'a', 60))
+
+    def testSeveralProcesses(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'newspapers.db')
+            DB(sqlite3.connect(path)).close()
+
+            names = ['LT:%d' % i for i in range(50)]
+            pool = multiprocessing.Pool(4)
+            try:
+                results = pool.starmap(acquire_all, [(path, 'node%d' % i, names) for i in range(4)])
+            finally:
+                pool.close()
+                pool.join()
+
+            acquired = sorted(name for result in results for name in result)
+            self.assertEqual(acquired, sorted(names))
+        finally:
+            shutil.rmtree(directory)
+
+    def testLeasedDownloader(self):
+        today = datetime.date(2014, 12, 12)
+        downloader = mock()
+        when(downloader).name().thenReturn('LT')
+        when(downloader).__call__(today).thenReturn(False).thenReturn(True)
+
+        leased = LeasedNewspaperDownloader(downloader, self._db, 'a')
+        other = LeasedNewspaperDownloader(downloader, self._db, 'b')
+
+        self.assertFalse(leased(today))
+        self.assertFalse(leased.skipped(today))
+        self.assertTrue(other(today))
+        self.assertTrue(self._db.lease_done('LT:2014-12-12'))
+
+        # the issue has been downloaded by another node
+        self.assertTrue(leased(today))
+        self.assertTrue(leased.skipped(today))
+        verify(downloader, times=2).__call__(today)
+
+    def testLeaseHeldByAnotherNode(self):
+        today = datetime.date(2014, 12, 12)
+        downloader = mock()
+        when(downloader).name().thenReturn('LT')
+        self._db.acquire_lease('LT:2014-12-12', 'b', 60)
+
+        leased = LeasedNewspaperDownloader(downloader, self._db, 'a')
+        self.assertFalse(leased(today))
+        self.assertTrue(leased.skipped(today))
+        verify(downloader, times=0).__call__(any())
+
+    def testDBException(self):
+        db = mock()
+        when(db).lease_done(any()).thenRaise(DBException)
+        downloader = mock()
+        leased = LeasedNewspaperDownloader(downloader, db, 'a')
+        self.assertFalse(leased(datetime.date(2014, 12, 12)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+
+import unittest
+import datetime
+import io
+import re
+
+import nd.metrics
+
+from nd.listing import *
+from nd.newspaper_api import NewspaperLoader, NewspaperIssue
+from nd.newspaper_loader import dated_issues
+
+PATTERN = r'<li date="(?P<date>\d+)">\s*<a href="(?P<url>[^"]*)">(?P<title>.*?)</a>\s*</li>'
+
+def page(nb_entries):
+    entries = ['<li date="%d">\n  <a href="/issue%d.pdf">Issue <b>%d</b></a>\n</li>' % (i, i, i)
+               for i in range(nb_entries)]
+    return '<html><ul>%s</ul></html>' % '\n'.join(entries)
+
+class CountingStream(object):
+    def __init__(self, content):
+        self._stream = io.BytesIO(content.encode('utf-8'))
+        self.reads = 0
+        self.closed = False
+    def read(self, size):
+        self.reads += 1
+        return self._stream.read(size)
+    def close(self):
+        self.closed = True
+
+class ListingTest(unittest.TestCase):
+
+    def testSameMatchesAsWholePage(self):
+        text = page(200)
+        expected = [m.groupdict() for m in re.finditer(PATTERN, text, re.DOTALL)]
+        for size in (1, 7, 100, 4096, len(text)):
+            parser = ListingParser(PATTERN, window=100)
+            matches = []
+            for i in range(0, len(text), size):
+                matches.extend(parser.feed(text[i:i+size]))
+            matches.extend(parser.close())
+            self.assertEqual([m.groupdict() for m in matches], expected)
+
+    def testMatchAcrossPieces(self):
+        parser = ListingParser(PATTERN, window=100)
+        self.assertEqual(parser.feed('<li date="1"> <a href="/a'), [])
+        self.assertEqual(parser.feed('.pdf">A</a></li>'), [])
+        matches = parser.close()
+        self.assertEqual([m.group('url') for m in matches], ['/a.pdf'])
+
+    def testIterMatches(self):
+        # a multi-byte character cut between two reads
+        text = page(3).replace('Issue', 'Numéro')
+        matches = list(iter_matches(io.BytesIO(text.encode('utf-8')), PATTERN, size=5))
+        self.assertEqual([m['title'] for m in matches], ['Numéro <b>%d</b>' % i for i in range(3)])
+
+    def testEarlyExit(self):
+        stream = CountingStream(page(10000))
+        matches = iter_matches(stream, PATTERN, size=1024)
+        for match in matches:
+            if match['date'] == '3':
+                break
+        self.assertTrue(stream.reads < 30)
+
+    def testIterPage(self):
+        stream = CountingStream(page(10000))
+        with nd.metrics.newspaper('listing test'):
+            matches = iter_page(lambda : stream, PATTERN, size=1024)
+            for match in matches:
+                if match['date'] == '3':
+                    break
+            matches.close()
+        self.assertTrue(stream.closed)
+
+        # the phases are recorded when the iteration stops
+        samples = [s for s in nd.metrics.REGISTRY.samples() if s.newspaper == 'listing test']
+        self.assertEqual([s.phase for s in samples], [nd.metrics.LISTING_FETCH, nd.metrics.LISTING_PARSE])
+        self.assertEqual(samples[0].size, stream.reads * 1024)
+
+class ListedIssues(NewspaperLoader):
+    def __init__(self, dates):
+        self._dates = dates
+        self.listed = []
+        self.closed = False
+    def iter_issues(self):
+        try:
+            for d in self._dates:
+                self.listed.append(d)
+                yield NewspaperIssue('Issue', d)
+        finally:
+            self.closed = True
+
+class DatedIssuesTest(unittest.TestCase):
+
+    def testStopAfterDate(self):
+        day = datetime.date(2014, 12, 12)
+        dates = [day + datetime.timedelta(days=1), day, day, day - datetime.timedelta(days=1),
+                 day - datetime.timedelta(days=2)]
+        loader = ListedIssues(dates)
+        self.assertEqual(len(dated_issues(loader, day)), 2)
+        self.assertEqual(loader.listed, dates[:4])
+        self.assertTrue(loader.closed)
+
+    def testIssuesFor(self):
+        day = datetime.date(2014, 12, 12)
+        class DirectIssues(ListedIssues):
+            def issues_for(self, issue_date):
+                return [NewspaperIssue('Edition', issue_date)]
+        loader = DirectIssues([day])
+        self.assertEqual([issue.title() for issue in dated_issues(loader, day)], ['Edition'])
+        # the listing isn't read
+        self.assertEqual(loader.listed, [])
+
+    def testNotFound(self):
+        loader = ListedIssues([datetime.date(2014, 12, 11)])
+        self.assertEqual(dated_issues(loader, datetime.date(2014, 12, 12)), [])
+        self.assertTrue(loader.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+
+import unittest
+import datetime
+import io
+import urllib.request
+
+from nd.metrics import *
+from nd.newspaper_loader import NewspaperDownloader
+from nd.sender import Sender
+
+from mockito import *
+
+class CopySender(Sender):
+    def __init__(self):
+        super(CopySender, self).__init__(True)
+    def upload_PDF(self, issue, stream):
+        self.content = stream.read()
+
+class MetricsTest(unittest.TestCase):
+
+    def testPhase(self):
+        registry = Registry()
+        with newspaper('Le Temps'):
+            with phase(DOWNLOAD, registry=registry) as measure:
+                measure.add(1000)
+                measure.add(24)
+        with phase(LOGIN, newspaper='24 Heures', registry=registry):
+            pass
+
+        samples = registry.samples()
+        self.assertEqual([(s.newspaper, s.phase, s.size) for s in samples],
+                         [('Le Temps', DOWNLOAD, 1024), ('24 Heures', LOGIN, 0)])
+        self.assertEqual(current_newspaper(), None)
+
+    def testFailedPhase(self):
+        registry = Registry()
+        try:
+            with phase(LOGIN, newspaper='Le Temps', registry=registry):
+                raise IOError('Connection refused')
+        except IOError:
+            pass
+        self.assertEqual(len(registry.samples()), 1)
+
+    def testWindow(self):
+        registry = Registry(window=2)
+        for i in range(3):
+            registry.record(Sample('Le Temps', DOWNLOAD, 1, 100))
+        self.assertEqual(len(registry.samples()), 2)
+        self.assertEqual(len(registry.drain()), 2)
+        self.assertEqual(registry.drain(), [])
+        # the totals are kept
+        self.assertTrue('nd_phase_runs_total{newspaper="Le Temps",phase="download"} 3' in registry.prometheus())
+
+    def testPrometheus(self):
+        registry = Registry()
+        registry.record(Sample('Le Temps', DOWNLOAD, 2, 1000))
+        registry.record(Sample('Le Temps', DOWNLOAD, 2, 3000))
+        registry.record(Sample('L\'"Hebdo', LOGIN, 0.5, 0))
+
+        lines = registry.prometheus().splitlines()
+        self.assertTrue('# TYPE nd_phase_seconds_total counter' in lines)
+        self.assertTrue('nd_phase_seconds_total{newspaper="Le Temps",phase="download"} 4.000000' in lines)
+        self.assertTrue('nd_phase_bytes_total{newspaper="Le Temps",phase="download"} 4000' in lines)
+        self.assertTrue('nd_phase_throughput_bytes{newspaper="Le Temps",phase="download"} 1000.0' in lines)
+        self.assertTrue('nd_phase_runs_total{newspaper="L\'\\"Hebdo",phase="login"} 1' in lines)
+
+    def testServer(self):
+        registry = Registry()
+        registry.record(Sample('Le Temps', DOWNLOAD, 2, 1000))
+        server = MetricsServer(('127.0.0.1', 0), registry)
+        server.start()
+        try:
+            page = urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1])
+            self.assertEqual(page.read().decode('utf-8'), registry.prometheus())
+            page.close()
+        finally:
+            server.close()
+
+    def testDownloaderPhases(self):
+        today = datetime.date(2013, 12, 14)
+        issue = mock()
+        when(issue).date().thenReturn(today)
+        when(issue).title().thenReturn('Issue')
+        when(issue).open().thenReturn(io.BytesIO(b'x' * 1000))
+
+        paper = mock()
+        when(paper).name().thenReturn('metrics test')
+        when(paper).issues().thenReturn([issue])
+
+        self.assertTrue(NewspaperDownloader(CopySender(), paper)(today))
+        phases = dict((s.phase, s.size) for s in REGISTRY.samples() if s.newspaper == 'metrics test')
+        self.assertEqual(phases, {LOGIN: 0, DOWNLOAD: 1000, 'sender_CopySender': 1000})
+
+if __name__ == '__main__':
+    unittest.main()
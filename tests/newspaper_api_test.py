@@ -1,5 +1,6 @@
 
 import unittest
+import io
 from nd.newspaper_api import *
 from mockito import mock, verify, when
 
@@ -35,6 +36,46 @@ class NewspaperAPITest(unittest.TestCase):
         except ValueError:
             pass
 
+    def testReadIntoShim(self):
+        # the API of the old plugins: read() without a size
+        class OldStream(NewspaperStream):
+            def __init__(self):
+                self._data = [b'abcdefghijkl', b'mn']
+            def read(self):
+                return self._data.pop(0) if self._data else None
+
+        stream = OldStream()
+        buffer = memoryview(bytearray(10))
+        self.assertEqual(stream.readinto(buffer), 10)
+        self.assertEqual(bytes(buffer), b'abcdefghij')
+        self.assertEqual(readinto(stream, buffer), 2)
+        self.assertEqual(bytes(buffer[:2]), b'kl')
+        self.assertEqual(readinto(stream, buffer), 2)
+        self.assertEqual(bytes(buffer[:2]), b'mn')
+        self.assertEqual(readinto(stream, buffer), 0)
+
+        self.assertEqual([bytes(x) for x in chunks(OldStream(), 5)], [b'abcde', b'fghij', b'kl', b'mn'])
+        destination = io.BytesIO()
+        self.assertEqual(copy_stream(OldStream(), destination), 14)
+        self.assertEqual(destination.getvalue(), b'abcdefghijklmn')
+
+    def testChunks(self):
+        content = bytes(range(256)) * 10
+        self.assertEqual(list(map(len, chunks(io.BytesIO(content), 1000))), [1000, 1000, 560])
+
+        # the buffer is reused
+        views = list(chunks(io.BytesIO(content), 1000))
+        self.assertEqual(views[0].obj, views[1].obj)
+
+        # streams without readinto
+        self.assertEqual(list(chunks(io.StringIO('abcde'), 2)), ['ab', 'cd', 'e'])
+
+    def testCopyStream(self):
+        content = b'x' * (3 * CHUNK_SIZE + 10)
+        destination = io.BytesIO()
+        self.assertEqual(copy_stream(io.BytesIO(content), destination), len(content))
+        self.assertEqual(destination.getvalue(), content)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,15 +1,56 @@
 
-from nd.newspaper_loader import NewspaperDownloader
-from nd.sender import SenderException
+from nd.newspaper_loader import NewspaperDownloader, StreamTee
+from nd.sender import Sender, SenderException, DBSender
 from nd.newspaper_api import *
 import unittest
 import datetime
 import io
+import hashlib
+import threading
 
 from mockito import *
 
+class ReadingSender(Sender):
+    def __init__(self, critical=True, size=-1, fail=False):
+        super(ReadingSender, self).__init__(critical)
+        self._size = size
+        self._fail = fail
+        self.content = None
+    def upload_PDF(self, issue, stream):
+        content = b''
+        while True:
+            data = stream.read(self._size)
+            if self._fail:
+                raise SenderException('Disk full')
+            content += data
+            if not data or self._size < 0:
+                break
+        self.content = content
+
+class BrokenStream(object):
+    def __init__(self):
+        self._reads = 0
+    def read(self, size):
+        self._reads += 1
+        if self._reads > 2:
+            raise IOError('Connection reset')
+        return b'x' * size
+    def close(self):
+        pass
+
 class NewspaperDownloaderTest(unittest.TestCase):
 
+    def _newspaper(self, today, stream):
+        issue = mock()
+        when(issue).date().thenReturn(today)
+        when(issue).title().thenReturn('Issue')
+        when(issue).open().thenReturn(stream)
+
+        newspaper = mock()
+        when(newspaper).name().thenReturn('newspaper')
+        when(newspaper).issues().thenReturn([issue])
+        return newspaper
+
     def testConstructor(self):
         try:
             NewspaperDownloader(None, None)
@@ -58,6 +99,158 @@ class NewspaperDownloaderTest(unittest.TestCase):
         inorder.verify(sender).upload_PDF(issue, file)
         inorder.verify(file).close()
 
+    def testFanOut(self):
+        today = datetime.date(2013, 12, 14)
+        content = bytes(range(256)) * 10000
+        senders = [ReadingSender(), ReadingSender(size=1000), ReadingSender(size=10**6)]
+
+        d = NewspaperDownloader(senders, self._newspaper(today, io.BytesIO(content)))
+        self.assertTrue(d(today))
+        for sender in senders:
+            self.assertEqual(sender.content, content)
+
+    def testFanOutSenderException(self):
+        today = datetime.date(2013, 12, 14)
+        content = b'x' * 10**7
+        failing, other = ReadingSender(size=10, fail=True), ReadingSender()
+
+        # the other senders get the whole issue
+        d = NewspaperDownloader([failing, other], self._newspaper(today, io.BytesIO(content)))
+        self.assertFalse(d(today))
+        self.assertEqual(other.content, content)
+
+        failing = ReadingSender(critical=False, size=10, fail=True)
+        d = NewspaperDownloader([failing, other], self._newspaper(today, io.BytesIO(content)))
+        self.assertTrue(d(today))
+
+    def testFanOutDownloadError(self):
+        today = datetime.date(2013, 12, 14)
+        sender = ReadingSender(size=1000)
+
+        d = NewspaperDownloader([sender], self._newspaper(today, BrokenStream()))
+        self.assertFalse(d(today))
+        self.assertEqual(sender.content, None)
+
+    def testParallelIssues(self):
+        today = datetime.date(2013, 12, 14)
+        # every issue waits for the others to be opened
+        barrier = threading.Barrier(3, timeout=1)
+        def open_issue(*args):
+            barrier.wait()
+            return io.BytesIO(b'content')
+
+        issues = []
+        for i in range(3):
+            issue = mock()
+            when(issue).date().thenReturn(today)
+            when(issue).title().thenReturn('Edition %d' % i)
+            when(issue).open().thenAnswer(open_issue)
+            issues.append(issue)
+
+        newspaper = mock()
+        when(newspaper).name().thenReturn('newspaper')
+        when(newspaper).issues().thenReturn(issues)
+        when(newspaper).parallel_issues().thenReturn(3)
+
+        sender = ReadingSender()
+        d = NewspaperDownloader([sender], newspaper)
+        self.assertTrue(d(today))
+        self.assertFalse(barrier.broken)
+
+        # one after the other
+        barrier.reset()
+        when(newspaper).parallel_issues().thenReturn(1)
+        self.assertFalse(d(today))
+        self.assertTrue(barrier.broken)
+
+    def testKnownContent(self):
+        today = datetime.date(2013, 12, 14)
+        content = b'x' * 10**6
+        known = []
+        sender = ReadingSender(size=1000)
+
+        # the senders are aborted at the end of the stream
+        d = NewspaperDownloader([sender], self._newspaper(today, io.BytesIO(content)),
+                                known_content=lambda x : known.append(x) or True)
+        self.assertTrue(d(today))
+        self.assertEqual(sender.content, None)
+        self.assertEqual(known, [hashlib.sha256(content).hexdigest()])
+
+        # the senders aren't called in the spool mode
+        sender = mock()
+        repo = mock()
+        when(repo).mkstemp().thenReturn(io.BytesIO())
+        d = NewspaperDownloader([sender], self._newspaper(today, io.BytesIO(content)), repo,
+                                known_content=lambda x : True)
+        self.assertTrue(d(today))
+        verify(sender, times=0).upload_PDF(any(), any())
+
+    def testStreamTeeDigest(self):
+        tee = StreamTee(1, chunk_size=4)
+        reader = tee.readers[0]
+        stream = io.BytesIO(b'abcdefghij')
+        while tee.fill(stream):
+            pass
+        self.assertEqual(reader.sha256(), None)
+        self.assertEqual(reader.read(), b'abcdefghij')
+        self.assertEqual(reader.sha256(), hashlib.sha256(b'abcdefghij').hexdigest())
+
+    def testStreamTee(self):
+        tee = StreamTee(2, chunk_size=4, nb_chunks=2)
+        first, second = tee.readers
+        stream = io.BytesIO(b'abcdefghij')
+
+        self.assertTrue(tee.fill(stream))
+        self.assertTrue(tee.fill(stream))
+        self.assertEqual(first.read(2), b'ab')
+        self.assertEqual(first.read(10), b'cd')
+        buffer = bytearray(10)
+        self.assertEqual(first.readinto(memoryview(buffer)), 4)
+        self.assertEqual(buffer[:4], b'efgh')
+
+        # the chunks are reused once both readers have read them
+        self.assertEqual(second.read(8), b'abcd')
+        self.assertTrue(tee.fill(stream))
+
+        second.close()
+        self.assertFalse(tee.fill(stream))
+        self.assertEqual(first.read(), b'ij')
+        self.assertEqual(first.read(10), b'')
+
+        first.close()
+        self.assertFalse(tee.fill(io.BytesIO(b'k')))
+
+    def testStreamTeeAbort(self):
+        tee = StreamTee(1, chunk_size=4)
+        reader = tee.readers[0]
+        self.assertTrue(tee.fill(io.BytesIO(b'abcd')))
+        tee.abort(IOError('Connection reset'))
+
+        # the chunks already pushed are read first
+        self.assertEqual(reader.read(10), b'abcd')
+        self.assertRaises(IOError, reader.read, 10)
+
+        tee = StreamTee(1, chunk_size=4, known=lambda x : True)
+        reader = tee.readers[0]
+        stream = io.BytesIO(b'abcdef')
+        while tee.fill(stream):
+            pass
+        self.assertEqual(reader.read(4), b'abcd')
+        self.assertEqual(reader.read(4), b'ef')
+        self.assertRaises(DuplicateContentException, reader.read, 4)
+
+    def testDuplicateFanOut(self):
+        today = datetime.date(2013, 12, 14)
+        dirmanager, db = mock(), mock()
+        when(dirmanager).create_file('Issue').thenReturn((io.BytesIO(), 'issue.pdf'))
+        sender = DBSender(dirmanager, db)
+
+        d = NewspaperDownloader([sender], self._newspaper(today, io.BytesIO(b'x' * 10**6)),
+                                known_content=lambda x : True)
+        self.assertTrue(d(today))
+        verify(dirmanager).remove_file('issue.pdf')
+        verify(db, times=0).add_issue(any(), any(), any(), any())
+
     def testLoaderExcepion(self):
         sender = mock()
 
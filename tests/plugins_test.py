@@ -1,2 +1,94 @@
-
 import nd.plugin_utils
+
+import unittest
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+from nd.plugin_utils import *
+
+PLUGIN = '''
+from nd.newspaper_api import NewspaperLoader
+
+class %(cls)s(NewspaperLoader):
+  def __init__(self, config):
+    pass
+  def name(self):
+    return '%(name)s'
+'''
+
+class PluginRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._package = 'ndtestplugins%d' % id(self)
+        os.mkdir(os.path.join(self._dir, self._package))
+        open(os.path.join(self._dir, self._package, '__init__.py'), 'w').close()
+        for i in range(3):
+            self._plugin('paper%d' % i, PLUGIN % dict(cls='Loader%d' % i, name='Paper %d' % i))
+        sys.path.insert(0, self._dir)
+        importlib.invalidate_caches()
+        self._manifest = os.path.join(self._dir, 'plugins.cfg')
+
+    def tearDown(self):
+        sys.path.remove(self._dir)
+        for modname in list(sys.modules):
+            if modname.startswith(self._package):
+                del sys.modules[modname]
+        shutil.rmtree(self._dir)
+
+    def _plugin(self, modname, source):
+        with open(os.path.join(self._dir, self._package, '%s.py' % modname), 'w') as plugin:
+            plugin.write(source)
+
+    def _imported(self):
+        return sorted(modname for modname in sys.modules if modname.startswith(self._package + '.'))
+
+    def _write_manifest(self):
+        return write_manifest(self._manifest, importlib.import_module(self._package))
+
+    def testLoadOnlySelected(self):
+        with open(self._manifest, 'w') as manifest:
+            manifest.write('Paper 0 = %s.paper0:Loader0\n' % self._package)
+            manifest.write('Paper 1 = %s.paper1:Loader1\n' % self._package)
+        registry = plugin_registry(self._manifest, group='nd.test.none',
+                                   package=importlib.import_module(self._package))
+        self.assertEqual(registry.names(), ['Paper 0', 'Paper 1'])
+        self.assertEqual(self._imported(), [])
+
+        loader_classes = registry.load(['Paper 1'])
+        self.assertEqual([cls.__name__ for cls in loader_classes], ['Loader1'])
+        self.assertEqual(self._imported(), ['%s.paper1' % self._package])
+
+    def testUnknownNewspaper(self):
+        registry = PluginRegistry([PluginEntry('Paper 0', '%s.paper0:Loader0' % self._package)])
+        self.assertRaises(PluginException, registry.load, ['Paper 0', 'Unknown'])
+        self.assertEqual(self._imported(), [])
+
+    def testInvalidPlugins(self):
+        self._plugin('broken', 'raise ImportError("missing dependency")')
+        registry = PluginRegistry([PluginEntry('Broken', '%s.broken:Loader' % self._package),
+                                   PluginEntry('Not a loader', 'os.path:join'),
+                                   PluginEntry('No class', '%s.paper0' % self._package),
+                                   PluginEntry('Paper 2', '%s.paper2:Loader2' % self._package)])
+        loader_classes = registry.load()
+        self.assertEqual([cls.__name__ for cls in loader_classes], ['Loader2'])
+
+    def testWriteManifest(self):
+        self.assertEqual(self._write_manifest(), 3)
+        registry = PluginRegistry(read_manifest(self._manifest))
+        self.assertEqual(registry.names(), ['Paper 0', 'Paper 1', 'Paper 2'])
+        self.assertEqual([cls.__name__ for cls in registry.load()],
+                         ['Loader0', 'Loader1', 'Loader2'])
+
+    def testNoManifest(self):
+        self.assertEqual(read_manifest(os.path.join(self._dir, 'none.cfg')), [])
+
+    def testScan(self):
+        loader_classes = load_plugins(importlib.import_module(self._package))
+        self.assertEqual(sorted(cls.__name__ for cls in loader_classes), ['Loader0', 'Loader1', 'Loader2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+
+import unittest
+import io
+import os
+
+from nd.ratelimit import *
+from nd.config import Configuration, ConfigurationException
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+    def __call__(self):
+        return self.now
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self._clock = FakeClock()
+
+    def _bucket(self, rate, burst=None):
+        return TokenBucket(rate, burst, clock=self._clock, sleep=self._clock.sleep)
+
+    def testBurst(self):
+        bucket = self._bucket(2, burst=3)
+        for i in range(3):
+            self.assertEqual(bucket.acquire(), 0)
+        # the next requests are smoothed
+        self.assertEqual(bucket.acquire(), 0.5)
+        self.assertEqual(bucket.acquire(), 0.5)
+        self.assertEqual(self._clock.sleeps, [0.5, 0.5])
+
+        # the tokens come back with the time (at most the burst)
+        self._clock.now += 10
+        for i in range(3):
+            self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0.5)
+
+    def testDebt(self):
+        bucket = self._bucket(1000)
+        # a large chunk is taken at once, the next consumer pays for it
+        self.assertEqual(bucket.reserve(3000), 2)
+        self.assertEqual(bucket.reserve(1000), 3)
+
+    def testShared(self):
+        bucket = self._bucket(1, burst=2)
+        pid = os.fork()
+        if pid == 0:
+            bucket.reserve(2)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        # the tokens taken by the child are gone
+        self.assertEqual(bucket.reserve(), 1)
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, TokenBucket, 0)
+        self.assertRaises(ValueError, TokenBucket, 1, -1)
+
+class RateLimitsTest(unittest.TestCase):
+
+    def _config(self, text):
+        config = Configuration()
+        config.load(io.StringIO(text))
+        return config
+
+    def testConfig(self):
+        config = self._config('nd.ratelimit.requests=1\n'
+                              'nd.ratelimit.epaper.tamedia.ch.requests=0.5\n'
+                              'nd.ratelimit.epaper.tamedia.ch.bandwidth=100000\n')
+        limits = rate_limits(config, ['www.letemps.ch'])
+        self.assertEqual(len(limits), 2)
+        self.assertTrue(isinstance(limits.get('www.letemps.ch'), HostLimit))
+        self.assertTrue(isinstance(limits.get('epaper.tamedia.ch'), HostLimit))
+
+        # the default limits for the other websites
+        self.assertTrue(isinstance(limits.get('www.lhebdo.ch'), HostLimit))
+        self.assertTrue(limits.get('www.lhebdo.ch') is limits.get('www.lhebdo.ch'))
+        self.assertEqual(len(limits), 3)
+
+    def testNoLimit(self):
+        limits = rate_limits(self._config(''), ['www.letemps.ch'])
+        self.assertEqual(len(limits), 0)
+        self.assertEqual(limits.get('www.lhebdo.ch'), None)
+
+    def testInvalidConfig(self):
+        config = self._config('nd.ratelimit.www.letemps.ch.requests=fast\n')
+        self.assertRaises(ConfigurationException, rate_limits, config)
+
+    def testHostLimit(self):
+        clock = FakeClock()
+        limit = HostLimit(requests=1, bandwidth=100, clock=clock, sleep=clock.sleep)
+        limit.request()
+        limit.request()
+        limit.transferred(100)
+        limit.transferred(50)
+        self.assertEqual(clock.sleeps, [1, 0.5])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+
+import unittest
+import datetime
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import nd.control
+import nd.scheduler
+from nd.reload import *
+
+PLUGIN = '''
+from nd.newspaper_api import NewspaperLoader
+import nd.scheduler
+
+VERSION = %(version)d
+
+class Loader(NewspaperLoader):
+  def __init__(self, config):
+    pass
+  def name(self):
+    return '%(name)s'
+  def host(self):
+    return 'paper.ch'
+  def get_scheduler(self):
+    scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [3600])
+    scheduler.restore(datetime.date.today() + datetime.timedelta(1))
+    return scheduler
+  def version(self):
+    return VERSION
+'''
+
+class Downloader(object):
+    def __init__(self, newspaper, calls):
+        self._newspaper = newspaper
+        self._calls = calls
+    def __call__(self, date):
+        self._calls.append((self.name(), self._newspaper.version()))
+        release = self._calls.release
+        self._calls.called.set()
+        return release.wait(5)
+    def name(self):
+        return self._newspaper.name()
+    def host(self):
+        return self._newspaper.host()
+    def get_scheduler(self):
+        return self._newspaper.get_scheduler()
+
+class Calls(list):
+    def __init__(self):
+        super(Calls, self).__init__()
+        self.called = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._name = 'ndreloadtest%d' % id(self)
+        os.mkdir(os.path.join(self._dir, self._name))
+        open(os.path.join(self._dir, self._name, '__init__.py'), 'w').close()
+        self._write('paper', 'Paper', 1)
+        sys.path.insert(0, self._dir)
+        importlib.invalidate_caches()
+        self._package = importlib.import_module(self._name)
+
+        self._calls = Calls()
+        module = importlib.import_module('%s.paper' % self._name)
+        self._engine = nd.scheduler.DownloadEngine([self._create_downloader(module.Loader)])
+        self._thread = threading.Thread(target=self._engine.run)
+        self._thread.start()
+        self._manifest = os.path.join(self._dir, 'plugins.cfg')
+        self._watcher = PluginWatcher(self._engine, self._create_downloader, self._package,
+                                      manifest=self._manifest)
+
+    def tearDown(self):
+        self._calls.release.set()
+        self._engine.post(nd.control.ControlCommand('drain'))
+        self._thread.join(5)
+        sys.path.remove(self._dir)
+        for modname in list(sys.modules):
+            if modname.startswith(self._name):
+                del sys.modules[modname]
+        shutil.rmtree(self._dir)
+
+    def _write(self, modname, name, version, source=None):
+        path = os.path.join(self._dir, self._name, '%s.py' % modname)
+        with open(path, 'w') as plugin:
+            plugin.write(source or ('import datetime\n' + PLUGIN % dict(name=name, version=version)))
+        # a new modification time even on coarse clocks
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + version * 10**9))
+
+    def _create_downloader(self, loader_class):
+        return Downloader(loader_class(None), self._calls)
+
+    def _command(self, line):
+        command = nd.control.parse_command(line)
+        self._engine.post(command)
+        return command.reply(5)
+
+    def _download(self, name):
+        # once the previous download is over
+        for i in range(50):
+            self._calls.called.clear()
+            if self._command('now "%s"' % name) == 'ok':
+                break
+            self._calls.called.wait(0.1)
+        self.assertTrue(self._calls.called.wait(5))
+        return self._calls[-1]
+
+    def testReload(self):
+        self.assertEqual(self._download('Paper'), ('Paper', 1))
+        self._write('paper', 'Paper', 2)
+        self.assertEqual(self._watcher.check(), ['%s.paper' % self._name])
+        self.assertEqual(self._download('Paper'), ('Paper', 2))
+        # nothing changed since
+        self.assertEqual(self._watcher.check(), [])
+
+    def testNewPlugin(self):
+        self._write('other', 'Other', 1)
+        self.assertEqual(self._watcher.check(), ['%s.other' % self._name])
+        self.assertEqual(self._download('Other'), ('Other', 1))
+        names = [name for name, issue_date, wait_until in self._engine.status()]
+        self.assertEqual(sorted(names), ['Other', 'Paper'])
+
+    def testManifest(self):
+        with open(self._manifest, 'w') as manifest:
+            manifest.write('Paper = %s.paper:Loader\n' % self._name)
+        watcher = PluginWatcher(self._engine, self._create_downloader, self._package,
+                                manifest=self._manifest)
+
+        # the modules not listed aren't loaded
+        self._write('other', 'Other', 1)
+        self.assertEqual(watcher.check(), [])
+        self._write('paper', 'Paper', 2)
+        self.assertEqual(watcher.check(), ['%s.paper' % self._name])
+
+        # until they are added to the manifest
+        with open(self._manifest, 'a') as manifest:
+            manifest.write('Other = %s.other:Loader\n' % self._name)
+        self.assertEqual(watcher.check(), ['%s.other' % self._name])
+
+    def testInvalidPlugin(self):
+        self._write('paper', 'Paper', 2, source='raise ImportError("missing dependency")\n')
+        self._watcher.check()
+        self.assertEqual(self._download('Paper'), ('Paper', 1))
+
+    def testReplaceAfterAttempt(self):
+        self._calls.release.clear()
+        self._download('Paper')
+
+        # replaced once the download in progress is over
+        self._write('paper', 'Paper', 2)
+        self._watcher.check()
+        self.assertTrue(self._command('status').startswith('Paper'))
+        self.assertEqual(self._command('now Paper'), 'error: Paper is already being downloaded')
+        self._calls.release.set()
+        self.assertEqual(self._download('Paper'), ('Paper', 2))
+
+    def testInvalidInterval(self):
+        self.assertRaises(ValueError, PluginWatcher, self._engine, self._create_downloader, self._package, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+
+import unittest
+import gzip
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+
+from nd.replay import *
+from nd.http_client import build_opener, ConnectionPool
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hits += 1
+        content = gzip.compress(('page %d' % self.server.hits).encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._origin = http.server.HTTPServer(('127.0.0.1', 0), OriginHandler)
+        self._origin.hits = 0
+        self._thread = threading.Thread(target=self._origin.serve_forever)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:%d/list' % self._origin.server_port
+
+    def tearDown(self):
+        self._origin.shutdown()
+        self._origin.server_close()
+        self._thread.join()
+        shutil.rmtree(self._dir)
+
+    def _get(self, opener, url):
+        page = opener.open(url)
+        try:
+            return page.read().decode('utf-8')
+        finally:
+            page.close()
+
+    def _record(self):
+        archive = Archive({'date': '2014-12-12'})
+        opener = build_opener(pool=RecordingPool(archive))
+        self.assertEqual(self._get(opener, self._url), 'page 1')
+        self.assertEqual(self._get(opener, self._url), 'page 2')
+
+        path = os.path.join(self._dir, 'origin.zip')
+        archive.save(path)
+        return Archive.load(path)
+
+    def _replay_opener(self, server):
+        proxy = urllib.request.ProxyHandler({'http': server.url()})
+        return build_opener(proxy, pool=ConnectionPool())
+
+    def testRecordReplay(self):
+        archive = self._record()
+        self.assertEqual(archive.meta, {'date': '2014-12-12'})
+        self.assertEqual(len(archive.responses('GET', self._url)), 2)
+
+        server = ReplayServer(archive)
+        server.start()
+        try:
+            opener = self._replay_opener(server)
+            self.assertEqual(self._get(opener, self._url), 'page 1')
+            self.assertEqual(self._get(opener, self._url), 'page 2')
+            self.assertEqual(self._get(opener, self._url), 'page 2')
+            self.assertRaises(urllib.error.HTTPError, opener.open, self._url + '/unknown')
+        finally:
+            server.close()
+        # the website isn't asked
+        self.assertEqual(self._origin.hits, 2)
+
+    def testLatency(self):
+        server = ReplayServer(self._record(), latency=0.2)
+        server.start()
+        try:
+            started = time.time()
+            self._get(self._replay_opener(server), self._url)
+            self.assertTrue(time.time() - started >= 0.2)
+        finally:
+            server.close()
+
+    def testInvalidArchive(self):
+        path = os.path.join(self._dir, 'invalid.zip')
+        with open(path, 'wb') as f:
+            f.write(b'not a zip')
+        self.assertRaises(ReplayException, Archive.load, path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+
+import unittest
+import base64
+import hashlib
+import http.server
+import io
+import shutil
+import tempfile
+import threading
+import urllib.request
+
+from nd.resume import *
+from nd.newspaper_api import LoaderException, copy_stream
+from nd.config import Configuration
+
+CONTENT = bytes(range(256)) * 4000
+
+class IssueHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('Range'))
+        content = server.content
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == server.etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+            digest = base64.b64encode(hashlib.sha256(server.digested or content).digest()).decode('ascii')
+            self.send_header('Repr-Digest', 'sha-256=:%s:' % digest)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(server.length or len(content) - start))
+        self.end_headers()
+
+        body = content[start:]
+        if server.cut_at != None:
+            body = body[:server.cut_at]
+        self.wfile.write(body)
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._store = PartialStore(self._dir)
+
+        self._server = http.server.HTTPServer(('127.0.0.1', 0), IssueHandler)
+        self._server.content = CONTENT
+        self._server.etag = '"v1"'
+        self._server.cut_at = None
+        self._server.length = None
+        self._server.digested = None
+        self._server.ranges = []
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:%d/issue.pdf' % self._server.server_port
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        shutil.rmtree(self._dir)
+
+    def _download(self):
+        stream = ResumableStream(self._store, 'Le Temps [2014-12-12]', self._url, urllib.request.urlopen)
+        output = io.BytesIO()
+        try:
+            copy_stream(stream, output)
+        finally:
+            stream.close()
+        return output.getvalue()
+
+    def testDownload(self):
+        self.assertEqual(self._download(), CONTENT)
+        self.assertEqual(self._server.ranges, [None])
+        self.assertEqual(self._store.load('Le Temps [2014-12-12]'), None)
+
+    def testResume(self):
+        self._server.cut_at = len(CONTENT) * 9 // 10
+        try:
+            self._download()
+            self.fail("No exception raised")
+        except LoaderException:
+            pass
+        meta, offset = self._store.load('Le Temps [2014-12-12]')
+        self.assertEqual(offset, len(CONTENT) * 9 // 10)
+        self.assertEqual(meta['etag'], '"v1"')
+
+        # only the end of the issue is downloaded
+        self._server.cut_at = None
+        self.assertEqual(self._download(), CONTENT)
+        self.assertEqual(self._server.ranges, [None, 'bytes=%d-' % offset])
+        self.assertEqual(self._store.load('Le Temps [2014-12-12]'), None)
+
+    def testChangedIssue(self):
+        self._server.cut_at = 1000
+        self.assertRaises(LoaderException, self._download)
+
+        # a new version of the issue is downloaded from the start
+        self._server.cut_at = None
+        self._server.etag = '"v2"'
+        self._server.content = CONTENT[::-1]
+        self.assertEqual(self._download(), CONTENT[::-1])
+
+    def testInvalidDigest(self):
+        self._server.digested = b'something else'
+        self.assertRaises(LoaderException, self._download)
+
+        # the partial download is dropped
+        self.assertEqual(self._store.load('Le Temps [2014-12-12]'), None)
+
+    def testCompletePartialDownload(self):
+        self._server.length = len(CONTENT) + 10
+        self.assertRaises(LoaderException, self._download)
+
+        self._server.length = None
+        self.assertEqual(self._download(), CONTENT)
+        self.assertEqual(self._server.ranges[-2:], ['bytes=%d-' % len(CONTENT), None])
+
+    def testPartialStoreConfig(self):
+        config = Configuration()
+        self.assertEqual(partial_store(config), None)
+
+        config.load(io.StringIO('nd.downloader.partial_dir=%s/partial' % self._dir))
+        self.assertTrue(isinstance(partial_store(config), PartialStore))
+
+if __name__ == '__main__':
+    unittest.main()
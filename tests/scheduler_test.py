@@ -1,5 +1,6 @@
 
 import itertools
+import threading
 
 import unittest
 from mockito import mock, when, verify, spy, inorder, any
@@ -20,6 +21,11 @@ class TestSchedule(unittest.TestCase):
                 return self._base_date.date()
             def now(self):
                 return self._base_date
+            def wait(self, events, x=None):
+                if x is None or not events.empty():
+                    return events.get()
+                self._base_date += datetime.timedelta(seconds=x)
+                return None
 
         self._time = spy(TimeMock())
 
@@ -120,8 +126,8 @@ class TestSchedule(unittest.TestCase):
         except KeyboardInterrupt as e:
             pass
 
-        verify(self._time).sleep(time_to_wait)
-        verify(self._time).sleep(0)
+        verify(self._time).wait(any(), time_to_wait)
+        verify(self._time).wait(any(), 0)
 
         verify(scheduler).failure()
         verify(scheduler).success()
@@ -160,6 +166,251 @@ class TestSchedule(unittest.TestCase):
         verify(scheduler1).success()
         verify(scheduler2).success()
 
+    class BlockingDownloader(object):
+        def __init__(self, host, scheduler):
+            self.started = threading.Event()
+            self.release = threading.Event()
+            self._host = host
+            self._scheduler = scheduler
+        def __call__(self, date):
+            self.started.set()
+            return self.release.wait(5)
+        def host(self):
+            return self._host
+        def get_scheduler(self):
+            return self._scheduler
+
+    def _startedScheduler(self):
+        scheduler = mock()
+        when(scheduler).wait_until().thenReturn(self._time.now())
+        when(scheduler).download_on_date().thenReturn(datetime.date(2020,12,12))
+        when(scheduler).success().thenRaise(KeyboardInterrupt)
+        return scheduler
+
+    def testConcurrentNewspapers(self):
+        downloader1 = self.BlockingDownloader('a.ch', self._startedScheduler())
+        downloader2 = self.BlockingDownloader('b.ch', self._startedScheduler())
+
+        # the second download must start while the first one is still running
+        def release():
+            if downloader2.started.wait(5):
+                downloader1.release.set()
+                downloader2.release.set()
+        threading.Thread(target=release).start()
+
+        try:
+            nd.scheduler.download([downloader1, downloader2], self._time, max_workers=2)
+            self.fail("The exception should be raised")
+        except KeyboardInterrupt:
+            pass
+        self.assertTrue(downloader1.started.is_set())
+
+    def testSameHostNewspapers(self):
+        downloader1 = self.BlockingDownloader('a.ch', self._startedScheduler())
+        downloader2 = self.BlockingDownloader('a.ch', self._startedScheduler())
+
+        # only one download at a time on the same website
+        def release():
+            if downloader1.started.wait(5):
+                downloader2.release.set()
+                downloader2.started.wait(0.1)
+                downloader1.release.set()
+        threading.Thread(target=release).start()
+
+        try:
+            nd.scheduler.download([downloader1, downloader2], self._time, max_workers=2)
+            self.fail("The exception should be raised")
+        except KeyboardInterrupt:
+            pass
+        self.assertFalse(downloader2.started.is_set())
+
+    def testInvalidWorkers(self):
+        try:
+            nd.scheduler.DownloadEngine([mock()], self._time, max_workers=0)
+            self.fail("No exception raised")
+        except ValueError:
+            pass
+
+    def testTimerQueue(self):
+        q = nd.scheduler.TimerQueue()
+        base = datetime.datetime(2014, 12, 12)
+        for i in range(10):
+            q.push(i, base + datetime.timedelta(hours=10-i))
+
+        q.remove(9)
+        q.push(0, base)
+        self.assertFalse(9 in q)
+        self.assertEqual(len(q), 9)
+        self.assertEqual(q.pop(), (base, 0))
+        self.assertEqual(q.pop(), (base + datetime.timedelta(hours=2), 8))
+
+        while q:
+            q.pop()
+        self.assertEqual(q.peek(), None)
+        try:
+            q.pop()
+            self.fail("No exception raised")
+        except KeyError:
+            pass
+
+    def testRestoreState(self):
+        time = mock()
+        when(time).today().thenReturn(datetime.date(2013, 6, 10))
+        wait_evolution = (i for i in [10, 20, 30])
+        scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), wait_evolution, time)
+
+        self.assertEqual(scheduler.state(), (datetime.date(2013, 6, 11), 0, None))
+        scheduler.success()
+        scheduler.failure()
+        self.assertEqual(scheduler.state(), (datetime.date(2013, 6, 12), 1, datetime.date(2013, 6, 11)))
+
+        other = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [10, 20, 30], time)
+        other.restore(*scheduler.state())
+        self.assertEqual(other.state(), scheduler.state())
+        self.assertEqual(other.wait_until(), scheduler.wait_until())
+
+    def testCatchUp(self):
+        time = mock()
+        when(time).today().thenReturn(datetime.date(2013, 6, 10))
+        scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [10, 20], time)
+        scheduler.restore(datetime.date(2013, 6, 7), 1)
+
+        missed = scheduler.catch_up(datetime.date(2013, 6, 11))
+        self.assertEqual(missed, [datetime.date(2013, 6, 7), datetime.date(2013, 6, 8),
+                                  datetime.date(2013, 6, 10)])
+        self.assertEqual(scheduler.state(), (datetime.date(2013, 6, 11), 0, None))
+        self.assertEqual(scheduler.catch_up(datetime.date(2013, 6, 11)), [])
+
+    def testEngineCatchUp(self):
+        import sqlite3, nd.db
+        db = nd.db.DB(sqlite3.connect(':memory:'))
+        db.save_scheduler_state('LT', datetime.date(2014, 12, 10), 1)
+
+        scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [3600], self._time)
+        downloader = mock()
+        dcall = self.CallableMock(downloader)
+        when(downloader).get_scheduler().thenReturn(scheduler)
+        when(downloader).name().thenReturn('LT')
+        when(downloader).__call__(datetime.date(2014, 12, 10)).thenReturn(True)
+        when(downloader).__call__(datetime.date(2014, 12, 11)).thenReturn(False)
+
+        engine = nd.scheduler.DownloadEngine([dcall], self._time, state_store=db)
+        self.assertEqual(scheduler.download_on_date(), datetime.date(2014, 12, 10))
+        engine.catch_up()
+
+        # the missed issues are downloaded by the engine's loop
+        self.assertEqual(db.scheduler_state('LT'), (datetime.date(2014, 12, 10), 0, None))
+        verify(downloader, times=0).__call__(any())
+        self._drainOn(downloader, datetime.date(2014, 12, 11), engine, False)
+        engine.run()
+
+        verify(downloader).__call__(datetime.date(2014, 12, 10))
+        verify(downloader).__call__(datetime.date(2014, 12, 11))
+        verify(downloader, times=0).__call__(datetime.date(2014, 12, 12))
+        state = (datetime.date(2014, 12, 12), 0, datetime.date(2014, 12, 10))
+        self.assertEqual(scheduler.state(), state)
+        self.assertEqual(db.scheduler_state('LT'), state)
+
+    def _drainOn(self, downloader, issue_date, engine, result):
+        class Drain(object):
+            def execute(self, engine):
+                engine.drain()
+        def download(*args):
+            engine.post(Drain())
+            return result
+        when(downloader).__call__(issue_date).thenAnswer(download)
+
+    def testEngineCatchUpDrain(self):
+        import sqlite3, nd.db
+        db = nd.db.DB(sqlite3.connect(':memory:'))
+        db.save_scheduler_state('LT', datetime.date(2014, 12, 9), 0)
+
+        scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [3600], self._time)
+        downloader = mock()
+        dcall = self.CallableMock(downloader)
+        when(downloader).get_scheduler().thenReturn(scheduler)
+        when(downloader).name().thenReturn('LT')
+        when(downloader).host().thenReturn('letemps.ch')
+
+        # the commands are executed between the missed issues
+        nd.scheduler.download([dcall], self._time, state_store=db,
+                              engine_started=lambda x: self._drainOn(downloader, datetime.date(2014, 12, 9), x, True))
+
+        verify(downloader).__call__(datetime.date(2014, 12, 9))
+        verify(downloader, times=0).__call__(datetime.date(2014, 12, 10))
+        self.assertEqual(db.scheduler_state('LT'),
+                         (datetime.date(2014, 12, 10), 0, datetime.date(2014, 12, 9)))
+
+    def testEngineFirstRun(self):
+        import sqlite3, nd.db
+        db = nd.db.DB(sqlite3.connect(':memory:'))
+
+        scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(), [3600], self._time)
+        self.assertEqual(scheduler.download_on_date(), datetime.date(2014, 12, 13))
+        downloader = mock()
+        when(downloader).get_scheduler().thenReturn(scheduler)
+        when(downloader).name().thenReturn('LT')
+
+        # today's issue is downloaded when there is no state
+        nd.scheduler.DownloadEngine([self.CallableMock(downloader)], self._time, state_store=db)
+        self.assertEqual(scheduler.state(), (datetime.date(2014, 12, 12), 0, None))
+
+    def testAdapt(self):
+        time = mock()
+        when(time).today().thenReturn(datetime.date(2013, 6, 10))
+        scheduler = nd.scheduler.SimpleNewspaperDownloadScheduler(nd.scheduler.DailySchedule(),
+                                                                  (x*3600 for x in (6, 12)), time)
+        scheduler.adapt(2*3600, lead=600, step=1800, window=3600)
+        self.assertEqual(scheduler.wait_evolution(), [2*3600-600, 1800, 1800, 6*3600-(3*3600-600), 12*3600])
+
+        midnight = datetime.datetime(2013, 6, 11)
+        self.assertEqual(scheduler.wait_until(), midnight + datetime.timedelta(seconds=2*3600-600))
+        scheduler.failure()
+        self.assertEqual(scheduler.wait_until(), midnight + datetime.timedelta(seconds=2*3600+1200))
+
+        # the original waiting times are kept
+        scheduler.adapt(8*3600, step=1800, window=3600)
+        self.assertEqual(scheduler.wait_evolution(), [8*3600, 1800, 1800, 18*3600-9*3600])
+
+    def testPublicationTimeLearner(self):
+        learner = nd.scheduler.PublicationTimeLearner(step=600)
+        day = datetime.date(2013, 6, 10)
+        self.assertEqual(learner.estimate('LT'), None)
+
+        for i in range(3):
+            date = day + datetime.timedelta(i)
+            midnight = datetime.datetime.combine(date, datetime.time())
+            learner.record('LT', date, midnight + datetime.timedelta(hours=5), False)
+            learner.record('LT', date, midnight + datetime.timedelta(hours=6+i), True)
+
+        self.assertEqual(learner.samples('LT'), [6*3600+1800, 6*3600, 5*3600+1800])
+        self.assertEqual(learner.estimate('LT'), 6*3600)
+
+        # the first attempt is a success
+        date = day + datetime.timedelta(3)
+        midnight = datetime.datetime.combine(date, datetime.time())
+        learner.record('LT', date, midnight + datetime.timedelta(hours=4), True)
+        self.assertEqual(learner.samples('LT')[0], 4*3600-300)
+
+        scheduler = mock()
+        learner.adapt(scheduler, 'LT')
+        verify(scheduler).adapt(6*3600, step=600, window=7200)
+
+    def testLearnerSkipped(self):
+        today = datetime.date(2020, 12, 12)
+        for skipped in (True, False):
+            downloader, learner = mock(), mock()
+            dcall = self.CallableMock(downloader)
+            when(downloader).get_scheduler().thenReturn(self._startedScheduler())
+            when(downloader).name().thenReturn('LT')
+            when(downloader).__call__(today).thenReturn(True)
+            when(downloader).skipped(today).thenReturn(skipped)
+
+            # the issues downloaded by another node aren't learnt
+            self.assertRaises(KeyboardInterrupt, nd.scheduler.download, [dcall], self._time,
+                              learner=learner)
+            verify(learner, times=0 if skipped else 1).record('LT', today, any(), True)
+
     def testNoNewspaper(self):
         try:
             nd.scheduler.download([], self._time)
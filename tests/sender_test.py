@@ -5,6 +5,25 @@ from nd.sender import *
 from nd.db import *
 from mockito import mock, verify, when, any
 import io, datetime
+import email
+import hashlib
+import threading
+import shutil
+import tempfile
+import nd.sender
+
+class BrokenStream(io.BytesIO):
+    '''
+    A download which fails after a first chunk
+    '''
+    def __init__(self):
+        super(BrokenStream, self).__init__(b'%PDF')
+        self._read = False
+    def readinto(self, buffer):
+        if self._read:
+            raise IOError('Connection reset')
+        self._read = True
+        return super(BrokenStream, self).readinto(buffer)
 
 class DBSenderTest(unittest.TestCase):
 
@@ -83,6 +102,96 @@ class DBSenderTest(unittest.TestCase):
 
         self.assertNotEquals(issues1[0].id(), issues2[0].id())
 
+    def testDuplicateIssues(self):
+        sqlite = sqlite3.connect(':memory:')
+        db = DB(sqlite)
+
+        newspaperissue = mock()
+        when(newspaperissue).title().thenReturn('LeTitre')
+        when(newspaperissue).date().thenReturn(datetime.date(2012, 12, 2))
+        newspaper = mock()
+        when(newspaper).name().thenReturn('LT')
+        when(newspaperissue).loader().thenReturn(newspaper)
+
+        self.assertFalse(db.issue_exists('abc'))
+        db.add_issue(newspaperissue, 'a.pdf', None, 'abc')
+        db.add_issue(newspaperissue, 'b.pdf')
+        db.add_issue(newspaperissue, 'c.pdf')
+        self.assertTrue(db.issue_exists('abc'))
+        try:
+            db.add_issue(newspaperissue, 'd.pdf', None, 'abc')
+            self.fail("No exception raised")
+        except DuplicateIssueException:
+            pass
+        self.assertEqual(len(db.issues()), 3)
+
+        # the other constraints aren't duplicates
+        when(newspaperissue).title().thenReturn(None)
+        try:
+            db.add_issue(newspaperissue, 'e.pdf', None, 'def')
+            self.fail("No exception raised")
+        except DuplicateIssueException:
+            self.fail("Not a duplicate")
+        except DBException:
+            pass
+        self.assertFalse(db.issue_exists('def'))
+
+    def testIssueTableMigration(self):
+        sqlite = sqlite3.connect(':memory:')
+        sqlite.execute('CREATE TABLE issue (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL, ' \
+                       'date DATE NOT NULL, newspaper TEXT NOT NULL, path TEXT NOT NULL, thumbnail_path TEXT)')
+        db = DB(sqlite)
+        self.assertFalse(db.issue_exists('abc'))
+        DB(sqlite)
+
+    def testSkipDuplicateContent(self):
+        dirmanager = mock()
+        when(dirmanager).create_file('LeTitre').thenReturn((io.StringIO(''), 'content.txt'))
+
+        newspaperissue = mock()
+        when(newspaperissue).title().thenReturn('LeTitre')
+
+        db = mock()
+        sha256 = hashlib.sha256(b'TheContent').hexdigest()
+        when(db).issue_exists(sha256).thenReturn(True)
+        dbs = DBSender(dirmanager, db)
+        dbs.upload_PDF(newspaperissue, io.StringIO('TheContent'))
+
+        verify(dirmanager).remove_file('content.txt')
+        verify(dirmanager, times=0).create_thumbnail(any(), any())
+        verify(db, times=0).add_issue(any(), any(), any(), any())
+
+        # stored by another download in the meantime
+        when(db).issue_exists(sha256).thenReturn(False)
+        when(dirmanager).create_file('LeTitre').thenReturn((io.StringIO(''), 'content.txt'))
+        when(dirmanager).create_thumbnail('LeTitre', 'content.txt').thenReturn('thumb.png')
+        when(db).add_issue(any(), any(), any(), any()).thenRaise(DuplicateIssueException(''))
+        dbs.upload_PDF(newspaperissue, io.StringIO('TheContent'))
+        verify(dirmanager).remove_file('thumb.png')
+
+    def testSchedulerState(self):
+        sqlite = sqlite3.connect(':memory:')
+        db = DB(sqlite)
+
+        self.assertEqual(db.scheduler_state('LT'), None)
+        db.save_scheduler_state('LT', datetime.date(2014, 12, 2), 2)
+        self.assertEqual(db.scheduler_state('LT'), (datetime.date(2014, 12, 2), 2, None))
+
+        db.save_scheduler_state('LT', datetime.date(2014, 12, 3), 0, datetime.date(2014, 12, 2))
+        self.assertEqual(db.scheduler_state('LT'), (datetime.date(2014, 12, 3), 0, datetime.date(2014, 12, 2)))
+
+    def testPublicationSamples(self):
+        sqlite = sqlite3.connect(':memory:')
+        db = DB(sqlite)
+
+        self.assertEqual(db.publication_samples('LT', 10), [])
+        db.add_publication_sample('LT', datetime.date(2014, 12, 2), 3600)
+        db.add_publication_sample('LT', datetime.date(2014, 12, 3), 7200)
+        db.add_publication_sample('LT', datetime.date(2014, 12, 3), 5400)
+        db.add_publication_sample('TDG', datetime.date(2014, 12, 3), 100)
+        self.assertEqual(db.publication_samples('LT', 10), [5400, 3600])
+        self.assertEqual(db.publication_samples('LT', 1), [5400])
+
     def testInvalidValues(self):
         try:
             DBSender(None, None)
@@ -107,7 +216,7 @@ class DBSenderTest(unittest.TestCase):
 
         ret = (io.StringIO(), 'test')
         when(dirmanager).create_file(any()).thenReturn(ret)
-        when(db).add_issue(any(), any(), None).thenRaise(DBException)
+        when(db).add_issue(any(), any(), None, any()).thenRaise(DBException)
         try:
             sender.upload_PDF(newspaperissue,
                               io.StringIO())
@@ -115,6 +224,14 @@ class DBSenderTest(unittest.TestCase):
         except SenderException:
             pass
 
+    def testPartialDownload(self):
+        dirmanager, db = mock(), mock()
+        when(dirmanager).create_file('LeTitre').thenReturn((io.BytesIO(), 'content.pdf'))
+        sender = DBSender(dirmanager, db)
+        self.assertRaises(SenderException, sender.upload_PDF, self._issue(), BrokenStream())
+        verify(dirmanager).remove_file('content.pdf')
+        verify(db, times=0).add_issue(any(), any(), any(), any())
+
     def testSaveNewspaper(self):
         dirmanager = mock()
         newfile = io.StringIO('')
@@ -136,7 +253,8 @@ class DBSenderTest(unittest.TestCase):
         stream = io.StringIO('TheContent')
         dbs.upload_PDF(newspaperissue, stream)
 
-        verify(db).add_issue(newspaperissue, 'content.txt', 'thumb.png')
+        sha256 = hashlib.sha256(b'TheContent').hexdigest()
+        verify(db).add_issue(newspaperissue, 'content.txt', 'thumb.png', sha256)
         #self.assertEquals(newfile.getvalue(), 'TheContent')
 
     def testExceptionWhenCreatingAThumbnails(self):
@@ -160,11 +278,88 @@ class DBSenderTest(unittest.TestCase):
         stream = io.StringIO('TheContent')
         dbs.upload_PDF(newspaperissue, stream)
 
-        verify(db).add_issue(newspaperissue, 'content.txt', None)
+        sha256 = hashlib.sha256(b'TheContent').hexdigest()
+        verify(db).add_issue(newspaperissue, 'content.txt', None, sha256)
+
+    def _issue(self, title='LeTitre'):
+        newspaperissue = mock()
+        when(newspaperissue).title().thenReturn(title)
+        when(newspaperissue).date().thenReturn(datetime.date(2012, 12, 2))
+        newspaper = mock()
+        when(newspaper).name().thenReturn('LT')
+        when(newspaperissue).loader().thenReturn(newspaper)
+        return newspaperissue
+
+    class SlowDirManager(object):
+        def __init__(self):
+            self.release = threading.Event()
+        def create_file(self, base_name):
+            return io.BytesIO(), '%s.pdf' % base_name
+        def create_thumbnail(self, base_name, pdf_name):
+            if not self.release.wait(5):
+                raise OSError('timeout')
+            return '%s.png' % base_name
+
+    def testThumbnailJobs(self):
+        db = DB(sqlite3.connect(':memory:'))
+        issue_id = db.add_issue(self._issue(), 'a.pdf', None, 'abc', thumbnail_job=True)
+        db.add_issue(self._issue(), 'b.pdf', None, 'def')
+        self.assertEqual(db.thumbnail_jobs(), [(issue_id, 'LeTitre', 'a.pdf', 'LT')])
+
+        db.complete_thumbnail_job(issue_id, 'a.png')
+        self.assertEqual(db.thumbnail_jobs(), [])
+        self.assertEqual(db.issues(id=issue_id)[0].thumbnail_path(), 'a.png')
+
+    def testBackgroundThumbnail(self):
+        db = DB(sqlite3.connect(':memory:', check_same_thread=False))
+        dirmanager = self.SlowDirManager()
+        thumbnails = ThumbnailPool(dirmanager, db)
+        try:
+            dbs = DBSender(dirmanager, db, thumbnails)
+            dbs.upload_PDF(self._issue(), io.BytesIO(b'TheContent'))
+
+            # stored before its thumbnail is created
+            issue = db.issues()[0]
+            self.assertEqual(issue.path(), 'LeTitre.pdf')
+            self.assertEqual(issue.thumbnail_path(), None)
+            self.assertEqual(len(db.thumbnail_jobs()), 1)
+        finally:
+            dirmanager.release.set()
+            thumbnails.close()
+
+        self.assertEqual(db.issues()[0].thumbnail_path(), 'LeTitre.png')
+        self.assertEqual(db.thumbnail_jobs(), [])
+
+    def testResumeThumbnails(self):
+        db = DB(sqlite3.connect(':memory:', check_same_thread=False))
+        db.add_issue(self._issue('A'), 'a.pdf', None, 'abc', thumbnail_job=True)
+        db.add_issue(self._issue('B'), 'b.pdf', None, 'def', thumbnail_job=True)
+
+        dirmanager = mock()
+        when(dirmanager).create_thumbnail('A', 'a.pdf').thenReturn('a.png')
+        when(dirmanager).create_thumbnail('B', 'b.pdf').thenRaise(OSError)
+        thumbnails = ThumbnailPool(dirmanager, db, workers=2)
+        self.assertEqual(thumbnails.resume(), 2)
+        thumbnails.close()
+
+        # a thumbnail which cannot be created isn't retried
+        self.assertEqual(db.thumbnail_jobs(), [])
+        self.assertEqual(sorted(str(x.thumbnail_path()) for x in db.issues()), ['None', 'a.png'])
 
     def testDirManager(self):
         d = DirManager('.')
 
+    def testThumbnailTitle(self):
+        directory = tempfile.mkdtemp()
+        # a command ignoring its arguments
+        convert_path, nd.sender.CONVERT_PATH = nd.sender.CONVERT_PATH, 'true'
+        try:
+            thumbnail_name = DirManager(directory).create_thumbnail('Le Temps: 12.03', 'a.pdf')
+            self.assertTrue(thumbnail_name.startswith('Le Temps 12.03'))
+        finally:
+            nd.sender.CONVERT_PATH = convert_path
+            shutil.rmtree(directory)
+
     def testDirManagerInvalidDir(self):
         try:
             d = DirManager('in va lid')
@@ -244,3 +439,21 @@ class DBSenderTest(unittest.TestCase):
             self.fail('No exception raised')
         except DBException:
             pass
+
+class GMailSenderTest(unittest.TestCase):
+
+    def testAttachment(self):
+        messages = []
+        sender = GMailSender('reader@example.com')
+        sender._send_mail = messages.append
+        issue = mock()
+        when(issue).title().thenReturn('LeTitre')
+        when(issue).date().thenReturn(datetime.date(2012, 12, 2))
+
+        # encoded chunk by chunk
+        content = bytes(range(256)) * 2000
+        sender.upload_PDF(issue, io.BytesIO(content))
+        message = email.message_from_string(messages[0])
+        attachment = message.get_payload()[1]
+        self.assertEqual(attachment.get_payload(decode=True), content)
+        self.assertIn('LeTitre 02-12-12.pdf', attachment['Content-Disposition'])
@@ -0,0 +1,167 @@
+
+import unittest
+import http.server
+import io
+import threading
+import time
+
+from nd.session import *
+import nd.listing
+from nd.http_client import build_opener
+
+class ListingHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.conditions.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        content = server.content.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', server.content_type)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+    def __call__(self):
+        return self.now
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = http.server.HTTPServer(('127.0.0.1', 0), ListingHandler)
+        self._server.content = '<html>issues</html>'
+        self._server.content_type = 'text/html'
+        self._server.etag = '"1"'
+        self._server.conditions = []
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:%d/list' % self._server.server_port
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _get(self, opener):
+        page = opener.open(self._url)
+        try:
+            return page.read().decode('utf-8')
+        finally:
+            page.close()
+
+    def testConditionalRequests(self):
+        opener = build_opener()
+        self.assertEqual(self._get(opener), '<html>issues</html>')
+        self.assertEqual(self._get(opener), '<html>issues</html>')
+        self.assertEqual(self._server.conditions, [None, '"1"'])
+
+        self._server.content = '<html>new issues</html>'
+        self._server.etag = '"2"'
+        self.assertEqual(self._get(opener), '<html>new issues</html>')
+        self.assertEqual(self._get(opener), '<html>new issues</html>')
+        self.assertEqual(self._server.conditions, [None, '"1"', '"1"', '"2"'])
+
+    def testOnlyPagesAreCached(self):
+        self._server.content_type = 'application/pdf'
+        opener = build_opener()
+        self._get(opener)
+        self._get(opener)
+        self.assertEqual(self._server.conditions, [None, None])
+
+    def testStreamedRequestsNotCached(self):
+        opener = build_opener()
+        self._get(opener)
+        page = opener.open(StreamedRequest(self._url))
+        # read from the network
+        self.assertFalse(isinstance(page.fp, io.BytesIO))
+        self.assertEqual(page.read(), b'<html>issues</html>')
+        page.close()
+        self.assertEqual(self._server.conditions, [None, None])
+
+    def testStreamedListingNotModified(self):
+        opener = build_opener()
+        listing = ParsedPage()
+        pattern = r'<html>(?P<title>.*?)</html>'
+        parsed = []
+        def parse_match(metadata):
+            parsed.append(metadata['title'])
+            return metadata['title']
+        def open_page(headers):
+            return opener.open(StreamedRequest(self._url, headers=headers))
+
+        self.assertEqual(list(nd.listing.iter_listing(listing, open_page, pattern, parse_match)), ['issues'])
+        self.assertEqual(list(nd.listing.iter_listing(listing, open_page, pattern, parse_match)), ['issues'])
+        # a "304 Not Modified" the second time, not parsed again
+        self.assertEqual(self._server.conditions, [None, '"1"'])
+        self.assertEqual(parsed, ['issues'])
+
+        self._server.content = '<html>new issues</html>'
+        self._server.etag = '"2"'
+        self.assertEqual(list(nd.listing.iter_listing(listing, open_page, pattern, parse_match)), ['new issues'])
+        self.assertEqual(parsed, ['issues', 'new issues'])
+
+    def testSessionCache(self):
+        clock = FakeClock()
+        logins = []
+        def login():
+            logins.append(clock.now)
+            return 'opener %d' % len(logins)
+
+        session = SessionCache(max_age=60, clock=clock)
+        self.assertEqual(session.get(login), 'opener 1')
+        clock.now = 59
+        self.assertEqual(session.get(login), 'opener 1')
+        clock.now = 60
+        self.assertEqual(session.get(login), 'opener 2')
+
+        session.invalidate()
+        self.assertEqual(session.get(login), 'opener 3')
+
+        # a failed login isn't cached
+        def failing_login():
+            raise IOError('Connection refused')
+        session.invalidate()
+        self.assertRaises(IOError, session.get, failing_login)
+        self.assertEqual(session.get(login), 'opener 4')
+
+    def testConcurrentSessions(self):
+        logins = []
+        def login():
+            logins.append(threading.current_thread().name)
+            time.sleep(0.1)
+            return 'opener'
+
+        session = SessionCache(max_age=60)
+        threads = [threading.Thread(target=session.get, args=(login,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the other threads wait for the first login
+        self.assertEqual(len(logins), 1)
+
+    def testParsedPage(self):
+        parsed = []
+        def parser(page):
+            parsed.append(page)
+            return page.upper()
+
+        listing = ParsedPage()
+        self.assertEqual(listing.parse('a', parser), 'A')
+        self.assertEqual(listing.parse('a', parser), 'A')
+        self.assertEqual(listing.parse('b', parser), 'B')
+        self.assertEqual(parsed, ['a', 'b'])
+
+if __name__ == '__main__':
+    unittest.main()
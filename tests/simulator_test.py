@@ -0,0 +1,50 @@
+
+import unittest
+import datetime
+import queue
+
+import nd.simulator
+
+class SimulatorTest(unittest.TestCase):
+
+    def testVirtualTime(self):
+        start = datetime.datetime(2015, 1, 1)
+        time = nd.simulator.VirtualTime(start, start + datetime.timedelta(hours=1))
+        events = queue.Queue()
+
+        self.assertEqual(time.wait(events, 60), None)
+        self.assertEqual(time.now(), start + datetime.timedelta(minutes=1))
+
+        events.put('event')
+        self.assertEqual(time.wait(events, 60), 'event')
+        self.assertEqual(time.now(), start + datetime.timedelta(minutes=1))
+
+        try:
+            time.wait(events, 3600)
+            self.fail("No exception raised")
+        except nd.simulator.SimulationOver:
+            pass
+
+    def testSimulation(self):
+        report = nd.simulator.simulate([6*3600, 12*3600], nb_newspapers=10, days=30)
+        self.assertTrue(report.attempts >= report.logins)
+        self.assertTrue(report.downloaded > 0)
+        self.assertTrue(report.attempts >= report.downloaded + report.missed)
+
+        frequent = nd.simulator.simulate([3600]*20, nb_newspapers=10, days=30)
+        self.assertTrue(frequent.attempts > report.attempts)
+        self.assertTrue(frequent.mean_delay < report.mean_delay)
+
+    def testAdaptiveSimulation(self):
+        report = nd.simulator.simulate([6*3600, 12*3600], nb_newspapers=20, days=60)
+        adaptive = nd.simulator.simulate([6*3600, 12*3600], nb_newspapers=20, days=60, adaptive=True)
+        self.assertTrue(adaptive.mean_delay < report.mean_delay)
+        self.assertTrue(adaptive.missed <= report.missed)
+
+    def testSameResults(self):
+        report1 = nd.simulator.simulate([3600, 3600], nb_newspapers=5, days=10, seed=3)
+        report2 = nd.simulator.simulate([3600, 3600], nb_newspapers=5, days=10, seed=3)
+        self.assertEqual(str(report1), str(report2))
+
+if __name__ == '__main__':
+    unittest.main()
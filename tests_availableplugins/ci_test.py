@@ -79,7 +79,7 @@ class CILoaderTest(unittest.TestCase):
 
         networkAccess = mock()
         when(networkAccess).login('a', 'b').thenReturn(1)
-        when(networkAccess).issues_page(1).thenReturn(htmlSrc)
+        when(networkAccess).issues_page(1).thenReturn((htmlSrc, len(htmlSrc)))
 
         l = CourrierInternationalLoader(self._config, networkAccess)
         l.init()
@@ -101,7 +101,7 @@ class CILoaderTest(unittest.TestCase):
 
         networkAccess = mock()
         when(networkAccess).login('a', 'b').thenReturn(1)
-        when(networkAccess).issues_page(1).thenReturn(htmlSrc)
+        when(networkAccess).issues_page(1).thenReturn((htmlSrc, len(htmlSrc)))
 
         l = CourrierInternationalLoader(self._config, networkAccess)
         l.init()
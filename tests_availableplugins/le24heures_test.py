@@ -6,6 +6,11 @@ from mockito import mock, verify, when
 import mockito
 
 import urllib
+import io
+import zipfile
+import pypdf
+import threading
+import nd.metrics
 
 class Le24HeuresTest(unittest.TestCase):
 
@@ -39,10 +44,111 @@ class Le24HeuresTest(unittest.TestCase):
 
         issue_lausanne = '<option selected="selected" value="20140201">01.02.14</option>'
 
-        when(netaccess).issues_page(opener, mockito.any()).thenReturn('')
-        when(netaccess).issues_page(opener, 'LAUSANNE').thenReturn(issue_lausanne)
+        when(netaccess).issues_page(opener, mockito.any()).thenReturn(('', 0))
+        when(netaccess).issues_page(opener, 'LAUSANNE').thenReturn((issue_lausanne, len(issue_lausanne)))
 
         self.assertEquals(len(loader.issues()), 1)
         self.assertEquals(loader.issues()[0].date(), datetime.date(2014, 2, 1))
         self.assertEquals(loader.issues()[0].title(), '24 heures')
 
+
+    def testConcurrentListings(self):
+        class BarrierNetAccess(object):
+            def __init__(self):
+                # every listing waits for the others to be requested
+                self.barrier = threading.Barrier(5, timeout=5)
+            def login(self, username, password):
+                return 'opener'
+            def issues_page(self, opener, issue_type):
+                self.barrier.wait()
+                page = '<option value="20140201">01.02.14</option>'
+                return page, len(page)
+
+        loader = Le24HeuresLoader(self._config, BarrierNetAccess())
+        loader.init()
+        issues = loader.issues()
+        self.assertEqual(len(issues), 5)
+        self.assertEqual([issue.title() for issue in issues],
+                         sorted([issue.title() for issue in issues], reverse=True))
+
+    def testIssuesFor(self):
+        netaccess = mock()
+        opener = mock()
+        loader = Le24HeuresLoader(self._config, netaccess)
+        when(netaccess).login('a', 'b').thenReturn(opener)
+        loader.init()
+
+        when(netaccess).zip_exists(opener, mockito.any(), '20140201').thenReturn(False)
+        when(netaccess).zip_exists(opener, 'LAUSANNE', '20140201').thenReturn(True)
+        when(netaccess).zip_exists(opener, 'VQSU', '20140201').thenReturn(True)
+
+        issues = loader.issues_for(datetime.date(2014, 2, 1))
+        self.assertEqual(sorted(issue.title() for issue in issues), ['24 heures', 'Suppléments'])
+        self.assertEqual(set(issue.date() for issue in issues), set([datetime.date(2014, 2, 1)]))
+        verify(netaccess, times=0).issues_page(mockito.any(), mockito.any())
+        phases = [s.phase for s in nd.metrics.REGISTRY.samples() if s.newspaper == '24 Heures']
+        self.assertIn(nd.metrics.LISTING_FETCH, phases)
+
+        # the listings are read if an edition cannot be checked
+        when(netaccess).zip_exists(opener, 'VQSU', '20140201').thenReturn(None)
+        self.assertEqual(loader.issues_for(datetime.date(2014, 2, 1)), None)
+
+    def testZipExists(self):
+        netaccess = Le24HeuresNetAccess()
+        opener = mock()
+        response = mock()
+        response.status = 200
+        when(opener).open(mockito.any()).thenReturn(response)
+        self.assertEqual(netaccess.zip_exists(opener, 'LAUSANNE', '20140201'), True)
+
+        response.status = 204
+        self.assertEqual(netaccess.zip_exists(opener, 'LAUSANNE', '20140201'), True)
+        response.status = 304
+        self.assertEqual(netaccess.zip_exists(opener, 'LAUSANNE', '20140201'), None)
+
+        for code, exists in ((404, False), (403, None), (405, None), (501, None), (503, None)):
+            error = urllib.request.HTTPError('http://epaper.tamedia.ch', code, 'error', {}, None)
+            when(opener).open(mockito.any()).thenRaise(error)
+            self.assertEqual(netaccess.zip_exists(opener, 'LAUSANNE', '20140201'), exists)
+
+    def _zip(self, pages):
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as myzip:
+            for name, width in pages:
+                writer = pypdf.PdfWriter()
+                writer.add_blank_page(width, 100)
+                page = io.BytesIO()
+                writer.write(page)
+                myzip.writestr(name, page.getvalue())
+        content.seek(0)
+        return content
+
+    def testOpen(self):
+        netaccess = mock()
+        opener = mock()
+        loader = Le24HeuresLoader(self._config, netaccess)
+        when(netaccess).login('a', 'b').thenReturn(opener)
+        loader.init()
+
+        # the pages are merged in order
+        pages = [('page02.pdf', 200), ('page01.pdf', 100), ('page03.pdf', 300)]
+        when(netaccess).load_zip(opener, 'LAUSANNE', '20140201').thenReturn(self._zip(pages))
+
+        issue = Le24HeuresIssue('LAUSANNE', '24 heures', datetime.date(2014, 2, 1), loader)
+        stream = issue.open()
+        try:
+            pdf = pypdf.PdfReader(io.BytesIO(stream.read(10**6)))
+        finally:
+            stream.close()
+        self.assertEqual([page.mediabox.width for page in pdf.pages], [100, 200, 300])
+
+    def testOpenInvalidZip(self):
+        netaccess = mock()
+        opener = mock()
+        loader = Le24HeuresLoader(self._config, netaccess)
+        when(netaccess).login('a', 'b').thenReturn(opener)
+        loader.init()
+
+        when(netaccess).load_zip(opener, 'LAUSANNE', '20140201').thenReturn(io.BytesIO(b'not a zip'))
+        issue = Le24HeuresIssue('LAUSANNE', '24 heures', datetime.date(2014, 2, 1), loader)
+        self.assertRaises(LoaderException, issue.open)
@@ -4,7 +4,10 @@ import unittest
 from available_plugins.letemps import *
 from mockito import mock, verify, when
 
-import urllib
+import urllib, urllib.error, urllib.response
+import email.message
+import io
+import nd.metrics
 
 class LeTempsLoaderTest(unittest.TestCase):
 
@@ -87,11 +90,16 @@ class LeTempsLoaderTest(unittest.TestCase):
 
         networkAccess = mock()
         when(networkAccess).login('a', 'b').thenReturn(1)
-        when(networkAccess).issues_page(1).thenReturn(htmlSrc)
+        when(networkAccess).issues_page(1).thenReturn((htmlSrc, 1234))
 
         l = LeTempsLoader(self._config, networkAccess)
         l.init()
-        issues = l.issues()
+        with nd.metrics.newspaper('letemps test'):
+            issues = l.issues()
+        # the number of bytes read from the response
+        sizes = [s.size for s in nd.metrics.REGISTRY.samples()
+                 if s.newspaper == 'letemps test' and s.phase == nd.metrics.LISTING_FETCH]
+        self.assertEquals(sizes, [1234])
 
         self.assertEquals(len(issues), 1)
         self.assertEquals(issues[0].date(), datetime.date(2013,9,14))
@@ -109,7 +117,7 @@ class LeTempsLoaderTest(unittest.TestCase):
 
         networkAccess = mock()
         when(networkAccess).login('a', 'b').thenReturn(1)
-        when(networkAccess).issues_page(1).thenReturn(htmlSrc)
+        when(networkAccess).issues_page(1).thenReturn((htmlSrc, len(htmlSrc)))
 
         l = LeTempsLoader(self._config, networkAccess)
         l.init()
@@ -117,6 +125,60 @@ class LeTempsLoaderTest(unittest.TestCase):
 
         self.assertEquals(len(issues), 0)
 
+    def testIterIssues(self):
+        entry = u'<div class="previewBox"><div class="background"><div class="heading"><strong>Le '
+        entry += u'<i></i>Temps</strong></div>'
+        entry += u'<div class="content"><h3><a href="http://letemps.ch/Page">%02d.09.2013</a></h3>'
+        entry += u'<div class="preview">'
+        entry += u'<a href="http://b.cj"><img src=""></a></div>'
+        entry += u'<ul class="linkbox clear"><li><a href="http://a.html">Version ePaper</a></li>'
+        entry += u'<li><a href="http://letemps.ch/rw/%d.pdf" onclick="">Version PDF</a></li>'
+        htmlSrc = ''.join(entry % (day, day) for day in range(30, 0, -1))
+
+        page = io.BytesIO(htmlSrc.encode('utf-8'))
+        networkAccess = mock()
+        when(networkAccess).login('a', 'b').thenReturn(1)
+        when(networkAccess).issues_stream(1, {}).thenReturn(page)
+
+        l = LeTempsLoader(self._config, networkAccess)
+        l.init()
+        issues = l.iter_issues()
+        issue = next(issues)
+        self.assertEquals(issue.date(), datetime.date(2013, 9, 30))
+        self.assertEquals(issue.title(), 'Le Temps')
+        self.assertEquals(issue.url(), 'http://letemps.ch/rw/30.pdf')
+        self.assertEquals(len(list(issues)), 29)
+        self.assertTrue(page.closed)
+
+    def testIterIssuesNotModified(self):
+        entry = u'<div class="previewBox"><div class="background"><div class="heading"><strong>Le '
+        entry += u'<i></i>Temps</strong></div>'
+        entry += u'<div class="content"><h3><a href="http://letemps.ch/Page">14.09.2013</a></h3>'
+        entry += u'<div class="preview">'
+        entry += u'<a href="http://b.cj"><img src=""></a></div>'
+        entry += u'<ul class="linkbox clear"><li><a href="http://a.html">Version ePaper</a></li>'
+        entry += u'<li><a href="http://letemps.ch/rw/30914.pdf" onclick="">Version PDF</a></li>'
+        headers = email.message.Message()
+        headers['ETag'] = '"1"'
+        page = urllib.response.addinfourl(io.BytesIO(entry.encode('utf-8')), headers, URL_BASE, 200)
+        not_modified = urllib.error.HTTPError(URL_BASE, 304, 'Not Modified', headers, io.BytesIO())
+
+        networkAccess = mock()
+        when(networkAccess).login('a', 'b').thenReturn(1)
+        when(networkAccess).issues_stream(1, {}).thenReturn(page)
+        when(networkAccess).issues_stream(1, {'If-None-Match': '"1"'}).thenRaise(not_modified)
+
+        l = LeTempsLoader(self._config, networkAccess)
+        l.init()
+        issues = list(l.iter_issues())
+        self.assertEquals(len(issues), 1)
+
+        # the issues of the unchanged page are not parsed again
+        parsed = []
+        l._issue = lambda metadata : parsed.append(metadata)
+        self.assertEquals(list(l.iter_issues()), issues)
+        self.assertEquals(parsed, [])
+
     def testGetStream(self):
         loader = mock()
         i = LeTempsIssue('a', datetime.date.today(), loader, 'http://???')
@@ -131,8 +131,9 @@ def thumbnail(id, db):
         thpath = os.path.join(db_folder, issues[0].thumbnail_path())
         if os.path.isfile(thpath):
             return static_file(issues[0].thumbnail_path(), root=db_folder)
-        else:
-            return static_file('no_thumbnail.png', root='static')
+
+    # not created yet (see nd.sender.ThumbnailPool) or missing
+    return static_file('no_thumbnail.png', root='static')
 
 @app.route('/issue/<id:re:\d+>')
 def newspaper(id, db):